@@ -0,0 +1,310 @@
+import numpy
+import vtk
+import slicer
+from vtk.util import numpy_support
+
+#------------------------------------------------------------
+#
+# ActivationMap class
+#
+
+class ActivationMap():
+
+  # ActivationMap generates the isochrones and the conduction velocity (CV) vectors from the local
+  # activation time (LAT) mapped on a surface model (point scalars 'LAT(ms)'; see onMapModel() in
+  # surfacemapping.py).
+  #
+  # The LAT is linear on each triangle, so its gradient is obtained from the differences of the
+  # LAT along the two edges from the first vertex:
+  #
+  #   grad(LAT) = (LAT1 - LAT0) * B1 + (LAT2 - LAT0) * B2
+  #
+  # where B1 and B2 are the dual basis vectors of the edges (e1 = p1 - p0, e2 = p2 - p0) computed
+  # from the inverse of the Gram matrix [[e1.e1, e1.e2], [e1.e2, e2.e2]]. The CV vector of the
+  # triangle is grad(LAT) / |grad(LAT)|^2 (mm/ms = m/s), i.e., the wavefront moves along the gradient
+  # at the speed of 1/|grad(LAT)|. The basis vectors depend only on the mesh, and are cached until
+  # the mesh (or the displayed level of detail) is changed. Updating the map for a new LAT is a few
+  # array operations on the triangles, followed by the contour and glyph filters, which are kept
+  # alive between the updates.
+  #
+  # The isochrones are extracted by vtkContourFilter at every 'spacing' ms. The CV vectors are shown
+  # as arrows at the centroids of the triangles (up to 'maxVectors' triangles), colored by the speed.
+  # The triangles with a speed above 'maxVelocity' (i.e., the LAT is almost flat) are excluded.
+  #
+  # The output model nodes are referenced from the surface model node with the
+  # 'MRTracking.Isochrones' and 'MRTracking.ConductionVelocity' roles.
+  # Use getActivationMap() to obtain the activation map shared by the modules for a model node.
+
+  ISOCHRONE_ROLE = 'MRTracking.Isochrones'
+  VELOCITY_ROLE = 'MRTracking.ConductionVelocity'
+
+  def __init__(self, modelNode, spacing=10.0, maxVelocity=5.0, maxVectors=2000, vectorScale=3.0):
+
+    self.modelNodeID = modelNode.GetID()
+    self.spacing = spacing             # ms
+    self.maxVelocity = maxVelocity     # m/s
+    self.maxVectors = maxVectors
+    self.vectorScale = vectorScale     # mm
+
+    self.meshKey = None
+    self.meshPoly = vtk.vtkPolyData()
+    self.triangleFilter = vtk.vtkTriangleFilter()
+    self.triangleFilter.PassVertsOff()
+    self.triangleFilter.PassLinesOff()
+
+    # Isochrones
+    self.latPoly = vtk.vtkPolyData()
+    self.contour = vtk.vtkContourFilter()
+    self.contour.SetInputData(self.latPoly)
+    self.contour.ComputeNormalsOff()
+    self.contour.ComputeScalarsOn()
+
+    # CV vectors
+    self.vectorPoly = vtk.vtkPolyData()
+    self.arrow = vtk.vtkArrowSource()
+    self.glyph = vtk.vtkGlyph3D()
+    self.glyph.SetInputData(self.vectorPoly)
+    self.glyph.SetSourceConnection(self.arrow.GetOutputPort())
+    self.glyph.OrientOn()
+    self.glyph.SetVectorModeToUseVector()
+    self.glyph.SetScaleModeToDataScalingOff()
+    self.glyph.SetColorModeToColorByScalar()
+
+    self.speedNP = None
+    self.velocityNP = None
+
+
+  def getModelNode(self):
+
+    return slicer.mrmlScene.GetNodeByID(self.modelNodeID)
+
+
+  def getOutputNode(self, role, suffix, create=False):
+
+    modelNode = self.getModelNode()
+    if modelNode == None:
+      return None
+
+    outputNode = modelNode.GetNodeReference(role)
+    if outputNode == None and create:
+      outputNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', modelNode.GetName() + suffix)
+      outputNode.CreateDefaultDisplayNodes()
+      dnode = outputNode.GetDisplayNode()
+      dnode.SetVisibility2D(False)
+      modelNode.SetNodeReferenceID(role, outputNode.GetID())
+    return outputNode
+
+
+  def getIsochroneNode(self, create=False):
+
+    node = self.getOutputNode(self.ISOCHRONE_ROLE, '-Isochrones', create)
+    if node and node.GetPolyData() == None:
+      dnode = node.GetDisplayNode()
+      dnode.SetLineWidth(2.0)
+      dnode.SetColor(0.1, 0.1, 0.1)
+      dnode.SetScalarVisibility(False)
+    return node
+
+
+  def getVelocityNode(self, create=False):
+
+    node = self.getOutputNode(self.VELOCITY_ROLE, '-CV', create)
+    if node and node.GetPolyData() == None:
+      dnode = node.GetDisplayNode()
+      dnode.SetActiveScalarName('CV(m/s)')
+      dnode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeRainbow')
+      dnode.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseManualScalarRange)
+      dnode.SetScalarRange(0.0, self.maxVelocity)
+      dnode.SetScalarVisibility(True)
+    return node
+
+
+  def setVisible(self, isochrones, vectors):
+
+    for (node, visible) in [(self.getIsochroneNode(create=isochrones), isochrones),
+                            (self.getVelocityNode(create=vectors), vectors)]:
+      if node and node.GetDisplayNode():
+        node.GetDisplayNode().SetVisibility(visible)
+
+
+  def updateMesh(self, polyData):
+    # Extract the triangles and precompute the gradient operator. Skipped if the mesh is unchanged.
+
+    key = (polyData, polyData.GetPoints().GetMTime(), polyData.GetPolys().GetMTime())
+    if key == self.meshKey:
+      return False
+
+    self.triangleFilter.SetInputData(polyData)
+    self.triangleFilter.Update()
+    self.meshPoly.ShallowCopy(self.triangleFilter.GetOutput())
+
+    pointsNP = numpy_support.vtk_to_numpy(self.meshPoly.GetPoints().GetData()).astype(float)
+    polys = self.meshPoly.GetPolys()
+    self.trianglesNP = numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).reshape(-1, 3)
+
+    p0 = pointsNP[self.trianglesNP[:,0]]
+    e1 = pointsNP[self.trianglesNP[:,1]] - p0
+    e2 = pointsNP[self.trianglesNP[:,2]] - p0
+    g11 = numpy.einsum('ij,ij->i', e1, e1)
+    g12 = numpy.einsum('ij,ij->i', e1, e2)
+    g22 = numpy.einsum('ij,ij->i', e2, e2)
+    det = g11 * g22 - g12 * g12
+    # Degenerate triangles have no gradient.
+    self.validTriangles = det > 1e-12 * numpy.maximum(g11 * g22, 1e-30)
+    invDet = numpy.zeros(det.shape)
+    invDet[self.validTriangles] = 1.0 / det[self.validTriangles]
+    self.basis1 = (g22 * invDet)[:,None] * e1 - (g12 * invDet)[:,None] * e2
+    self.basis2 = (g11 * invDet)[:,None] * e2 - (g12 * invDet)[:,None] * e1
+    self.centroidsNP = p0 + (e1 + e2) / 3.0
+
+    # The LAT is assigned to the points of a copy of the mesh for the contour filter.
+    self.latPoly.SetPoints(self.meshPoly.GetPoints())
+    self.latPoly.SetPolys(polys)
+
+    self.meshKey = key
+    return True
+
+
+  def computeVelocity(self, latNP):
+    #
+    # Compute the CV of the triangles from the LAT at the points. Returns a tuple (speed, velocity),
+    # where 'speed' is an (nT,) array (m/s) and 'velocity' is an (nT, 3) array. NaN for the
+    # triangles without a valid gradient.
+    #
+
+    t = self.trianglesNP
+    lat0 = latNP[t[:,0]]
+    gradNP = (latNP[t[:,1]] - lat0)[:,None] * self.basis1 + (latNP[t[:,2]] - lat0)[:,None] * self.basis2
+    grad2 = numpy.einsum('ij,ij->i', gradNP, gradNP)
+
+    valid = numpy.logical_and(self.validTriangles, numpy.isfinite(grad2))
+    valid[valid] = grad2[valid] > 0.0
+    speedNP = numpy.full(grad2.shape, numpy.nan)
+    velocityNP = numpy.full(gradNP.shape, numpy.nan)
+    speedNP[valid] = 1.0 / numpy.sqrt(grad2[valid])
+    velocityNP[valid] = gradNP[valid] / grad2[valid][:,None]
+    return (speedNP, velocityNP)
+
+
+  def getIsochroneValues(self, latNP):
+
+    latNP = latNP[numpy.isfinite(latNP)]
+    if len(latNP) == 0 or self.spacing <= 0.0:
+      return numpy.zeros(0)
+    first = numpy.ceil(numpy.min(latNP) / self.spacing) * self.spacing
+    return numpy.arange(first, numpy.max(latNP), self.spacing)
+
+
+  def updateIsochrones(self, latArray):
+
+    self.latPoly.GetPointData().SetScalars(latArray)
+    self.latPoly.Modified()
+    values = self.getIsochroneValues(numpy_support.vtk_to_numpy(latArray))
+    self.contour.SetNumberOfContours(len(values))
+    for (i, v) in enumerate(values):
+      self.contour.SetValue(i, v)
+    self.contour.Update()
+
+    node = self.getIsochroneNode(create=True)
+    poly = vtk.vtkPolyData()
+    poly.DeepCopy(self.contour.GetOutput())
+    node.SetAndObservePolyData(poly)
+    return len(values)
+
+
+  def updateVectors(self):
+
+    speedNP = self.speedNP
+    selected = numpy.nonzero(speedNP <= self.maxVelocity)[0]  # NaN is excluded.
+    if len(selected) > self.maxVectors:
+      selected = selected[numpy.linspace(0, len(selected) - 1, self.maxVectors).astype(int)]
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(self.centroidsNP[selected]), deep=True))
+    directionNP = self.velocityNP[selected] / speedNP[selected][:,None]
+    vectors = numpy_support.numpy_to_vtk(numpy.ascontiguousarray(directionNP), deep=True)
+    vectors.SetName('Direction')
+    speed = numpy_support.numpy_to_vtk(numpy.ascontiguousarray(speedNP[selected]), deep=True)
+    speed.SetName('CV(m/s)')
+
+    self.vectorPoly.Initialize()
+    self.vectorPoly.SetPoints(points)
+    self.vectorPoly.GetPointData().SetVectors(vectors)
+    self.vectorPoly.GetPointData().SetScalars(speed)
+    self.vectorPoly.Modified()
+    self.glyph.SetScaleFactor(self.vectorScale)
+    self.glyph.Update()
+
+    node = self.getVelocityNode(create=True)
+    poly = vtk.vtkPolyData()
+    poly.DeepCopy(self.glyph.GetOutput())
+    node.SetAndObservePolyData(poly)
+    return len(selected)
+
+
+  def update(self, paramStr='LAT(ms)', isochrones=True, vectors=True):
+    #
+    # Update the isochrones and the CV vectors from the point scalars 'paramStr' of the model.
+    # Returns False if the map is not available.
+    #
+
+    modelNode = self.getModelNode()
+    if modelNode == None or modelNode.GetPolyData() == None:
+      return False
+    polyData = modelNode.GetPolyData()
+    if polyData.GetNumberOfPoints() == 0:
+      return False
+    latArray = polyData.GetPointData().GetArray(paramStr)
+    if latArray == None:
+      return False
+
+    if self.updateMesh(polyData):
+      print('Activation map: %d triangles.' % self.trianglesNP.shape[0])
+
+    latNP = numpy_support.vtk_to_numpy(latArray).astype(float)
+    (self.speedNP, self.velocityNP) = self.computeVelocity(latNP)
+
+    if isochrones:
+      self.updateIsochrones(latArray)
+    if vectors:
+      self.updateVectors()
+    self.setVisible(isochrones, vectors)
+    return True
+
+
+  def getMedianVelocity(self):
+
+    if self.speedNP is None:
+      return numpy.nan
+    speedNP = self.speedNP[self.speedNP <= self.maxVelocity]
+    if len(speedNP) == 0:
+      return numpy.nan
+    return float(numpy.median(speedNP))
+
+
+# Activation maps shared by the modules, keyed by the model node ID. The entries must be removed
+# when the nodes are removed or the scene is closed, since the node IDs are reused (see
+# removeActivationMap()).
+activationMaps = {}
+
+def getActivationMap(modelNode):
+  # Returns the ActivationMap for the model node.
+
+  if modelNode == None:
+    return None
+
+  nodeID = modelNode.GetID()
+  amap = activationMaps.get(nodeID)
+  if amap == None:
+    amap = ActivationMap(modelNode)
+    activationMaps[nodeID] = amap
+  return amap
+
+
+def removeActivationMap(nodeID=None):
+  # Remove the activation map for the model node ID, or all the maps if 'nodeID' is None.
+
+  if nodeID == None:
+    activationMaps.clear()
+  else:
+    activationMaps.pop(nodeID, None)
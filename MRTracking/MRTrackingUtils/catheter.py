@@ -22,6 +22,235 @@ import slicer
 import numpy
 import vtk
 import time
+from vtk.util import numpy_support
+from MRTrackingUtils.cathetermodel import *
+from MRTrackingUtils.distortion import *
+from MRTrackingUtils.trackinghistory import *
+from MRTrackingUtils.recordingfilter import *
+from MRTrackingUtils.egramtable import *
+from MRTrackingUtils.pointcloud import *
+
+
+def computeCurveFrames(points):
+  #
+  # Compute the local coordinate frames along a curve given as an (N, 3) array of points.
+  # Returns an (N, 4, 4) array of homogeneous matrices. As in
+  # vtkMRMLMarkupsCurveNode::GetCurvePointToWorldTransformAtPointIndex(), the z-axis of each
+  # frame is the unit tangent pointing toward the points with larger indices, and the x- and y-axes
+  # are the normal and binormal vectors. The tangents are computed by finite differences
+  # (central differences for the inner points) over the whole array at once.
+  #
+
+  nPoints = points.shape[0]
+  frames = numpy.tile(numpy.eye(4), (nPoints, 1, 1))
+  if nPoints == 0:
+    return frames
+
+  frames[:,0:3,3] = points
+  if nPoints < 2:
+    return frames
+
+  tangents = numpy.gradient(points, axis=0)
+  norm = numpy.linalg.norm(tangents, axis=1)
+
+  # The tangent is not defined at coincident points (e.g., all the coils at the origin before the
+  # first tracking message). Those points use the tangent of the previous valid point (or the next
+  # one at the beginning of the curve), or the z-axis if there is no valid point.
+  fValid = norm > 1.0e-9
+  if not numpy.any(fValid):
+    tangents = numpy.zeros((nPoints, 3))
+    tangents[:,2] = 1.0
+  else:
+    tangents = tangents / numpy.where(fValid, norm, 1.0)[:,None]
+    index = numpy.where(fValid, numpy.arange(nPoints), -1)
+    index = numpy.maximum.accumulate(index)
+    index[index < 0] = numpy.argmax(fValid)
+    tangents = tangents[index]
+
+  # Use the x-axis as a reference to compute the normal vectors, unless the tangent is
+  # (nearly) parallel to the x-axis.
+  ref = numpy.zeros((nPoints, 3))
+  fParallel = numpy.abs(tangents[:,0]) > 0.9
+  ref[~fParallel,0] = 1.0
+  ref[fParallel,1] = 1.0
+
+  binormals = numpy.cross(tangents, ref)
+  binormals = binormals / numpy.linalg.norm(binormals, axis=1)[:,None]
+  normals = numpy.cross(binormals, tangents)
+
+  frames[:,0:3,0] = normals
+  frames[:,0:3,1] = binormals
+  frames[:,0:3,2] = tangents
+
+  return frames
+
+
+class CatheterCurve:
+
+  # CatheterCurve computes the catheter path from the coil positions using a centripetal
+  # Catmull-Rom spline. All the quantities needed to visualize the catheter are obtained from
+  # a single vectorized evaluation in update(), and stored as NumPy arrays:
+  #
+  #   points      : (N, 3) curve points, from the extended tip to the most proximal coil
+  #   frames      : (N, 4, 4) local frames at the curve points (see computeCurveFrames())
+  #   arcLength   : (N,) length along the curve measured from the extended tip
+  #   coilIndices : indices of the coils in 'points'
+  #
+  # The extended tip is always points[0]. If the tip length is 0, the tip coincides with the
+  # first coil.
+
+  def __init__(self, samplesPerSegment=10, alpha=0.5):
+
+    self.samplesPerSegment = samplesPerSegment  # Number of curve points between two coils
+    self.alpha = alpha                          # 0.5 for centripetal Catmull-Rom spline
+    self.clear()
+
+
+  def clear(self):
+
+    self.points = numpy.zeros((0,3))
+    self.frames = numpy.zeros((0,4,4))
+    self.arcLength = numpy.zeros(0)
+    self.coilIndices = numpy.array([], dtype=int)
+
+
+  def update(self, coilPoints, tipLength=0.0):
+    # Evaluate the curve for the coil positions given as an (n, 3) array ordered from distal
+    # to proximal. 'tipLength' is the distance between the catheter tip and the first coil.
+    # Returns False if the curve cannot be computed.
+
+    nCoils = coilPoints.shape[0]
+    if nCoils == 0:
+      self.clear()
+      return False
+
+    if nCoils == 1:
+      # No curve; only the coil with the default frame.
+      self.points = numpy.array(coilPoints, dtype=float).reshape(1, 3)
+      self.coilIndices = numpy.array([0])
+      self.frames = computeCurveFrames(self.points)
+      self.arcLength = numpy.zeros(1)
+      return True
+
+    body = self.evaluateSpline(numpy.array(coilPoints, dtype=float))
+    coilIndices = numpy.arange(nCoils) * self.samplesPerSegment
+
+    # Extrapolate the tip along the tangent at the first coil.
+    nTipSamples = 0
+    tipPoints = numpy.zeros((0,3))
+    if nCoils > 1 and tipLength > 0.0:
+      direction = body[0] - body[1]
+      norm = numpy.linalg.norm(direction)
+      if norm > 0.0:
+        nTipSamples = self.samplesPerSegment
+        direction = direction / norm
+        s = tipLength * (1.0 - numpy.arange(nTipSamples) / nTipSamples)
+        tipPoints = body[0] + s[:,None] * direction
+
+    self.points = numpy.concatenate((tipPoints, body), axis=0)
+    self.coilIndices = coilIndices + nTipSamples
+    self.frames = computeCurveFrames(self.points)
+    self.arcLength = numpy.zeros(self.points.shape[0])
+    self.arcLength[1:] = numpy.cumsum(numpy.linalg.norm(numpy.diff(self.points, axis=0), axis=1))
+
+    return True
+
+
+  def evaluateSpline(self, p):
+    # Evaluate the centripetal Catmull-Rom spline through the points 'p' ((n, 3) array, n >= 2)
+    # using the Barry-Goldman pyramidal formulation. All segments are evaluated at once.
+    # The phantom end points are obtained by reflecting the second and the second last points.
+    # The returned array includes the input points at every 'samplesPerSegment' points.
+
+    n = p.shape[0]
+    nSamples = self.samplesPerSegment
+
+    ext = numpy.concatenate(([2.0*p[0]-p[1]], p, [2.0*p[-1]-p[-2]]), axis=0)
+    p0 = ext[0:n-1]
+    p1 = ext[1:n]
+    p2 = ext[2:n+1]
+    p3 = ext[3:n+2]
+
+    def knotInterval(a, b):
+      d = numpy.linalg.norm(b-a, axis=1)
+      return numpy.maximum(d, 1.0e-6) ** self.alpha
+
+    t0 = numpy.zeros(n-1)
+    t1 = t0 + knotInterval(p0, p1)
+    t2 = t1 + knotInterval(p1, p2)
+    t3 = t2 + knotInterval(p2, p3)
+
+    u = numpy.arange(nSamples) / float(nSamples)
+    t = (t1[:,None] + (t2-t1)[:,None] * u[None,:])[:,:,None]  # (n-1, nSamples, 1)
+
+    def lerp(a, b, ta, tb):
+      w = (t - ta[:,None,None]) / (tb-ta)[:,None,None]
+      return (1.0-w) * a + w * b
+
+    a1 = lerp(p0[:,None,:], p1[:,None,:], t0, t1)
+    a2 = lerp(p1[:,None,:], p2[:,None,:], t1, t2)
+    a3 = lerp(p2[:,None,:], p3[:,None,:], t2, t3)
+    b1 = lerp(a1, a2, t0, t2)
+    b2 = lerp(a2, a3, t1, t3)
+    c = lerp(b1, b2, t1, t2)
+
+    return numpy.concatenate((c.reshape(-1,3), p[-1:]), axis=0)
+
+
+  def getResampledPoints(self, nSegments=10):
+    # Resample the curve between the first and the last coils into 'nSegments' segments with
+    # an equal length. The extended tip is added as the first point if available.
+
+    if self.points.shape[0] < 2:
+      return numpy.array(self.points)
+
+    i0 = self.coilIndices[0]
+    l = numpy.linspace(self.arcLength[i0], self.arcLength[-1], nSegments+1)
+    resampled = self.getPointsAtArcLength(l)
+    if i0 > 0:
+      resampled = numpy.concatenate((self.points[0:1], resampled), axis=0)
+
+    return resampled
+
+
+  def getPointsAtArcLength(self, lengths):
+    # Return the points at the given lengths from the tip along the curve.
+
+    points = numpy.zeros((len(lengths), 3))
+    for i in range(3):
+      points[:,i] = numpy.interp(lengths, self.arcLength, self.points[:,i])
+    return points
+
+
+  def getPointsAtCoilDistances(self, coilDistances, distances):
+    #
+    # Return the points at the nominal distances from the tip given as 'distances'. 'coilDistances'
+    # are the nominal distances of the coils (ascending). The arc length is interpolated linearly
+    # between two coils, so that the points at the coil distances coincide with the coils.
+    # Returns a tuple (points, mask), where 'points' is an (m, 3) array and 'mask' is a boolean array
+    # that is False for the distances outside [first coil, last coil). As in the original per-segment
+    # search, a point exactly at the last coil is not interpolated.
+    #
+
+    distances = numpy.asarray(distances, dtype=float).reshape(-1)
+    points = numpy.zeros((distances.shape[0], 3))
+    mask = numpy.zeros(distances.shape[0], dtype=bool)
+
+    n = min(len(coilDistances), len(self.coilIndices))
+    if n < 2:
+      return (points, mask)
+
+    coilDistances = numpy.asarray(coilDistances[:n], dtype=float)
+    mask = numpy.logical_and(distances >= coilDistances[0], distances < coilDistances[-1])
+    lengths = numpy.interp(distances[mask], coilDistances, self.arcLength[self.coilIndices[:n]])
+    points[mask] = self.getPointsAtArcLength(lengths)
+
+    return (points, mask)
+
+
+  def getCoilFrames(self):
+
+    return self.frames[self.coilIndices]
 
 
 class CatheterCollection(QObject):
@@ -146,6 +375,14 @@ class Catheter:
     self.childTransformNodeIDList = [None] * self.MAX_COILS
     
     self.lastMTime = 0
+    self.lastTS = 0.0
+
+    # Tracking history
+    # The coil positions (before registration) are recorded with their time stamps every time new
+    # tracking data arrive. The registration uses the history to pair the samples from two catheters
+    # acquired at different rates (see pairTrackingSamples()).
+    self.trackingHistory = TrackingHistory()
+    self.pairingCurve = CatheterCurve()
 
     # Coil model
     self.coilPointsNP = numpy.array([])
@@ -157,10 +394,32 @@ class Catheter:
     self.coilTransformFilterArray = []
     self.coilLength = 3.0
 
+    # Catheter path
+    # The path is interpolated from the (registered) coil positions by CatheterCurve in every
+    # frame. The coils are mapped to known indices of the interpolated curve points, so that
+    # the coil frames can be obtained without searching for the closest points on the curve.
+    self.curve = CatheterCurve()
+    self.curveResamplingSegments = 10                          # Number of segments for the control points
+    self.coilCurvePointIndices = numpy.array([], dtype=int)  # Curve point index for each active coil
+    self.curvePointsWorldNP = numpy.zeros((0,3))               # Interpolated curve points (world)
+    self.coilFramesNP = numpy.zeros((0,4,4))                   # Coil frames (world)
+
     # Sheath model
     self.sheathModelNode = None 
     self.sheathPoly = None
 
+    # Rendering mode
+    #   'filter' : The coils and the sheath are drawn as separate models generated by VTK filters.
+    #   'mesh'   : The shaft, the sheath, and the coils are drawn as one model with a fixed topology
+    #              (see CatheterTubeModel). Only the point coordinates are updated in each frame.
+    #   'glyph'  : The coils are drawn as glyphs with per-coil position and direction arrays
+    #              (see CatheterCoilGlyphModel). The sheath is drawn as in the 'filter' mode.
+    self.renderingMode = 'filter'
+    self.tubeModel = None
+    self.tubeModelNodeID = ''
+    self.coilGlyphModel = None
+    self.coilGlyphModelNodeID = ''
+
     self.tipTransformNode = None
 
     # Coil configuration
@@ -180,6 +439,9 @@ class Catheter:
     self.pointRecordingMarkupsNode = None
     self.pointRecordingDistance = 0.0
     self.prevRecordedPoints = numpy.array([[0.0, 0.0, 0.0]])
+    # If the voxel size of the filter is greater than 0, only one point per voxel is kept
+    # (see VoxelRecordingFilter).
+    self.pointRecordingFilter = VoxelRecordingFilter()
     
     # Coordinate system
     self.axisDirections = numpy.array([1.0, 1.0, 1.0])
@@ -250,7 +512,13 @@ class Catheter:
     self.registration = None
 
     # Distortion correction
+    # If 'distortionCorrection' is True, the coil positions are corrected by the displacement field
+    # in 'distortionGrid' after the registration transform is applied. The grid is copied to
+    # 'distortionTransformNode' for visualization.
+    self.distortionCorrection = False
+    self.distortionGrid = DistortionGrid()
     self.distortionTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+    self.distortionTransformNode.SetName(name + '-DistortionTransform')
     
     ## Default values for self.coilPositions:
     self.defaultCoilPositions = {}
@@ -438,6 +706,9 @@ class Catheter:
 
       # Update catheter/registration
       self.updateCatheterNode()
+
+      if fUpdate:
+        self.trackingHistory.add(self.lastTS, self.coilPointsNP)
       
       if fUpdate and self.registration:
         self.registration.updatePoints()
@@ -554,43 +825,22 @@ class Catheter:
 
 
   
-  #def createDistortionTransform(self):
-  #
-  #  rasBounds = [0,]*6
-  #  rasBounds = [-20,20,-20,20,-20,20]
-  #  
-  #  from math import floor, ceil
-  #
-  #  trans = vtk.vtkTransform()
-  #  trans.Translate(10,20,30)
-  #  trans.rotateZ(20)
-  #  
-  #  origin = map(int,map(floor,rasBounds[::2]))
-  #  maxes = map(int,map(ceil,rasBounds[1::2]))
-  #  boundSize = [m - o for m,o in zip(maxes,origin) ]
-  #  spacing = [1.0, 1.0, 1.0]
-  #  samples = [ceil(b / s) for b,s in zip(boundSize,spacing)]
-  #  extent = [0,]*6
-  #  extent[::2] = [0,]*3
-  #  extent[1::2] = samples
-  #  extent = map(int,extent)
-  #  
-  #  toGrid = vtk.vtkTransformToGrid()
-  #  toGrid.SetGridOrigin(origin)
-  #  toGrid.SetGridSpacing(spacing)
-  #  toGrid.SetGridExtent(extent)
-  #  toGrid.SetInput(trans)
-  #  toGrid.Update()
-  #  gridTransform = vtk.vtkGridTransform()
-  #  gridTransform.SetDisplacementGridData(toGrid.GetOutput())
-  #
-  #  if self.distortionTransformNode == None:
-  #    gridNode = slicer.vtkMRMLGridTransformNode()
-  #    gridNode.SetName(state.transform.GetName()+"-grid")
-  #    slicer.mrmlScene.AddNode(gridNode)
-  #    
-  #  gridNode.SetAndObserveTransformFromParent(gridTransform)
-    
+  def setDistortionGrid(self, grid):
+    # Set a DistortionGrid, and copy it to the distortion transform node.
+
+    self.distortionGrid = grid
+    if self.distortionTransformNode and grid.isValid():
+      grid.updateGridTransformNode(self.distortionTransformNode)
+
+
+  def setDistortionCorrection(self, s):
+
+    self.distortionCorrection = s
+    if self.logic:
+      self.logic.getParameterNode().SetParameter("TD.%s.distortionCorrection" % self.name, str(self.distortionCorrection))
+      return 1
+    return 0
+
     
   def updateCatheterNode(self):
 
@@ -630,6 +880,8 @@ class Catheter:
 
     ## ------------------------
     ## TODO: Interpolation should be performed in the transformed space
+    ## The registration transform (linear or thin plate spline) is applied to the coil positions
+    ## as a NumPy array (see MRTrackingFiducialRegistration.transformPointsNP()).
     transformedCoilPoints = None
     
     if self.registration and \
@@ -637,64 +889,42 @@ class Catheter:
         self.registration.applyTransform.catheterID == self.catheterID and \
         self.registration.registrationTransform:
       
-      #egramPoint = self.registration.registrationTransform.TransformPoint(egramPoint)
-      transformedCoilPoints = vtk.vtkPoints()  # TODO: Make it a class member to avoid creating a new objects in each iteration?
-      self.registration.registrationTransform.TransformPoints(self.coilPoints, transformedCoilPoints)
+      transformedCoilPointsNP = self.registration.transformPointsNP(self.coilPointsNP)
+      transformedCoilPoints = vtk.vtkPoints()
+      transformedCoilPoints.SetData(numpy_support.numpy_to_vtk(transformedCoilPointsNP, deep=True))
     else:
       curveNode.SetAndObserveTransformNodeID('')
       transformedCoilPoints = self.coilPoints
-      
-    nTransformedPoints = transformedCoilPoints.GetNumberOfPoints()
-    transformedCoilPointsNP = numpy.zeros((nTransformedPoints,3))
-    self.pointsToNumpyArray(transformedCoilPoints, transformedCoilPointsNP)
-      
-    length = 0.0
-    prevPoint = numpy.array(transformedCoilPoints.GetPoint(0))
-    pPrev = transformedCoilPointsNP[0]
-    for p in transformedCoilPointsNP[1:]:
-      length = length + numpy.linalg.norm(p-pPrev)
-      pPrev = p
-    
-
-    # Determin the resampling interval. Aim to divide the catheter into 10 segments.
-    resamplingIntv = length / 10.0
-    if resamplingIntv < 0.01: # The minimum value for resamplingIntv is 0.01.
-      resamplingIntv = 0.01
-
-    interpolatedPoints = vtk.vtkPoints()
-    #slicer.vtkMRMLMarkupsCurveNode.ResamplePoints(self.coilPoints, interpolatedPoints, resamplingIntv, False)
-    slicer.vtkMRMLMarkupsCurveNode.ResamplePoints(transformedCoilPoints, interpolatedPoints, resamplingIntv, False)
-    nInterpolatedPoints = interpolatedPoints.GetNumberOfPoints()
-    #curveNode.SetControlPointPositionsWorld(interpolatedPoints)
-    # Set pre-registration coordinates
-    nControlPoints = curveNode.GetNumberOfControlPoints()
-    if nControlPoints > nInterpolatedPoints:
-      i = 0
-      for i in range(nInterpolatedPoints):
-        p = interpolatedPoints.GetPoint(i)
-        curveNode.SetNthControlPointPosition(i, p[0], p[1], p[2])
-      for i in range(nInterpolatedPoints, nControlPoints):
-        curveNode.RemoveNthControlPoint(nInterpolatedPoints)
-    else:
-      i = 0
-      for i in range(nControlPoints):
-        p = interpolatedPoints.GetPoint(i)
-        curveNode.SetNthControlPointPosition(i, p[0], p[1], p[2])
-      for i in range(nControlPoints,nInterpolatedPoints):
-        p = interpolatedPoints.GetPoint(i)
-        v = vtk.vtkVector3d(p)
-        curveNode.InsertControlPoint(i, v)
+      transformedCoilPointsNP = numpy.array(self.coilPointsNP).reshape(-1,3)
+
+    # Distortion correction (in the registered space)
+    if self.distortionCorrection and self.distortionGrid.isValid():
+      transformedCoilPointsNP = self.distortionGrid.apply(transformedCoilPointsNP)
+      transformedCoilPoints = vtk.vtkPoints()
+      transformedCoilPoints.SetData(numpy_support.numpy_to_vtk(transformedCoilPointsNP, deep=True))
 
+    # Interpolate the catheter path. The curve points, the coil frames, the extended tip and
+    # the sheath centerline are all obtained from a single evaluation by CatheterCurve.
     coilPosFromTip = self.getActiveCoilPositionsFromTip()
-    tipLength = coilPosFromTip[0]
+    tipLength = 0.0
+    if len(coilPosFromTip) > 0:
+      tipLength = coilPosFromTip[0]
 
-    (f, p) = self.computeExtendedTipPosition(curveNode, tipLength)
-    if f:
-      v = vtk.vtkVector3d(p)
-      curveNode.InsertControlPoint(0,v)
+    self.curve.update(transformedCoilPointsNP, tipLength)
+    self.curvePointsWorldNP = self.curve.points
+    self.coilCurvePointIndices = self.curve.coilIndices
+    self.coilFramesNP = self.curve.getCoilFrames()
+
+    # Feed the resampled points to the curve node at once.
+    controlPointsNP = self.curve.getResampledPoints(self.curveResamplingSegments)
+    controlPoints = vtk.vtkPoints()
+    controlPoints.SetData(numpy_support.numpy_to_vtk(controlPointsNP, deep=True))
+    curveNode.SetControlPointPositionsWorld(controlPoints)
+
+    self.updateTipTransform(curveNode)
 
     ## ------------------------
-    
+
     curveNode.EndModify(prevState)
 
     ## Apply registration transform to the curve node and Egram poit
@@ -748,74 +978,47 @@ class Catheter:
         self.prevRecordedPoints = recordingPoints
       
 
-  def computeExtendedTipPosition(self, curveNode, tipLength):
-
-    # Add a extended tip
-    # make sure that there is more than one points
-    
-    if curveNode.GetNumberOfControlPoints() < 2:
-      return (False, None)
-    
-    lastPoint = curveNode.GetNumberOfControlPoints()-1
-
-    if lastPoint < 2:
-      # Not possible to compute an extended tip position.
-      return (False, None)
-
-    ## The 'curve end point matrix' (normal vectors + the curve end position)
-    matrix = vtk.vtkMatrix4x4()
+  def updateTipTransform(self, curveNode):
 
-    #curvePoints = curveNode.GetCurvePoints() # This does not work on Slicer 5.x
-    #TODO: The following obtains points in the world coordinates. Does it work??
-    curvePoints = vtk.vtkPoints()
-    curveNode.GetControlPointPositionsWorld(curvePoints)
-    p0 = numpy.array(curvePoints.GetPoint(0))
-    p1 = numpy.array(curvePoints.GetPoint(1))
+    # Update Tip transform (for volume reslicing) with the extended tip computed by self.curve.
+    # Note that the tip is computed in the registered space.
 
-    n10 = p0 - p1
-    n10 = n10 / numpy.linalg.norm(n10)
+    if self.curvePointsWorldNP.shape[0] == 0:
+      return
 
-    # Tip location
-    # The sign for the normal vector is '-' because the normal vector point toward points
-    # with larger indecies.
-    pe = p0 + n10 * tipLength
+    pe = self.curvePointsWorldNP[0]
 
-    # Update Tip transform (for volume reslicing)
-    # Note Tip transform must be further transformed with the registration transform.
     if self.tipTransformNode == None:
       self.tipTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode')
       self.tipTransformNode.SetName(curveNode.GetName() + '-TipTransform')
-      
+
+    ## The 'curve end point matrix' (normal vectors + the curve end position)
+    matrix = vtk.vtkMatrix4x4()
     matrix.SetElement(0, 3, pe[0])
     matrix.SetElement(1, 3, pe[1])
     matrix.SetElement(2, 3, pe[2])
     self.tipTransformNode.SetMatrixTransformToParent(matrix)
-    
-    return (True, pe)
 
 
   def transformCoilPositions(self, curveNode, coilPoints):
     # Calculate the transformed coil positions and orientations.
     # Takes self.coilPoints as an input, and store the results in self.coilTransformArray.
     # This function takes account of both registration transform and the interpolated catheter path.
-    # It applies the registration transform, and then find the closest point on the interpolated catheter path.
-    
+    # The coil frames are obtained from the interpolated catheter path (self.curve).
+
     nCoils = coilPoints.GetNumberOfPoints()
-    
+
     if len(self.coilTransformArray) != nCoils:
       self.coilTransformArray = []
       for i in range(nCoils):
         trans = vtk.vtkTransform()
         self.coilTransformArray.append(trans)
 
-    p = [0.0]*3
-    for i in range(0, nCoils):
-      coilPoints.GetPoint(i, p)
-      cpi = curveNode.GetClosestCurvePointIndexToPositionWorld(p)
-      if cpi >= 0:
-        matrix = vtk.vtkMatrix4x4()
-        curveNode.GetCurvePointToWorldTransformAtPointIndex(cpi, matrix)
-        self.coilTransformArray[i].SetMatrix(matrix)
+    nFrames = min(nCoils, self.coilFramesNP.shape[0])
+    for i in range(0, nFrames):
+      matrix = vtk.vtkMatrix4x4()
+      slicer.util.updateVTKMatrixFromArray(matrix, self.coilFramesNP[i])
+      self.coilTransformArray[i].SetMatrix(matrix)
 
 
   def updateCatheter(self):
@@ -850,35 +1053,119 @@ class Catheter:
       curveDisplayNode.OutlineVisibilityOff()
       curveDisplayNode.EndModify(prevState)
 
-    self.updateCoilModel(self.coilTransformArray, self.radius*1.5, [0.7, 0.7, 0.7], self.opacity)
+    (sheathIndex0, sheathIndex1) = self.getSheathCurvePointIndices()
+
+    if self.renderingMode == 'mesh':
+      self.setModelVisibility(self.coilModelNodeID, False)
+      self.setModelVisibility(self.coilGlyphModelNodeID, False)
+      if self.sheathModelNode:
+        self.setModelVisibility(self.sheathModelNode.GetID(), False)
+      self.updateTubeModel(sheathIndex0, sheathIndex1)
+      return
+
+    self.setModelVisibility(self.tubeModelNodeID, False)
+    if self.renderingMode == 'glyph':
+      self.setModelVisibility(self.coilModelNodeID, False)
+      self.updateCoilGlyphModel(self.radius*1.5, [0.7, 0.7, 0.7], self.opacity)
+    else:
+      self.setModelVisibility(self.coilGlyphModelNodeID, False)
+      self.updateCoilModel(self.coilTransformArray, self.radius*1.5, [0.7, 0.7, 0.7], self.opacity)
 
     # Draw Sheath
+    if (sheathIndex0 >= 0):
+      sheathPointsNP = self.curvePointsWorldNP[sheathIndex0:sheathIndex1+1]
+      curvePoints = vtk.vtkPoints()
+      curvePoints.SetData(numpy_support.numpy_to_vtk(sheathPointsNP, deep=True))
+
+      self.updateSheathModelNode(curvePoints, self.radius*1.3, [0.4, 0.4, 0.4], self.opacity)
+
+
+  def getSheathCurvePointIndices(self):
+    # Return the range of the curve point indices covered by the sheath. (-1, -1) if the sheath
+    # is not specified.
+
     sheathIndex0 = -1
     sheathIndex1 = -1
-    nCoils = self.coilPoints.GetNumberOfPoints()
+    nCoils = len(self.coilCurvePointIndices)
     if (self.sheathRange[0] >= 0) and (self.sheathRange[1] >= 0) and (self.sheathRange[0] <= self.sheathRange[1]) and (self.sheathRange[1] < nCoils):
-      p0 = [0.0]*3
-      p1 = [0.0]*3
-      self.coilPoints.GetPoint(self.sheathRange[0], p0)
-      self.coilPoints.GetPoint(self.sheathRange[1], p1)
-      sheathIndex0 = curveNode.GetClosestCurvePointIndexToPositionWorld(p0)
-      sheathIndex1 = curveNode.GetClosestCurvePointIndexToPositionWorld(p1)
+      sheathIndex0 = self.coilCurvePointIndices[self.sheathRange[0]]
+      sheathIndex1 = self.coilCurvePointIndices[self.sheathRange[1]]
+      if sheathIndex0 > sheathIndex1:
+        (sheathIndex0, sheathIndex1) = (sheathIndex1, sheathIndex0)
+
+    return (sheathIndex0, sheathIndex1)
 
-    if (sheathIndex0 >= 0):
-      curvePoints = vtk.vtkPoints()
-      curvePoints.SetNumberOfPoints(sheathIndex1-sheathIndex0+1)
-      p = [0.0]*3
-      idx = 0
-      matrix = vtk.vtkMatrix4x4()
-      for i in range(sheathIndex0, sheathIndex1+1):
-        curveNode.GetCurvePointToWorldTransformAtPointIndex(i, matrix)
-        p[0] = matrix.GetElement(0, 3)
-        p[1] = matrix.GetElement(1, 3)
-        p[2] = matrix.GetElement(2, 3)
-        curvePoints.SetPoint(idx, p)
-        idx = idx+1
-      
-      self.updateSheathModelNode(curvePoints, self.radius*1.3, [0.4, 0.4, 0.4], self.opacity)
+
+  def setModelVisibility(self, modelNodeID, visible):
+
+    if modelNodeID == None or modelNodeID == '':
+      return
+    modelNode = slicer.mrmlScene.GetNodeByID(modelNodeID)
+    if modelNode and modelNode.GetDisplayNode():
+      modelNode.GetDisplayNode().SetVisibility(visible)
+
+
+  def updateTubeModel(self, sheathIndex0, sheathIndex1):
+    # Draw the shaft, the sheath and the coils as a single model. The geometry is computed from
+    # the curve points and frames in self.curve, and written to the points of the existing poly data.
+
+    curveNode = None
+    if self.curveNodeID:
+      curveNode = slicer.mrmlScene.GetNodeByID(self.curveNodeID)
+
+    if curveNode == None:
+      print('Catheter.updateTubeModel(): No cathterNode is found.')
+      return
+
+    if self.curve.points.shape[0] == 0:
+      return
+
+    tubeModelNode = None
+    if self.tubeModelNodeID != '':
+      tubeModelNode = slicer.mrmlScene.GetNodeByID(self.tubeModelNodeID)
+
+    if self.tubeModel == None:
+      self.tubeModel = CatheterTubeModel()
+
+    if tubeModelNode == None:
+      tubeModelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
+      tubeModelNode.SetName(curveNode.GetName() + '-Tube')
+      tubeModelNode.SetAndObservePolyData(self.tubeModel.getPolyData())
+      self.tubeModelNodeID = tubeModelNode.GetID()
+
+    parts = []
+    parts.append({'centers': self.curve.points, 'frames': self.curve.frames,
+                  'radius': self.radius, 'color': self.modelColor, 'capped': False})
+
+    if sheathIndex0 >= 0:
+      parts.append({'centers': self.curve.points[sheathIndex0:sheathIndex1+1],
+                    'frames': self.curve.frames[sheathIndex0:sheathIndex1+1],
+                    'radius': self.radius*1.3, 'color': [0.4, 0.4, 0.4], 'capped': True})
+
+    # Each coil band is a short tube between the two ends of the coil.
+    halfLength = numpy.array([-0.5, 0.5]) * self.coilLength
+    for frame in self.coilFramesNP:
+      parts.append({'centers': frame[0:3,3] + halfLength[:,None] * frame[0:3,2],
+                    'frames': numpy.array([frame, frame]),
+                    'radius': self.radius*1.5, 'color': [0.7, 0.7, 0.7], 'capped': True})
+
+    self.tubeModel.update(parts)
+
+    tubeDispNode = tubeModelNode.GetDisplayNode()
+    if tubeDispNode == None:
+      tubeDispNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelDisplayNode')
+      tubeDispNode.SetScene(slicer.mrmlScene)
+      tubeModelNode.SetAndObserveDisplayNodeID(tubeDispNode.GetID())
+
+    prevState = tubeDispNode.StartModify()
+    tubeDispNode.SetVisibility(True)
+    tubeDispNode.SetOpacity(self.opacity)
+    tubeDispNode.SetActiveScalarName('Colors')
+    tubeDispNode.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseDirectMapping)
+    tubeDispNode.SetScalarVisibility(True)
+    tubeDispNode.Visibility2DOn()
+    tubeDispNode.SetSliceDisplayModeToIntersection()
+    tubeDispNode.EndModify(prevState)
 
 
   def updateCoilModel(self, transArray, radius, color, opacity):
@@ -961,6 +1248,7 @@ class Catheter:
     coilDispNode = slicer.mrmlScene.GetNodeByID(coilDispID)
 
     prevState = coilDispNode.StartModify()
+    coilDispNode.SetVisibility(True)
     coilDispNode.SetColor(color)
     coilDispNode.SetOpacity(opacity)
     coilDispNode.Visibility2DOn()
@@ -968,6 +1256,49 @@ class Catheter:
     coilDispNode.EndModify(prevState)
       
     
+  def updateCoilGlyphModel(self, radius, color, opacity):
+    # Draw the coils as glyphs. The positions and the directions of the coils are taken from
+    # the coil frames (self.coilFramesNP); the z-axis of each frame is the coil axis.
+
+    curveNode = None
+    if self.curveNodeID:
+      curveNode = slicer.mrmlScene.GetNodeByID(self.curveNodeID)
+
+    if curveNode == None:
+      print('Catheter.updateCoilGlyphModel(): No cathterNode is found.')
+      return
+
+    if self.coilGlyphModel == None:
+      self.coilGlyphModel = CatheterCoilGlyphModel()
+
+    coilGlyphModelNode = None
+    if self.coilGlyphModelNodeID != '':
+      coilGlyphModelNode = slicer.mrmlScene.GetNodeByID(self.coilGlyphModelNodeID)
+
+    if coilGlyphModelNode == None:
+      coilGlyphModelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
+      coilGlyphModelNode.SetName(curveNode.GetName() + '-CoilGlyph')
+      coilGlyphModelNode.SetPolyDataConnection(self.coilGlyphModel.getOutputPort())
+      self.coilGlyphModelNodeID = coilGlyphModelNode.GetID()
+
+    self.coilGlyphModel.setGeometry(radius, self.coilLength)
+    self.coilGlyphModel.update(self.coilFramesNP[:,0:3,3], self.coilFramesNP[:,0:3,2])
+
+    coilDispNode = coilGlyphModelNode.GetDisplayNode()
+    if coilDispNode == None:
+      coilDispNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelDisplayNode')
+      coilDispNode.SetScene(slicer.mrmlScene)
+      coilGlyphModelNode.SetAndObserveDisplayNodeID(coilDispNode.GetID())
+
+    prevState = coilDispNode.StartModify()
+    coilDispNode.SetVisibility(True)
+    coilDispNode.SetColor(color)
+    coilDispNode.SetOpacity(opacity)
+    coilDispNode.Visibility2DOn()
+    coilDispNode.SetSliceDisplayModeToIntersection()
+    coilDispNode.EndModify(prevState)
+
+
   def updateSheathModelNode(self, points, radius, color, opacity):
 
     curveNode = None
@@ -1023,6 +1354,7 @@ class Catheter:
     sheathDispNode = slicer.mrmlScene.GetNodeByID(sheathDispID)
 
     prevState = sheathDispNode.StartModify()
+    sheathDispNode.SetVisibility(True)
     sheathDispNode.SetColor(color)
     sheathDispNode.SetOpacity(opacity)
     sheathDispNode.Visibility2DOn()
@@ -1042,16 +1374,21 @@ class Catheter:
     egramTableNP = egram[1]
     
     nPoints = len(recordingPoints)
-    for i in range(nPoints):
-      egramValues = egramTableNP[i]
-      point = recordingPoints[i]
-      #id = prMarkupsNode.AddFiducial(egramPoint[0], egramPoint[1], egramPoint[2])
-      id = prMarkupsNode.AddFiducial(point[0], point[1], point[2])
-
-      # Concatinate the values in egramTablesNP[i] as a string
-      # See https://stackoverflow.com/questions/2721521/fastest-way-to-generate-delimited-string-from-1d-numpy-array
-      desc = ','.join(numpy.char.mod('%f', egramValues))
-      prMarkupsNode.SetNthControlPointDescription(id, desc)
+    if self.pointRecordingFilter.isEnabled():
+      # Keep one point per voxel. The existing points are updated in place.
+      self.pointRecordingFilter.record(prMarkupsNode, recordingPoints, egramTableNP, egramHeader)
+    else:
+      ids = numpy.zeros(nPoints, dtype=int)
+      for i in range(nPoints):
+        point = recordingPoints[i]
+        #id = prMarkupsNode.AddFiducial(egramPoint[0], egramPoint[1], egramPoint[2])
+        ids[i] = prMarkupsNode.AddFiducial(point[0], point[1], point[2])
+
+      # The egram parameters are stored in the egram table as numeric columns (see egramtable.py)
+      egramTableNP = numpy.asarray(egramTableNP, dtype=float)
+      nRows = min(nPoints, egramTableNP.shape[0])
+      if egramHeader and nRows > 0 and egramTableNP.ndim == 2:
+        getEgramTable(prMarkupsNode).setValues(ids[:nRows], egramTableNP[:nRows], list(egramHeader))
 
     # If the header is not registered to the markup node, do it now.
     ev = prMarkupsNode.GetAttribute('MRTracking.EgramParamList')
@@ -1065,6 +1402,15 @@ class Catheter:
       prMarkupsNode.SetAttribute('MRTracking.EgramParamList', attr)
       prMarkupsNode.Modified();
 
+    # Append the new points to the point cloud, if it is displayed. The points updated in place by
+    # the voxel filter are copied individually.
+    cloud = recordedPointClouds.get(prMarkupsNode.GetID())
+    if cloud and cloud.isVisible():
+      modifiedIds = None
+      if self.pointRecordingFilter.isEnabled():
+        modifiedIds = self.pointRecordingFilter.modifiedIds
+      cloud.update(modifiedIds=modifiedIds)
+
 
     
   #--------------------------------------------------
@@ -1171,6 +1517,16 @@ class Catheter:
     return 1
       
 
+  def setRenderingMode(self, mode):
+    # mode: 'filter', 'mesh' or 'glyph'
+
+    self.renderingMode = mode
+    if self.logic:
+      self.logic.getParameterNode().SetParameter("TD.%s.renderingMode" % self.name, str(self.renderingMode))
+      return 1
+    return 0
+
+
   def setCutOffFrequency(self, freq):
 
     self.cutOffFrequency = freq
@@ -1297,29 +1653,27 @@ class Catheter:
     if curveNode == None:
       return r
     
-    curvePoly = curveNode.GetCurve()
-    locator = vtk.vtkPointLocator()
-    locator.SetDataSet(curvePoly)
-    locator.BuildLocator()
-    
-    nPoints = len(self.coilPointsNP)
-    #curvePointsWorld = curveNode.GetCurvePointsWorld() # This does not work in Slicer 5.x
-    curvePointsWorld = vtk.vtkPoints()
-    curveNode.GetControlPointPositionsWorld(curvePointsWorld)
+    # The coil-to-curve mapping (coilCurvePointIndices) is computed by CatheterCurve.update(), which is
+    # called from updateCatheterNode() every time the curve is updated.
+    nPoints = min(len(self.coilPointsNP), len(self.coilCurvePointIndices))
 
-    
     for s in range(nPoints):
-      pos = [0.0]*3
-      cp = self.coilPointsNP[s]
-      pid = locator.FindClosestPoint(cp)
-      curvePointsWorld.GetPoint(pid, pos)
+      pos = self.curvePointsWorldNP[self.coilCurvePointIndices[s]].tolist()
       r.append(pos)
 
     return r
       
   
 
-  def getInterpolatedFiducialPoints(self, distFromTip, world=False):
+  def getActiveCoilDistances(self):
+    # Nominal distances of the active coils from the tip.
+
+    cpos = numpy.array(self.coilPositions, dtype=float)
+    cpos.resize(self.MAX_COILS)
+    return cpos[numpy.array(self.activeCoils, dtype=bool)]   # Remove inactive coils
+
+
+  def getInterpolatedFiducialPoints(self, distFromTip):
     #
     #   (posList, mask) = getInterpolatedFiducialPoints(distFromTip)
     #
@@ -1327,15 +1681,16 @@ class Catheter:
     #   distFromTip : An array of distances between the catheter tip and points on the catheter.
     #
     # Output:
-    #   posList    : An array of positions
-    #   mask        : A list of booleans representing whether the positions in the array are valid.
+    #   posList    : An (n, 3) array of positions
+    #   mask       : A boolean array representing whether the positions in the array are valid.
     #
     # Estimate the coordinates of the given point on the catheter by interpolation.
     # Unlike getFiducialPoints(), getInterpolatedFiducialPoints() can be used to
     # calculate intermediate points between the tracking sensors.
     # The reason to have the mask is that the coordinates of the points cannot be computed by interpolation,
     # if, for example, the point given by 'distFromTip' is not in between two coils.
-    # When 'world'=True, the posList are in the world coordinate system
+    # All the points are computed at once from the length along the interpolated curve (CatheterCurve.arcLength).
+    # The positions are always in the world coordinate system.
     #
 
     if self.curveNodeID == None:
@@ -1344,88 +1699,27 @@ class Catheter:
     curveNode = slicer.mrmlScene.GetNodeByID(self.curveNodeID)
     if curveNode == None:
       return (None, None)
-    
-    numpy.array([0.0, 0.0, 0.0])
-    cpos = numpy.array(self.coilPositions)
-    cpos.resize(8)
-    cpos = cpos[self.activeCoils]   # Remove inactive coils
-    
-    interval = cpos[1:] - cpos[:-1]
-    trans = vtk.vtkMatrix4x4()
-
-    mask = []
-    posList = []
-    #upperIndexLimit = curveNode.GetNumberOfControlPoints() - 2
-    upperIndexLimit = len(self.coilPointsNP) - 2
 
     # TODO: The curve length is measured in the transformed space - this may cause an issue when
     #   the registration transform is not rigid.
+    cpos = self.getActiveCoilDistances()[:len(self.coilPointsNP)]
+    return self.curve.getPointsAtCoilDistances(cpos, distFromTip)
 
-    curvePoly = curveNode.GetCurve()
-    curvePoints = None
-    if world:
-      #curvePoints = curveNode.GetCurvePointsWorld() # This does not work on Slicer 5.x
-      curvePoints = vtk.vtkPoints()
-      curveNode.GetControlPointPositionsWorld(curvePoints)
-    else:
-      #curvePoints = curveNode.GetCurvePoints() # This does not work on Slicer 5.x
-      #TODO: The following obtains points in the world coordinates. Does it work??
-      curvePoints = vtk.vtkPoints()
-      curveNode.GetControlPointPositionsWorld(curvePoints)
-    
-    locator = vtk.vtkPointLocator()
-    locator.SetDataSet(curvePoly)
-    locator.BuildLocator()
-    
-    for d in distFromTip:
-      pos = [0.0]*3
-
-      # The following gives the index of the lower end of the segment that includes 'd':
-      #
-      #  Example: If cpos and d have the following values:
-      #       cpos = [10.0, 15.0, 20.0, 25.0, 30.0]
-      #       d = 23.0
-      #  The segment that includes 'd' is [20.0, 25.0], and the lower end is 20.0 (cpos[2]).
-      #  's' can be computed as sum([True, True, True, False, False]) - 1 = 2.
-      #
-
-      s = numpy.sum(d >= cpos) - 1
-
-      # Out of range
-      if s < 0 or s > upperIndexLimit:
-        posList.append(pos)
-        mask.append(False)
-        continue
-
-      # Find the coil point on the curve
-      cp = self.coilPointsNP[s]
-      p0 = locator.FindClosestPoint(cp)
-      cp = self.coilPointsNP[s+1]
-      p1 = locator.FindClosestPoint(cp)
-      #p0 = curveNode.GetCurvePointIndexFromControlPointIndex(s)
-      #p1 = curveNode.GetCurvePointIndexFromControlPointIndex(s+1)
-      clen = curveNode.GetCurveLengthBetweenStartEndPointsWorld(p0, p1)
-      a = d - cpos[s]
-
-      # In the following code, make sure that 'd' is less than the last element of 'cpos' to perform
-      # interpolation.
-      # TODO: if 'd' is greater than the last element of 'cpos', extrapolate the curve.
-      if s < len(interval):
-        b = interval[s]
-        pindexm =  curveNode.GetCurvePointIndexAlongCurveWorld(p0, clen * a / b)
-        if pindexm >= 0:
-          #curveNode.GetCurvePointToWorldTransformAtPointIndex(pindexm, trans)
-          curvePoints.GetPoint(pindexm, pos)
-          #pos[0] = trans.GetElement(0, 3)
-          #pos[1] = trans.GetElement(1, 3)
-          #pos[2] = trans.GetElement(2, 3)
-          posList.append(pos)
-          mask.append(True)
-        else:
-          posList.append(pos)
-          mask.append(False)
 
-    return (posList, mask)
+  def getInterpolatedFiducialPointsFromCoils(self, coilPointsNP, distFromTip):
+    #
+    # Same as getInterpolatedFiducialPoints(), but the points are interpolated along the curve
+    # through the given coil positions ((n, 3) array; e.g., a sample in the tracking history)
+    # instead of the current curve. The coil positions are used as they are; no registration
+    # transform is applied.
+    #
+
+    coilPointsNP = numpy.asarray(coilPointsNP, dtype=float).reshape(-1,3)
+    if not self.pairingCurve.update(coilPointsNP):
+      return (None, None)
+
+    cpos = self.getActiveCoilDistances()[:coilPointsNP.shape[0]]
+    return self.pairingCurve.getPointsAtCoilDistances(cpos, distFromTip)
   
     
   #--------------------------------------------------
@@ -172,6 +172,29 @@ class MRTrackingCatheterConfig(MRTrackingPanelBase):
     self.sheathRangeLineEdit.frame = True
     configFormLayout.addRow('Sheath Coils (e.g., "0-3"): ', self.sheathRangeLineEdit)
 
+    #
+    # Rendering mode
+    #
+    self.renderingFilterRadioButton = qt.QRadioButton("Filter")
+    self.renderingFilterRadioButton.checked = 1
+    self.renderingFilterRadioButton.setToolTip("Draw the coils and the sheath as separate models generated by VTK filters.")
+    self.renderingMeshRadioButton = qt.QRadioButton("Mesh")
+    self.renderingMeshRadioButton.checked = 0
+    self.renderingMeshRadioButton.setToolTip("Draw the shaft, the sheath and the coils as one model with a fixed topology.")
+    self.renderingGlyphRadioButton = qt.QRadioButton("Glyph")
+    self.renderingGlyphRadioButton.checked = 0
+    self.renderingGlyphRadioButton.setToolTip("Draw the coils as glyphs placed by per-coil position and direction arrays.")
+    self.renderingButtonGroup = qt.QButtonGroup()
+    self.renderingButtonGroup.addButton(self.renderingFilterRadioButton)
+    self.renderingButtonGroup.addButton(self.renderingMeshRadioButton)
+    self.renderingButtonGroup.addButton(self.renderingGlyphRadioButton)
+
+    renderingGroupLayout = qt.QHBoxLayout()
+    renderingGroupLayout.addWidget(self.renderingFilterRadioButton)
+    renderingGroupLayout.addWidget(self.renderingMeshRadioButton)
+    renderingGroupLayout.addWidget(self.renderingGlyphRadioButton)
+    configFormLayout.addRow("Rendering:", renderingGroupLayout)
+
     
     #--------------------------------------------------
     # Coordinate System
@@ -316,6 +339,9 @@ class MRTrackingCatheterConfig(MRTrackingPanelBase):
     self.catheterOpacitySliderWidget.connect("valueChanged(double)", self.onCatheterOpacityChanged)
     self.colorButton.connect('clicked(bool)', self.onColorButtonClicked)
     self.showCoilLabelCheckBox.connect('clicked(bool)', self.onCoilLabelChecked)
+    self.renderingFilterRadioButton.connect('clicked(bool)', self.onRenderingModeChanged)
+    self.renderingMeshRadioButton.connect('clicked(bool)', self.onRenderingModeChanged)
+    self.renderingGlyphRadioButton.connect('clicked(bool)', self.onRenderingModeChanged)
 
     for ch in range(self.nChannel):
       self.coilCheckBox[ch].connect('clicked(bool)', self.onCoilChecked)
@@ -390,6 +416,13 @@ class MRTrackingCatheterConfig(MRTrackingPanelBase):
       
     self.showCoilLabelCheckBox.checked = td.showCoilLabel
 
+    if td.renderingMode == 'mesh':
+      self.renderingMeshRadioButton.checked = 1
+    elif td.renderingMode == 'glyph':
+      self.renderingGlyphRadioButton.checked = 1
+    else:
+      self.renderingFilterRadioButton.checked = 1
+
     # Coordinate System
     if td.axisDirections[0] > 0.0:
       self.coordinateRPlusRadioButton.checked = 1
@@ -518,6 +551,15 @@ class MRTrackingCatheterConfig(MRTrackingPanelBase):
   def onCoilLabelChecked(self):
     self.setShowCoilLabel(self.showCoilLabelCheckBox.checked)
 
+
+  def onRenderingModeChanged(self):
+    if self.renderingMeshRadioButton.checked:
+      self.setRenderingMode('mesh')
+    elif self.renderingGlyphRadioButton.checked:
+      self.setRenderingMode('glyph')
+    else:
+      self.setRenderingMode('filter')
+
       
   def onCoilChecked(self):
 
@@ -691,6 +733,14 @@ class MRTrackingCatheterConfig(MRTrackingPanelBase):
       #td.showCoilLabel = show
       td.setShowCoilLabel(show)
       td.updateCatheter()
+
+
+  def setRenderingMode(self, mode):
+    td = self.currentCatheter
+    if td:
+      td.setRenderingMode(mode)
+      td.updateCatheter()
+
         
   def setSheathRange(self, ch0, ch1):
     td = self.currentCatheter
@@ -821,6 +871,11 @@ class MRTrackingCatheterConfig(MRTrackingPanelBase):
     if setting != None:
       td.modelColor = [float(s) for s in setting]
 
+    # Rendering mode
+    setting = settings.value(self.moduleName + '/' + 'RenderingMode.' + cathName)
+    if setting != None:
+      td.renderingMode = str(setting)
+
     # Egram
     setting = settings.value(self.moduleName + '/' + 'EgramDataNode.' + cathName)
     if setting != '':
@@ -877,6 +932,7 @@ class MRTrackingCatheterConfig(MRTrackingPanelBase):
     settings.setValue(self.moduleName + '/' + 'Opacity.' + cathName, td.opacity)
     settings.setValue(self.moduleName + '/' + 'Radius.' + cathName, td.radius)
     settings.setValue(self.moduleName + '/' + 'ModelColor.' + cathName, td.modelColor)
+    settings.setValue(self.moduleName + '/' + 'RenderingMode.' + cathName, td.renderingMode)
     if saveEgram:
       enode = slicer.mrmlScene.GetNodeByID(td.egramDataNodeID)
       if enode:
@@ -911,6 +967,7 @@ class MRTrackingCatheterConfig(MRTrackingPanelBase):
     settings.remove(self.moduleName + '/' + 'Opacity.' + cathName)
     settings.remove(self.moduleName + '/' + 'Radius.' + cathName)
     settings.remove(self.moduleName + '/' + 'ModelColor.' + cathName)
+    settings.remove(self.moduleName + '/' + 'RenderingMode.' + cathName)
     settings.remove(self.moduleName + '/' + 'EgramDataNode.' + cathName)
       
     
@@ -0,0 +1,278 @@
+#------------------------------------------------------------
+#
+# Catheter models
+#
+
+#
+# The classes in this file generate polygon models to visualize a catheter from the interpolated
+# catheter path (see CatheterCurve in catheter.py). Unlike the filter-based models in the Catheter
+# class (vtkCylinderSource/vtkTubeFilter), the topology of the models is fixed as long as
+# the numbers of the curve points and coils do not change; only the coordinates are overwritten
+# in each frame.
+#
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+
+class CatheterTubeModel:
+
+  # CatheterTubeModel keeps one vtkPolyData that contains the shaft, the sheath, and the coil bands
+  # of a catheter. Each part is a tube defined by a list of centers and the local frames at the centers.
+  # The parts are given to update() as a list of dictionaries with the following keys:
+  #
+  #   'centers'  : (k, 3) array of the centers of the tube
+  #   'frames'   : (k, 4, 4) array of the local frames at the centers (z-axis is the tangent)
+  #   'radius'   : radius of the tube
+  #   'color'    : RGB color (0.0-1.0)
+  #   'capped'   : True to close the both ends of the tube
+  #
+  # The point/cell topology is rebuilt only when the numbers of parts or centers change. Otherwise,
+  # update() only overwrites the point and normal arrays computed in NumPy, and calls Modified() on
+  # the poly data.
+
+  def __init__(self, nSides=20):
+
+    self.nSides = nSides
+    theta = numpy.linspace(0.0, 2.0*numpy.pi, nSides, endpoint=False)
+    self.cosTheta = numpy.cos(theta)
+    self.sinTheta = numpy.sin(theta)
+
+    self.polyData = vtk.vtkPolyData()
+    self.topologyKey = None
+    self.colorKey = None
+
+    self.pointArray = None
+    self.normalArray = None
+    self.colorArray = None
+    self.pointsNP = None      # NumPy views of the VTK arrays above
+    self.normalsNP = None
+    self.colorsNP = None
+
+
+  def getPolyData(self):
+
+    return self.polyData
+
+
+  def getNumberOfPartPoints(self, nCenters, capped):
+
+    n = nCenters * self.nSides
+    if capped:
+      n = n + 2 * (self.nSides + 1)
+    return n
+
+
+  def buildTopology(self, parts):
+    #
+    # Build the points and cells for the given parts. The points of each part are organized as:
+    #
+    #   [ring 0 (nSides points)] [ring 1] ... [ring k-1] ([cap 0 center] [cap 0 ring] [cap 1 center] [cap 1 ring])
+    #
+    # The side of the tube consists of quads between the adjacent rings. The caps are triangle fans.
+    #
+
+    nSides = self.nSides
+    nTotalPoints = 0
+    cellList = []
+    j = numpy.arange(nSides)
+    jn = (j + 1) % nSides
+
+    for part in parts:
+      nCenters = part['centers'].shape[0]
+      offset = nTotalPoints
+
+      if nCenters >= 2:
+        ring = offset + numpy.arange(nCenters-1)[:,None] * nSides
+        quads = numpy.empty((nCenters-1, nSides, 5), dtype=numpy.int64)
+        quads[:,:,0] = 4
+        quads[:,:,1] = ring + j
+        quads[:,:,2] = ring + jn
+        quads[:,:,3] = ring + nSides + jn
+        quads[:,:,4] = ring + nSides + j
+        cellList.append(quads.reshape(-1))
+
+      if part['capped'] and nCenters > 0:
+        for c in range(2):
+          center = offset + nCenters * nSides + c * (nSides + 1)
+          tris = numpy.empty((nSides, 4), dtype=numpy.int64)
+          tris[:,0] = 3
+          tris[:,1] = center
+          if c == 0:
+            tris[:,2] = center + 1 + jn
+            tris[:,3] = center + 1 + j
+          else:
+            tris[:,2] = center + 1 + j
+            tris[:,3] = center + 1 + jn
+          cellList.append(tris.reshape(-1))
+
+      nTotalPoints = nTotalPoints + self.getNumberOfPartPoints(nCenters, part['capped'])
+
+    nCells = 0
+    cellArrayNP = numpy.zeros(0, dtype=numpy.int64)
+    if len(cellList) > 0:
+      cellArrayNP = numpy.concatenate(cellList)
+      nCells = sum([int(len(c) / (c[0] + 1)) for c in cellList])
+
+    cells = vtk.vtkCellArray()
+    cells.SetCells(nCells, numpy_support.numpy_to_vtkIdTypeArray(cellArrayNP, deep=True))
+
+    self.pointArray = numpy_support.numpy_to_vtk(numpy.zeros((nTotalPoints, 3)), deep=True)
+    self.normalArray = numpy_support.numpy_to_vtk(numpy.zeros((nTotalPoints, 3)), deep=True)
+    self.normalArray.SetName('Normals')
+    self.colorArray = numpy_support.numpy_to_vtk(numpy.zeros((nTotalPoints, 3), dtype=numpy.uint8), deep=True)
+    self.colorArray.SetName('Colors')
+
+    self.pointsNP = numpy_support.vtk_to_numpy(self.pointArray)
+    self.normalsNP = numpy_support.vtk_to_numpy(self.normalArray)
+    self.colorsNP = numpy_support.vtk_to_numpy(self.colorArray)
+
+    points = vtk.vtkPoints()
+    points.SetData(self.pointArray)
+
+    self.polyData.Initialize()
+    self.polyData.SetPoints(points)
+    self.polyData.SetPolys(cells)
+    self.polyData.GetPointData().SetNormals(self.normalArray)
+    self.polyData.GetPointData().AddArray(self.colorArray)
+    self.polyData.GetPointData().SetActiveScalars('Colors')
+
+    self.colorKey = None
+
+
+  def update(self, parts):
+
+    topologyKey = tuple([(part['centers'].shape[0], bool(part['capped'])) for part in parts])
+    if topologyKey != self.topologyKey:
+      self.buildTopology(parts)
+      self.topologyKey = topologyKey
+
+    colorKey = tuple([tuple(part['color']) for part in parts])
+    fColor = (colorKey != self.colorKey)
+
+    nSides = self.nSides
+    offset = 0
+    for part in parts:
+      centers = part['centers']
+      frames = part['frames']
+      nCenters = centers.shape[0]
+      nPoints = self.getNumberOfPartPoints(nCenters, part['capped'])
+      if nCenters == 0:
+        continue
+
+      # Radial unit vectors for all rings: (nCenters, nSides, 3)
+      radial = self.cosTheta[None,:,None] * frames[:,None,0:3,0] + self.sinTheta[None,:,None] * frames[:,None,0:3,1]
+      rings = centers[:,None,:] + part['radius'] * radial
+
+      nRingPoints = nCenters * nSides
+      self.pointsNP[offset:offset+nRingPoints] = rings.reshape(-1,3)
+      self.normalsNP[offset:offset+nRingPoints] = radial.reshape(-1,3)
+
+      if part['capped']:
+        capOffset = offset + nRingPoints
+        for (c, i, sign) in [(0, 0, -1.0), (1, nCenters-1, 1.0)]:
+          o = capOffset + c * (nSides + 1)
+          self.pointsNP[o] = centers[i]
+          self.pointsNP[o+1:o+1+nSides] = rings[i]
+          self.normalsNP[o:o+1+nSides] = sign * frames[i,0:3,2]
+
+      if fColor:
+        self.colorsNP[offset:offset+nPoints] = numpy.clip(numpy.array(part['color']) * 255.0, 0, 255).astype(numpy.uint8)
+
+      offset = offset + nPoints
+
+    self.pointArray.Modified()
+    self.normalArray.Modified()
+    if fColor:
+      self.colorArray.Modified()
+      self.colorKey = colorKey
+    self.polyData.Modified()
+
+
+class CatheterCoilGlyphModel:
+
+  # CatheterCoilGlyphModel draws the coils by copying a single cylinder glyph to every coil using
+  # vtkGlyph3D. The input of the glyph filter is a poly data with one point per coil and a 'Direction'
+  # vector array. vtkGlyph3D aligns the x-axis of the glyph with the vector; the cylinder source is
+  # therefore rotated so that its axis is the x-axis. Note that this is not instanced rendering:
+  # vtkGlyph3D generates the geometry of all the coils on the CPU as one poly data, which is passed
+  # to the model node (vtkGlyph3DMapper cannot be used with the model displayable manager). Updating
+  # the coils only requires writing the position and direction arrays and re-executing the filter.
+  # The cylinder source is regenerated only when the radius or the length of the coil is changed.
+
+  def __init__(self, nSides=20):
+
+    self.radius = None
+    self.length = None
+
+    self.cylinder = vtk.vtkCylinderSource()
+    self.cylinder.SetCenter(0.0, 0.0, 0.0)
+    self.cylinder.CappingOn()
+    self.cylinder.SetResolution(nSides)
+
+    # vtkCylinderSource generates a cylinder along the y-axis.
+    trans = vtk.vtkTransform()
+    trans.RotateZ(-90.0)
+    self.cylinderTransformFilter = vtk.vtkTransformPolyDataFilter()
+    self.cylinderTransformFilter.SetInputConnection(self.cylinder.GetOutputPort())
+    self.cylinderTransformFilter.SetTransform(trans)
+
+    self.glyphInput = vtk.vtkPolyData()
+    self.positionArray = None
+    self.directionArray = None
+    self.positionsNP = None    # NumPy views of the VTK arrays above
+    self.directionsNP = None
+    self.allocate(0)
+
+    self.glyph = vtk.vtkGlyph3D()
+    self.glyph.SetInputData(self.glyphInput)
+    self.glyph.SetSourceConnection(self.cylinderTransformFilter.GetOutputPort())
+    self.glyph.SetInputArrayToProcess(1, 0, 0, vtk.vtkDataObject.FIELD_ASSOCIATION_POINTS, 'Direction')
+    self.glyph.SetVectorModeToUseVector()
+    self.glyph.OrientOn()
+    self.glyph.ScalingOff()
+
+
+  def getOutputPort(self):
+
+    return self.glyph.GetOutputPort()
+
+
+  def allocate(self, nCoils):
+
+    self.positionArray = numpy_support.numpy_to_vtk(numpy.zeros((nCoils, 3)), deep=True)
+    self.directionArray = numpy_support.numpy_to_vtk(numpy.zeros((nCoils, 3)), deep=True)
+    self.directionArray.SetName('Direction')
+    self.positionsNP = numpy_support.vtk_to_numpy(self.positionArray)
+    self.directionsNP = numpy_support.vtk_to_numpy(self.directionArray)
+
+    points = vtk.vtkPoints()
+    points.SetData(self.positionArray)
+    self.glyphInput.Initialize()
+    self.glyphInput.SetPoints(points)
+    self.glyphInput.GetPointData().AddArray(self.directionArray)
+
+
+  def setGeometry(self, radius, length):
+
+    if radius == self.radius and length == self.length:
+      return
+    self.radius = radius
+    self.length = length
+    self.cylinder.SetRadius(radius)
+    self.cylinder.SetHeight(length)
+
+
+  def update(self, positions, directions):
+    # 'positions' and 'directions' are (n, 3) arrays of the coil centers and the coil axes.
+
+    nCoils = positions.shape[0]
+    if nCoils != self.positionsNP.shape[0]:
+      self.allocate(nCoils)
+
+    self.positionsNP[:] = positions
+    self.directionsNP[:] = directions
+    self.positionArray.Modified()
+    self.directionArray.Modified()
+    self.glyphInput.Modified()
@@ -0,0 +1,158 @@
+import numpy
+import vtk
+import slicer
+
+#------------------------------------------------------------
+#
+# CombinedTracking class
+#
+
+class CombinedTracking():
+
+  # CombinedTracking merges the coils of two catheters (e.g., MR tracking and NavX) into a single
+  # tracking data bundle node, so that they can be visualized as one catheter. The coils are
+  # ordered by the distance from the tip. The positions of the coils on the catheter with the newer
+  # tracking data are used as they are, and the positions of the coils on the other catheter are
+  # interpolated along the curve of the newer catheter.
+  #
+  # update() is called every time either catheter receives new tracking data. All the child transforms
+  # of the bundle node are written before any of them invokes its modified event. Each child transform
+  # still invokes one modified event, but the first one, which the catheter visualizing the combined
+  # data observes, is invoked last.
+
+  def __init__(self):
+
+    self.fromCatheter = None
+    self.toCatheter = None
+    self.trackingDataNodeID = None
+    self.matrices = []           # vtkMatrix4x4 for each child transform (reused)
+    self.lastIndex = -1
+    self.prevTimeStamps = None   # (from, to) time stamps of the last update
+
+
+  def setCatheters(self, fromCatheter, toCatheter):
+
+    self.fromCatheter = fromCatheter
+    self.toCatheter = toCatheter
+    self.prevTimeStamps = None
+
+
+  def setTrackingDataNode(self, node):
+
+    if node:
+      self.trackingDataNodeID = node.GetID()
+    else:
+      self.trackingDataNodeID = None
+    self.lastIndex = -1
+    self.prevTimeStamps = None
+
+
+  def getTrackingDataNode(self):
+
+    if self.trackingDataNodeID == None:
+      return None
+    return slicer.mrmlScene.GetNodeByID(self.trackingDataNodeID)
+
+
+  def initializeTrackingDataNode(self, ctdnode, nCoilsTotal):
+    #
+    # Make sure that the number of transforms under the combined tracking data node is at least
+    # the total number of tracking coils. Note that not all the transforms will be used
+    # because the numbers of valid coils depends the fesibility of interpolation.
+    #
+    # NOTE: vtkMRMLIGTLTrackingDataBundleNode does not have a function to remove the transforms
+    # under the node. If the tracking data node has been previously used for other purposes,
+    # the names of the child transforms might not match.
+    #
+
+    nTransforms = ctdnode.GetNumberOfTransformNodes()
+
+    # We add child node, if the current number of child nodes are less than what we need.
+    # The newly added nodes have a name 'Combined-?' where '?' is an index.
+    if nTransforms < nCoilsTotal:
+      t = vtk.vtkMatrix4x4()
+      t.Identity()
+      for i in range(nTransforms, nCoilsTotal):
+        ctdnode.UpdateTransformNode('Combined-' + str(i), t, 1)
+
+    while len(self.matrices) < nCoilsTotal:
+      self.matrices.append(vtk.vtkMatrix4x4())
+
+
+  def fuse(self):
+    #
+    # Compute the combined coil positions. Returns a tuple (distances, points), where 'distances'
+    # is an (m,) array of the distances from the tip, and 'points' is an (m, 3) array of the coil
+    # positions in the world coordinate system, both sorted by the distance.
+    #
+
+    cathList = [self.fromCatheter, self.toCatheter]
+
+    # Determine which tracking data is newer
+    if self.fromCatheter.lastTS >= self.toCatheter.lastTS:
+      (newer, other) = cathList
+    else:
+      (other, newer) = cathList
+
+    newerPos = newer.getActiveCoilDistances()
+    otherPos = other.getActiveCoilDistances()
+
+    newerPoints = numpy.array(newer.getCoilPointsAlongCurve()).reshape(-1,3)
+    n = min(newerPoints.shape[0], len(newerPos))
+
+    [otherPoints, otherMask] = newer.getInterpolatedFiducialPoints(otherPos)
+    if otherPoints is None:
+      otherPoints = numpy.zeros((0,3))
+      otherMask = numpy.zeros(0, dtype=bool)
+
+    distances = numpy.concatenate((newerPos[:n], otherPos[otherMask]))
+    points = numpy.concatenate((newerPoints[:n], otherPoints[otherMask]), axis=0)
+
+    # Sort the coils by the distance from the tip
+    order = numpy.argsort(distances, kind='stable')
+    return (distances[order], points[order])
+
+
+  def update(self):
+    # Update the combined tracking data node. Returns True if the node has been updated.
+
+    ctdnode = self.getTrackingDataNode()
+    if ctdnode == None or self.fromCatheter == None or self.toCatheter == None:
+      return False
+
+    # Skip if neither catheter has new tracking data
+    timeStamps = (self.fromCatheter.lastTS, self.toCatheter.lastTS)
+    if timeStamps == self.prevTimeStamps:
+      return False
+    self.prevTimeStamps = timeStamps
+
+    (distances, points) = self.fuse()
+    nCoilsTotal = self.fromCatheter.getNumberOfActiveCoils() + self.toCatheter.getNumberOfActiveCoils()
+    self.initializeTrackingDataNode(ctdnode, max(nCoilsTotal, points.shape[0]))
+
+    nPoints = points.shape[0]
+    tnodes = [ctdnode.GetTransformNode(i) for i in range(nPoints)]
+
+    # Write all the transforms before invoking the modified events in EndModify(). StartModify() only
+    # defers the event of each node; it does not merge the events across the nodes. Each node invokes
+    # one modified event, and the first transform is ended last, because it is the only one observed by
+    # the catheter visualizing the combined data (see Catheter.activateTracking()). The catheter is
+    # therefore updated once, after all the positions have been written.
+    wasModifying = [tnode.StartModify() for tnode in tnodes]
+    for i in range(nPoints):
+      matrix = self.matrices[i]
+      matrix.Identity()
+      matrix.SetElement(0, 3, points[i,0])
+      matrix.SetElement(1, 3, points[i,1])
+      matrix.SetElement(2, 3, points[i,2])
+      tnodes[i].SetMatrixTransformToParent(matrix)
+    for i in reversed(range(nPoints)):
+      tnodes[i].EndModify(wasModifying[i])
+
+    # We cannot remove unused child nodes. To prevent the Catheter class to use the child tracking
+    # nodes that are not actively updated, we set the 'MRTracking.lastIndex' attribute.
+    if nPoints - 1 != self.lastIndex:
+      self.lastIndex = nPoints - 1
+      ctdnode.SetAttribute('MRTracking.lastIndex', str(self.lastIndex))
+
+    return True
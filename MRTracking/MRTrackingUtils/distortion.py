@@ -0,0 +1,184 @@
+import numpy
+import vtk
+import slicer
+from vtk.util import numpy_support
+
+#------------------------------------------------------------
+#
+# DistortionGrid class
+#
+
+class DistortionGrid():
+
+  # DistortionGrid keeps a displacement field on a regular grid as NumPy arrays, and corrects
+  # the positions of points by trilinear interpolation of the field:
+  #
+  #   origin       : (x, y, z) position of the first grid point
+  #   spacing      : (x, y, z) spacing of the grid points
+  #   displacement : (nz, ny, nx, 3) array of displacement vectors
+  #
+  # The grid can be built from the residuals of point-based registration, or loaded from a file.
+  # It can also be copied to a vtkMRMLGridTransformNode to visualize it in Slicer.
+
+  def __init__(self):
+
+    self.origin = numpy.zeros(3)
+    self.spacing = numpy.ones(3)
+    self.displacement = numpy.zeros((0,0,0,3))
+
+
+  def isValid(self):
+
+    return min(self.displacement.shape[0:3]) >= 2
+
+
+  def getDimensions(self):
+    # Returns (nx, ny, nz)
+
+    return numpy.array(self.displacement.shape[2::-1])
+
+
+  def setGrid(self, origin, spacing, dimensions):
+    # Allocate a grid with zero displacement. 'dimensions' is (nx, ny, nz).
+
+    self.origin = numpy.array(origin, dtype=float)
+    self.spacing = numpy.array(spacing, dtype=float)
+    self.displacement = numpy.zeros((int(dimensions[2]), int(dimensions[1]), int(dimensions[0]), 3))
+
+
+  def setGridFromBounds(self, pointsMin, pointsMax, spacing, margin):
+    # Allocate a grid that covers the box [pointsMin - margin, pointsMax + margin].
+
+    spacing = numpy.full(3, float(spacing))
+    origin = numpy.asarray(pointsMin, dtype=float) - margin
+    extent = numpy.asarray(pointsMax, dtype=float) + margin - origin
+    dimensions = numpy.maximum(numpy.ceil(extent / spacing).astype(int) + 1, 2)
+    self.setGrid(origin, spacing, dimensions)
+
+
+  def getGridPoints(self):
+    # Returns the positions of the grid points as an (nz, ny, nx, 3) array.
+
+    (nx, ny, nz) = self.getDimensions()
+    (z, y, x) = numpy.meshgrid(numpy.arange(nz), numpy.arange(ny), numpy.arange(nx), indexing='ij')
+    index = numpy.stack((x, y, z), axis=-1)
+    return self.origin + index * self.spacing
+
+
+  def buildFromResiduals(self, points, residuals, spacing=10.0, margin=None, chunkSize=4096):
+    #
+    # Build the grid from scattered displacement vectors 'residuals' ((n, 3) array) observed at
+    # 'points' ((n, 3) array); e.g., (target - registered source) for the registration landmarks.
+    # The displacement at each grid point is the Gaussian-weighted average of the residuals (sigma =
+    # 'spacing'). A constant term in the denominator lets the displacement fall off to zero away
+    # from the observed points.
+    #
+
+    points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+    residuals = numpy.asarray(residuals, dtype=float).reshape(-1, 3)
+    if points.shape[0] == 0:
+      return False
+
+    if margin == None:
+      margin = 2.0 * spacing
+
+    self.setGridFromBounds(numpy.min(points, axis=0), numpy.max(points, axis=0), spacing, margin)
+    gridPoints = self.getGridPoints().reshape(-1, 3)
+    displacement = numpy.zeros(gridPoints.shape)
+    sigma2 = 2.0 * spacing * spacing
+    eps = numpy.exp(-2.0)     # Weight of a point at 2 sigma
+
+    # Process the grid points in chunks to bound the memory used for the (chunk, n) weight matrix.
+    for i in range(0, gridPoints.shape[0], chunkSize):
+      g = gridPoints[i:i+chunkSize]
+      d2 = numpy.sum(numpy.square(g[:,None,:] - points[None,:,:]), axis=2)
+      w = numpy.exp(-d2 / sigma2)
+      displacement[i:i+chunkSize] = (w @ residuals) / (numpy.sum(w, axis=1) + eps)[:,None]
+
+    self.displacement = displacement.reshape(self.displacement.shape)
+    return True
+
+
+  def apply(self, points):
+    #
+    # Correct an (n, 3) array of points by adding the displacement interpolated trilinearly.
+    # Points outside the grid use the displacement at the nearest boundary.
+    #
+
+    points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+    if not self.isValid() or points.shape[0] == 0:
+      return numpy.array(points)
+
+    dims = self.getDimensions()
+    f = numpy.clip((points - self.origin) / self.spacing, 0.0, dims - 1)
+    i0 = numpy.minimum(numpy.floor(f).astype(int), dims - 2)
+    t = f - i0
+
+    (x0, y0, z0) = (i0[:,0], i0[:,1], i0[:,2])
+    (tx, ty, tz) = (t[:,0:1], t[:,1:2], t[:,2:3])
+    D = self.displacement
+
+    c00 = D[z0,   y0,   x0] * (1.0-tx) + D[z0,   y0,   x0+1] * tx
+    c10 = D[z0,   y0+1, x0] * (1.0-tx) + D[z0,   y0+1, x0+1] * tx
+    c01 = D[z0+1, y0,   x0] * (1.0-tx) + D[z0+1, y0,   x0+1] * tx
+    c11 = D[z0+1, y0+1, x0] * (1.0-tx) + D[z0+1, y0+1, x0+1] * tx
+    c0 = c00 * (1.0-ty) + c10 * ty
+    c1 = c01 * (1.0-ty) + c11 * ty
+
+    return points + c0 * (1.0-tz) + c1 * tz
+
+
+  def save(self, filename):
+
+    numpy.savez_compressed(filename, origin=self.origin, spacing=self.spacing, displacement=self.displacement)
+
+
+  def load(self, filename):
+
+    data = numpy.load(filename)
+    self.origin = numpy.array(data['origin'], dtype=float)
+    self.spacing = numpy.array(data['spacing'], dtype=float)
+    self.displacement = numpy.array(data['displacement'], dtype=float)
+    return self.isValid()
+
+
+  def setFromGridTransformNode(self, gridTransformNode):
+    #
+    # Copy the displacement field from a vtkMRMLGridTransformNode (e.g., a grid transform loaded from
+    # a file). The grid is assumed to be aligned with the RAS axes.
+    #
+
+    gridTransform = gridTransformNode.GetTransformToParent()
+    if gridTransform == None or not hasattr(gridTransform, 'GetDisplacementGrid'):
+      return False
+
+    image = gridTransform.GetDisplacementGrid()
+    if image == None:
+      return False
+
+    (nx, ny, nz) = image.GetDimensions()
+    array = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+    self.origin = numpy.array(image.GetOrigin())
+    self.spacing = numpy.array(image.GetSpacing())
+    self.displacement = array.reshape(nz, ny, nx, 3) * gridTransform.GetDisplacementScale() + gridTransform.GetDisplacementShift()
+    return self.isValid()
+
+
+  def updateGridTransformNode(self, gridTransformNode):
+    # Copy the displacement field to a vtkMRMLGridTransformNode for visualization.
+
+    if not self.isValid():
+      return
+
+    (nx, ny, nz) = self.getDimensions()
+    image = vtk.vtkImageData()
+    image.SetOrigin(self.origin)
+    image.SetSpacing(self.spacing)
+    image.SetDimensions(nx, ny, nz)
+    array = numpy_support.numpy_to_vtk(self.displacement.reshape(-1, 3), deep=True)
+    image.GetPointData().SetScalars(array)
+
+    gridTransform = slicer.vtkOrientedGridTransform()
+    gridTransform.SetDisplacementGridData(image)
+    gridTransform.SetInterpolationModeToLinear()
+    gridTransformNode.SetAndObserveTransformToParent(gridTransform)
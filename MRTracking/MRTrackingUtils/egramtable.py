@@ -0,0 +1,239 @@
+import numpy
+import vtk
+import slicer
+from vtk.util import numpy_support
+
+#------------------------------------------------------------
+#
+# EgramTable class
+#
+
+class EgramTable():
+
+  # EgramTable stores the egram parameters of the points recorded in a markups fiducial node as
+  # named numeric columns (vtkDoubleArray) of a companion table node (vtkMRMLTableNode). The n-th
+  # row of the table holds the parameters of the n-th control point; the rows that have not been
+  # set are NaN. The table node is referenced from the markups node with the 'MRTracking.EgramTable'
+  # role, so that it is saved and loaded together with the scene.
+  #
+  # getColumn() returns a NumPy view of a column without copying. The view is valid only until
+  # rows are added to the table (the arrays may be reallocated), and must not be kept.
+  #
+  # Use getEgramTable() to obtain the table shared by all the modules for a markups node.
+
+  REFERENCE_ROLE = 'MRTracking.EgramTable'
+
+  def __init__(self, markupsNode):
+
+    self.markupsNodeID = markupsNode.GetID()
+    self.nRows = 0
+    self.observerTag = markupsNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointRemovedEvent, self.onPointRemoved)
+
+    tableNode = self.getTableNode()
+    if tableNode:
+      self.nRows = tableNode.GetTable().GetNumberOfRows()
+
+
+  def getMarkupsNode(self):
+
+    return slicer.mrmlScene.GetNodeByID(self.markupsNodeID)
+
+
+  def removeObservers(self):
+
+    markupsNode = self.getMarkupsNode()
+    if markupsNode and self.observerTag != None:
+      markupsNode.RemoveObserver(self.observerTag)
+    self.observerTag = None
+
+
+  def getTableNode(self, create=False):
+
+    markupsNode = self.getMarkupsNode()
+    if markupsNode == None:
+      return None
+
+    tableNode = markupsNode.GetNodeReference(self.REFERENCE_ROLE)
+    if tableNode == None and create:
+      tableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode', markupsNode.GetName() + '-Egram')
+      tableNode.SetHideFromEditors(True)
+      markupsNode.SetNodeReferenceID(self.REFERENCE_ROLE, tableNode.GetID())
+      self.nRows = 0
+    return tableNode
+
+
+  def getParameterNames(self):
+
+    tableNode = self.getTableNode()
+    if tableNode == None:
+      return []
+    table = tableNode.GetTable()
+    return [table.GetColumnName(i) for i in range(table.GetNumberOfColumns())]
+
+
+  def getNumberOfRows(self):
+
+    return self.nRows
+
+
+  def getColumnArray(self, param):
+    # Returns the vtkDoubleArray for the parameter, or None.
+
+    tableNode = self.getTableNode()
+    if tableNode == None:
+      return None
+    return tableNode.GetTable().GetColumnByName(str(param))
+
+
+  def getColumn(self, param):
+    # Returns an (n,) NumPy view of the parameter (no copy), or None if the parameter is not in the table.
+
+    array = self.getColumnArray(param)
+    if array == None:
+      return None
+    return numpy_support.vtk_to_numpy(array)
+
+
+  def getValues(self, params=None, start=0, end=None):
+    #
+    # Returns the rows from 'start' to 'end' as an (n, m) array, where m is the number of the
+    # parameters in 'params' (default: all the parameters in the table). The parameters that are
+    # not in the table are NaN.
+    #
+
+    if params == None:
+      params = self.getParameterNames()
+    if end == None:
+      end = self.nRows
+    end = max(start, end)
+
+    values = numpy.full((end - start, len(params)), numpy.nan)
+    n = max(0, min(end, self.nRows) - start)
+    for (j, param) in enumerate(params):
+      column = self.getColumn(param)
+      if column is not None:
+        values[:n, j] = column[start:start+n]
+    return values
+
+
+  def addParameters(self, params):
+    # Add the columns for the parameters that are not in the table yet. The new columns are NaN.
+
+    tableNode = self.getTableNode(create=True)
+    table = tableNode.GetTable()
+    for param in params:
+      if table.GetColumnByName(str(param)) != None:
+        continue
+      array = vtk.vtkDoubleArray()
+      array.SetName(str(param))
+      array.SetNumberOfTuples(self.nRows)
+      if self.nRows > 0:
+        array.Fill(numpy.nan)
+      table.AddColumn(array)
+
+
+  def resize(self, nRows):
+    # Change the number of rows. The arrays are grown geometrically to amortize the cost of adding
+    # rows one by one, and the new rows are filled with NaN.
+
+    tableNode = self.getTableNode(create=True)
+    table = tableNode.GetTable()
+    for i in range(table.GetNumberOfColumns()):
+      array = table.GetColumn(i)
+      capacity = array.GetSize()
+      if nRows > capacity:
+        array.Resize(max(nRows, 2 * capacity, 256))
+      array.SetNumberOfTuples(nRows)
+      if nRows > self.nRows:
+        numpy_support.vtk_to_numpy(array)[self.nRows:] = numpy.nan
+    self.nRows = nRows
+
+
+  def setValues(self, ids, values, params):
+    #
+    # Set the parameters 'params' of the control points 'ids'. 'values' is an (k, m) array, where k is
+    # the number of the control points and m is the number of the parameters. The table is extended
+    # if any of the control points is beyond the last row.
+    #
+
+    ids = numpy.asarray(ids, dtype=int).reshape(-1)
+    if len(ids) == 0:
+      return
+    values = numpy.asarray(values, dtype=float).reshape(len(ids), -1)
+
+    self.addParameters(params)
+    nRows = int(ids.max()) + 1
+    if nRows > self.nRows:
+      self.resize(nRows)
+
+    tableNode = self.getTableNode()
+    for (j, param) in enumerate(params[:values.shape[1]]):
+      self.getColumn(param)[ids] = values[:,j]
+      self.getColumnArray(param).Modified()
+    tableNode.Modified()
+
+
+  def removeRow(self, id):
+
+    tableNode = self.getTableNode()
+    if tableNode == None or id < 0 or id >= self.nRows:
+      return
+    table = tableNode.GetTable()
+    for i in range(table.GetNumberOfColumns()):
+      column = numpy_support.vtk_to_numpy(table.GetColumn(i))
+      column[id:-1] = column[id+1:].copy()
+      table.GetColumn(i).SetNumberOfTuples(self.nRows - 1)
+    self.nRows = self.nRows - 1
+    tableNode.Modified()
+
+
+  def clear(self):
+
+    self.nRows = 0
+    tableNode = self.getTableNode()
+    if tableNode:
+      tableNode.RemoveAllColumns()
+
+
+  @vtk.calldata_type(vtk.VTK_INT)
+  def onPointRemoved(self, caller, event, callData=None):
+    # Keep the rows aligned with the control points. If the index of the removed point is not given
+    # (e.g., the events have been compressed by StartModify()/EndModify()), the rows beyond the last
+    # control point are dropped.
+
+    if callData != None and callData >= 0 and self.nRows > caller.GetNumberOfControlPoints():
+      self.removeRow(callData)
+    elif self.nRows > caller.GetNumberOfControlPoints():
+      self.resize(caller.GetNumberOfControlPoints())
+
+
+# Tables shared by the modules, keyed by the markups node ID. The entries must be removed when the
+# nodes are removed or the scene is closed, since the node IDs are reused (see removeEgramTable()).
+egramTables = {}
+
+def getEgramTable(markupsNode):
+  # Returns the EgramTable for the markups node.
+
+  if markupsNode == None:
+    return None
+
+  nodeID = markupsNode.GetID()
+  table = egramTables.get(nodeID)
+  if table == None:
+    table = EgramTable(markupsNode)
+    egramTables[nodeID] = table
+  return table
+
+
+def removeEgramTable(nodeID=None):
+  # Remove the table for the markups node ID (or all the tables if 'nodeID' is None) and its
+  # observer on the node. The table node in the scene is not removed.
+
+  if nodeID == None:
+    tables = list(egramTables.values())
+    egramTables.clear()
+  else:
+    tables = [egramTables.pop(nodeID, None)]
+  for table in tables:
+    if table:
+      table.removeObservers()
@@ -0,0 +1,343 @@
+import numpy
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+from scipy.special import xlogy
+
+#------------------------------------------------------------
+#
+# RBFParameterMapper class
+#
+
+class RBFParameterMapper():
+
+  # RBFParameterMapper interpolates the egram parameters recorded at the points onto the vertices
+  # of a surface model using radial basis functions (RBF). The basis functions and the default
+  # epsilon are the same as scipy.interpolate.Rbf:
+  #
+  #   'multiquadric' : sqrt((r/epsilon)**2 + 1)
+  #   'inverse'      : 1.0/sqrt((r/epsilon)**2 + 1)
+  #   'gaussian'     : exp(-(r/epsilon)**2)
+  #   'linear'       : r
+  #   'cubic'        : r**3
+  #   'quintic'      : r**5
+  #   'thin_plate'   : r**2 * log(r)
+  #
+  # Unlike scipy.interpolate.Rbf, all the parameters are interpolated at once: the RBF matrix is
+  # factorized once, and the weights for the parameters are obtained by solving the system with
+  # multiple right-hand sides. The parameters with different sets of valid (non-NaN) values are
+  # solved separately. The values at the vertices are evaluated in chunks to bound the memory.
+
+  def __init__(self, function='multiquadric', epsilon=0.0, chunkSize=4096):
+
+    self.function = function
+    self.epsilon = epsilon     # 0.0 = Auto
+    self.chunkSize = chunkSize
+
+
+  def getDefaultEpsilon(self, pointsNP):
+    # Average distance between the points based on the bounding box (same as scipy.interpolate.Rbf)
+
+    edges = numpy.max(pointsNP, axis=0) - numpy.min(pointsNP, axis=0)
+    edges = edges[numpy.nonzero(edges)]
+    if len(edges) == 0:
+      return 1.0
+    return numpy.power(numpy.prod(edges) / pointsNP.shape[0], 1.0 / edges.size)
+
+
+  def basis(self, r, epsilon):
+
+    f = self.function
+    if f == 'multiquadric':
+      return numpy.sqrt((r/epsilon)**2 + 1)
+    elif f == 'inverse':
+      return 1.0/numpy.sqrt((r/epsilon)**2 + 1)
+    elif f == 'gaussian':
+      return numpy.exp(-(r/epsilon)**2)
+    elif f == 'linear':
+      return r
+    elif f == 'cubic':
+      return r**3
+    elif f == 'quintic':
+      return r**5
+    elif f == 'thin_plate':
+      return xlogy(r**2, r)
+    raise ValueError('Unknown radial basis function: %s' % f)
+
+
+  def solve(self, pointsNP, valuesNP):
+    # Returns a tuple (weights, epsilon), where 'weights' is an (n, m) array.
+
+    epsilon = self.epsilon
+    if epsilon == 0.0:
+      epsilon = self.getDefaultEpsilon(pointsNP)
+
+    A = self.basis(cdist(pointsNP, pointsNP), epsilon)
+    try:
+      weights = scipy.linalg.solve(A, valuesNP, assume_a='sym')
+    except scipy.linalg.LinAlgError:
+      weights = scipy.linalg.lstsq(A, valuesNP)[0]
+    return (weights, epsilon)
+
+
+  def evaluate(self, pointsNP, weights, epsilon, targetsNP):
+
+    result = numpy.zeros((targetsNP.shape[0], weights.shape[1]))
+    for i in range(0, targetsNP.shape[0], self.chunkSize):
+      phi = self.basis(cdist(targetsNP[i:i+self.chunkSize], pointsNP), epsilon)
+      result[i:i+self.chunkSize] = phi.dot(weights)
+    return result
+
+
+  def map(self, pointsNP, valuesNP, targetsNP):
+    #
+    # Interpolate (n, m) 'valuesNP' at (n, 3) 'pointsNP' onto (k, 3) 'targetsNP'. Returns a (k, m)
+    # array. The parameters without valid values are NaN.
+    #
+
+    pointsNP = numpy.asarray(pointsNP, dtype=float)
+    valuesNP = numpy.asarray(valuesNP, dtype=float).reshape(pointsNP.shape[0], -1)
+    targetsNP = numpy.asarray(targetsNP, dtype=float)
+    nParams = valuesNP.shape[1]
+    result = numpy.full((targetsNP.shape[0], nParams), numpy.nan)
+
+    # Group the parameters by the points with valid values.
+    valid = numpy.logical_not(numpy.isnan(valuesNP))
+    groups = {}
+    for j in range(nParams):
+      groups.setdefault(valid[:,j].tobytes(), []).append(j)
+
+    for columns in groups.values():
+      mask = valid[:,columns[0]]
+      if numpy.count_nonzero(mask) == 0:
+        continue
+      (weights, epsilon) = self.solve(pointsNP[mask], valuesNP[mask][:,columns])
+      result[:,columns] = self.evaluate(pointsNP[mask], weights, epsilon, targetsNP)
+
+    return result
+
+
+#------------------------------------------------------------
+#
+# GeodesicMesh class
+#
+
+class GeodesicMesh():
+
+  # GeodesicMesh holds the sparse operators of a triangle mesh used by GeodesicParameterMapper, and
+  # computes the geodesic distances from a set of source vertices to all the vertices:
+  #
+  #   'graph' : Shortest path along the edges (Dijkstra). Overestimates the distance across the
+  #             triangles, but can stop at 'limit'.
+  #   'heat'  : Heat method (Crane et al., ACM Trans Graph 2013). Solves the heat equation for a
+  #             short time (t = h^2, h = mean edge length) from the sources, normalizes the gradient
+  #             of the heat, and recovers the distance by solving a Poisson equation.
+  #
+  # The gradient operator G (3 rows per triangle) is built from the dual basis of the edges of each
+  # triangle. The cotangent Laplacian is L = G^T A G (A = triangle areas) and the mass matrix M is
+  # the lumped vertex area. The edge graph and the LU factorizations of (M + tL) and L (regularized
+  # by a small multiple of M) are computed at the first use and kept with the mesh.
+
+  def __init__(self, verticesNP, trianglesNP):
+
+    self.verticesNP = numpy.asarray(verticesNP, dtype=float)
+    self.trianglesNP = numpy.asarray(trianglesNP, dtype=numpy.int64).reshape(-1, 3)
+    self.nVertices = self.verticesNP.shape[0]
+    self.tree = cKDTree(self.verticesNP)
+
+    edges = numpy.concatenate((self.trianglesNP[:,[0,1]], self.trianglesNP[:,[1,2]], self.trianglesNP[:,[2,0]]))
+    edges = numpy.unique(numpy.sort(edges, axis=1), axis=0)
+    self.edgesNP = edges
+    self.edgeLengths = numpy.linalg.norm(self.verticesNP[edges[:,0]] - self.verticesNP[edges[:,1]], axis=1)
+    self.meanEdgeLength = numpy.mean(self.edgeLengths) if len(edges) > 0 else 1.0
+
+    self.graph = None
+    self.gradient = None
+    self.heatSolver = None
+    self.poissonSolver = None
+
+
+  def getGraph(self):
+
+    if self.graph is None:
+      e = self.edgesNP
+      self.graph = scipy.sparse.csr_matrix((self.edgeLengths, (e[:,0], e[:,1])), shape=(self.nVertices, self.nVertices))
+    return self.graph
+
+
+  def buildOperators(self):
+
+    if self.gradient is not None:
+      return
+
+    t = self.trianglesNP
+    p0 = self.verticesNP[t[:,0]]
+    e1 = self.verticesNP[t[:,1]] - p0
+    e2 = self.verticesNP[t[:,2]] - p0
+    g11 = numpy.einsum('ij,ij->i', e1, e1)
+    g12 = numpy.einsum('ij,ij->i', e1, e2)
+    g22 = numpy.einsum('ij,ij->i', e2, e2)
+    det = g11 * g22 - g12 * g12
+    valid = det > 1e-12 * numpy.maximum(g11 * g22, 1e-30)
+    invDet = numpy.zeros(det.shape)
+    invDet[valid] = 1.0 / det[valid]
+    b1 = (g22 * invDet)[:,None] * e1 - (g12 * invDet)[:,None] * e2
+    b2 = (g11 * invDet)[:,None] * e2 - (g12 * invDet)[:,None] * e1
+
+    # grad(u) = (u1 - u0) * b1 + (u2 - u0) * b2
+    nT = t.shape[0]
+    rows = numpy.repeat(numpy.arange(3 * nT).reshape(nT, 3), 3, axis=0).reshape(nT, 3, 3)  # [triangle, vertex, axis]
+    cols = numpy.repeat(t[:,:,None], 3, axis=2)
+    coefs = numpy.stack((-(b1 + b2), b1, b2), axis=1)
+    self.gradient = scipy.sparse.csr_matrix((coefs.reshape(-1), (rows.reshape(-1), cols.reshape(-1))), shape=(3 * nT, self.nVertices))
+
+    self.areas = 0.5 * numpy.sqrt(numpy.maximum(det, 0.0))
+    self.areaWeights = scipy.sparse.diags(numpy.repeat(self.areas, 3))
+    self.laplacian = (self.gradient.T * self.areaWeights * self.gradient).tocsc()
+    vertexAreas = numpy.bincount(t.reshape(-1), weights=numpy.repeat(self.areas / 3.0, 3), minlength=self.nVertices)
+    vertexAreas = numpy.maximum(vertexAreas, 1e-12 * max(numpy.mean(vertexAreas), 1e-30))  # Isolated vertices
+    self.mass = scipy.sparse.diags(vertexAreas).tocsc()
+
+
+  def getHeatSolvers(self):
+
+    if self.heatSolver is None:
+      print('Factorizing the heat and Poisson equations...')
+      self.buildOperators()
+      t = self.meanEdgeLength ** 2
+      self.heatSolver = scipy.sparse.linalg.splu((self.mass + t * self.laplacian).tocsc())
+      # L has the constant vectors in its null space.
+      self.poissonSolver = scipy.sparse.linalg.splu((self.laplacian + 1e-8 / t * self.mass).tocsc())
+    return (self.heatSolver, self.poissonSolver)
+
+
+  def project(self, pointsNP):
+    # Returns the indices of the nearest vertices.
+
+    (d, indices) = self.tree.query(pointsNP, k=1)
+    return indices
+
+
+  def getDistances(self, sources, method='heat', limit=numpy.inf):
+    #
+    # Returns an (nVertices, len(sources)) array of the distances from the source vertices. The
+    # unreachable vertices (or beyond 'limit' for 'graph') are inf.
+    #
+
+    sources = numpy.asarray(sources, dtype=numpy.int64)
+    if method == 'graph':
+      return csgraph.dijkstra(self.getGraph(), directed=False, indices=sources, limit=limit).T
+
+    (heatSolver, poissonSolver) = self.getHeatSolvers()
+    delta = numpy.zeros((self.nVertices, len(sources)))
+    delta[sources, numpy.arange(len(sources))] = 1.0
+    u = heatSolver.solve(delta)
+
+    # Normalized gradient of the heat, pointing away from the sources (3 rows per triangle).
+    gradU = (self.gradient * u).reshape(-1, 3, len(sources))
+    norm = numpy.sqrt(numpy.sum(gradU * gradU, axis=1))
+    norm[norm == 0.0] = numpy.inf
+    X = (-gradU / norm[:,None,:]).reshape(-1, len(sources))
+
+    phi = poissonSolver.solve(self.gradient.T * (self.areaWeights * X))
+    distances = numpy.maximum(phi - phi[sources, numpy.arange(len(sources))], 0.0)
+    distances[u <= 0.0] = numpy.inf   # Not connected to the source
+    distances[distances > limit] = numpy.inf
+    return distances
+
+
+#------------------------------------------------------------
+#
+# GeodesicParameterMapper class
+#
+
+class GeodesicParameterMapper():
+
+  # GeodesicParameterMapper interpolates the egram parameters on the surface model along the
+  # surface instead of through the 3D space, so that the values do not leak across thin walls or
+  # between neighbouring veins. The recorded points are projected to the nearest vertices (the
+  # values of the points on the same vertex are averaged), and the value at each vertex is the
+  # inverse-distance weighted average of the sources, using the geodesic distance ('heat' or
+  # 'graph'; see GeodesicMesh):
+  #
+  #   f(v) = sum_i w_i(v) * f_i / sum_i w_i(v),   w_i(v) = 1 / max(d_i(v), h/2)^power
+  #
+  # The sources farther than 'radius' (0.0 = no limit) are ignored; the vertices without any source
+  # within the radius are NaN. The distances are computed for 'chunkSize' sources at a time and
+  # accumulated, so the memory does not grow with the number of the points.
+  #
+  # The operators and factorizations of the recent meshes (e.g., the levels of detail of the
+  # surface model) are cached, so the mapper should be kept between the maps.
+
+  def __init__(self, method='heat', radius=0.0, power=2.0, chunkSize=64, cacheSize=3):
+
+    self.method = method
+    self.radius = radius     # 0.0 = No limit
+    self.power = power
+    self.chunkSize = chunkSize
+    self.cacheSize = cacheSize
+    self.meshes = []         # List of (key, GeodesicMesh), most recent last
+    self.mesh = None
+
+
+  def setMesh(self, verticesNP, trianglesNP):
+
+    verticesNP = numpy.ascontiguousarray(verticesNP, dtype=float)
+    trianglesNP = numpy.ascontiguousarray(trianglesNP, dtype=numpy.int64)
+    key = (verticesNP.shape[0], trianglesNP.shape[0], hash(verticesNP.tobytes()), hash(trianglesNP.tobytes()))
+
+    for (i, (k, mesh)) in enumerate(self.meshes):
+      if k == key:
+        self.meshes.append(self.meshes.pop(i))
+        self.mesh = mesh
+        return
+
+    self.mesh = GeodesicMesh(verticesNP, trianglesNP)
+    self.meshes.append((key, self.mesh))
+    if len(self.meshes) > self.cacheSize:
+      self.meshes.pop(0)
+
+
+  def map(self, pointsNP, valuesNP, targetsNP=None):
+    #
+    # Interpolate (n, m) 'valuesNP' at (n, 3) 'pointsNP' onto the vertices of the mesh (see
+    # setMesh()). Returns a (nVertices, m) array. 'targetsNP' is not used (the targets are the
+    # vertices of the mesh).
+    #
+
+    mesh = self.mesh
+    pointsNP = numpy.asarray(pointsNP, dtype=float)
+    valuesNP = numpy.asarray(valuesNP, dtype=float).reshape(pointsNP.shape[0], -1)
+    nParams = valuesNP.shape[1]
+    if pointsNP.shape[0] == 0:
+      return numpy.full((mesh.nVertices, nParams), numpy.nan)
+
+    # Average the values of the points projected to the same vertex.
+    (sources, inverse) = numpy.unique(mesh.project(pointsNP), return_inverse=True)
+    valid = numpy.logical_not(numpy.isnan(valuesNP))
+    sums = numpy.zeros((len(sources), nParams))
+    counts = numpy.zeros((len(sources), nParams))
+    numpy.add.at(sums, inverse, numpy.where(valid, valuesNP, 0.0))
+    numpy.add.at(counts, inverse, valid)
+    sourceValid = (counts > 0).astype(float)
+    sourceValues = sums / numpy.maximum(counts, 1.0)
+
+    limit = self.radius if self.radius > 0.0 else numpy.inf
+    minDistance = 0.5 * mesh.meanEdgeLength
+    numerator = numpy.zeros((mesh.nVertices, nParams))
+    denominator = numpy.zeros((mesh.nVertices, nParams))
+    for i in range(0, len(sources), self.chunkSize):
+      distances = mesh.getDistances(sources[i:i+self.chunkSize], self.method, limit)
+      weights = numpy.zeros(distances.shape)
+      finite = numpy.isfinite(distances)
+      weights[finite] = numpy.maximum(distances[finite], minDistance) ** -self.power
+      numerator += weights.dot(sourceValues[i:i+self.chunkSize] * sourceValid[i:i+self.chunkSize])
+      denominator += weights.dot(sourceValid[i:i+self.chunkSize])
+
+    result = numpy.full((mesh.nVertices, nParams), numpy.nan)
+    mask = denominator > 0.0
+    result[mask] = numerator[mask] / denominator[mask]
+    return result
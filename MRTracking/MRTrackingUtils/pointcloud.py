@@ -0,0 +1,247 @@
+import numpy
+import vtk
+import slicer
+from vtk.util import numpy_support
+from MRTrackingUtils.pointindex import *
+from MRTrackingUtils.egramtable import *
+
+#------------------------------------------------------------
+#
+# RecordedPointCloud class
+#
+
+class RecordedPointCloud():
+
+  # RecordedPointCloud displays the points recorded in a markups fiducial node as a point cloud
+  # (a model node with one vertex per point) instead of the markups control points, which become
+  # slow to render beyond a few thousand points. The egram parameters are added to the point data
+  # as scalar arrays (one array per parameter), and the vertices are colored by the selected one.
+  #
+  # update() appends the points added to the markups node since the last call to the arrays in
+  # one step. The arrays (including the offsets and connectivity of the vertex cells) are grown
+  # geometrically, and only the new points, egram parameters and vertex ids are copied. The points
+  # updated in place (e.g., by VoxelRecordingFilter) are given as 'modifiedIds' and copied
+  # individually. All the points are copied again only if the existing points have been moved or
+  # removed by the user, or 'full' is specified (e.g., after clearing or importing the points).
+  #
+  # The model node is referenced from the markups node with the 'MRTracking.PointCloud' role.
+  # Use getRecordedPointCloud() to obtain the point cloud shared by all the modules for a markups node.
+
+  REFERENCE_ROLE = 'MRTracking.PointCloud'
+
+  def __init__(self, markupsNode):
+
+    self.markupsNodeID = markupsNode.GetID()
+    self.nPoints = 0
+    self.params = []
+    self.scalarParam = None
+    self.fReset = False
+
+    self.polyData = vtk.vtkPolyData()
+    self.points = vtk.vtkPoints()
+    self.points.SetDataTypeToDouble()
+    self.verts = vtk.vtkCellArray()
+    self.vertOffsets = vtk.vtkIdTypeArray()
+    self.vertConnectivity = vtk.vtkIdTypeArray()
+    self.polyData.SetPoints(self.points)
+    self.polyData.SetVerts(self.verts)
+
+    # Points moved or removed by the user invalidate the arrays.
+    self.observerTags = []
+    for event in [slicer.vtkMRMLMarkupsNode.PointEndInteractionEvent, slicer.vtkMRMLMarkupsNode.PointRemovedEvent]:
+      self.observerTags.append(markupsNode.AddObserver(event, self.onMarkupsInvalidated))
+
+
+  def getMarkupsNode(self):
+
+    return slicer.mrmlScene.GetNodeByID(self.markupsNodeID)
+
+
+  def removeObservers(self):
+
+    markupsNode = self.getMarkupsNode()
+    if markupsNode:
+      for tag in self.observerTags:
+        markupsNode.RemoveObserver(tag)
+    self.observerTags = []
+
+
+  def getModelNode(self, create=False):
+
+    markupsNode = self.getMarkupsNode()
+    if markupsNode == None:
+      return None
+
+    modelNode = markupsNode.GetNodeReference(self.REFERENCE_ROLE)
+    if modelNode == None and create:
+      modelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode', markupsNode.GetName() + '-Cloud')
+      modelNode.CreateDefaultDisplayNodes()
+      dnode = modelNode.GetDisplayNode()
+      dnode.SetPointSize(4.0)
+      dnode.SetVisibility2D(False)
+      dnode.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseDataScalarRange)
+      dnode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeRainbow')
+      dnode.SetVisibility(False)
+      markupsNode.SetNodeReferenceID(self.REFERENCE_ROLE, modelNode.GetID())
+    if modelNode and modelNode.GetPolyData() != self.polyData:
+      modelNode.SetAndObservePolyData(self.polyData)
+    return modelNode
+
+
+  def setVisible(self, visible):
+    # Show the point cloud in place of the markups control points (or the other way around).
+
+    markupsNode = self.getMarkupsNode()
+    modelNode = self.getModelNode(create=visible)
+    if markupsNode and markupsNode.GetDisplayNode():
+      markupsNode.GetDisplayNode().SetVisibility(not visible)
+    if modelNode and modelNode.GetDisplayNode():
+      modelNode.GetDisplayNode().SetVisibility(visible)
+    if visible:
+      self.update(full=True)
+
+
+  def isVisible(self):
+
+    modelNode = self.getModelNode()
+    if modelNode == None or modelNode.GetDisplayNode() == None:
+      return False
+    return bool(modelNode.GetDisplayNode().GetVisibility())
+
+
+  def setScalarParameter(self, param):
+    # Color the vertices by the egram parameter 'param' (or a single color if None).
+
+    self.scalarParam = param
+    modelNode = self.getModelNode()
+    if modelNode == None:
+      return
+    dnode = modelNode.GetDisplayNode()
+    if param and self.polyData.GetPointData().GetArray(str(param)) != None:
+      dnode.SetActiveScalarName(str(param))
+      dnode.SetScalarVisibility(True)
+    else:
+      dnode.SetScalarVisibility(False)
+
+
+  def onMarkupsInvalidated(self, caller, event):
+
+    self.fReset = True
+
+
+  def resizeArray(self, array, n):
+    # Change the number of tuples, growing the memory geometrically. Returns an (n, c) view.
+
+    capacity = array.GetSize() // max(array.GetNumberOfComponents(), 1)
+    if n > capacity:
+      array.Resize(max(n, 2 * capacity, 1024))
+    array.SetNumberOfTuples(n)
+    return numpy_support.vtk_to_numpy(array)
+
+
+  def update(self, full=False, modifiedIds=None):
+    #
+    # Append the points added since the last update, and copy the points with the control point
+    # indices 'modifiedIds' again. If 'full' is True, or the points have been invalidated, all the
+    # points are copied again. Returns the number of the points.
+    #
+
+    markupsNode = self.getMarkupsNode()
+    if markupsNode == None:
+      return 0
+
+    index = getRecordedPointIndex(markupsNode)
+    table = getEgramTable(markupsNode)
+    n = index.getNumberOfPoints()
+    params = table.getParameterNames()
+
+    n0 = self.nPoints
+    if full or self.fReset or n < n0 or params != self.params:
+      n0 = 0
+      self.fReset = False
+
+    # The points updated in place before the new points
+    if modifiedIds is None:
+      modifiedIds = numpy.zeros(0, dtype=int)
+    modifiedIds = numpy.asarray(modifiedIds, dtype=int)
+    modifiedIds = modifiedIds[modifiedIds < n0]
+    if n0 == n and n == self.nPoints and len(modifiedIds) == 0:
+      return n
+
+    # Positions
+    pointsNP = self.resizeArray(self.points.GetData(), n)
+    pointsNP[n0:n] = index.getPoints()[n0:n]
+    pointsNP[modifiedIds] = index.getPoints()[modifiedIds]
+    self.points.Modified()
+
+    # Egram parameters
+    pointData = self.polyData.GetPointData()
+    fParams = (params != self.params)
+    if fParams:
+      for param in self.params:
+        pointData.RemoveArray(str(param))
+      for param in params:
+        array = vtk.vtkDoubleArray()
+        array.SetName(str(param))
+        pointData.AddArray(array)
+      self.params = params
+    if len(params) > 0:
+      valuesNP = table.getValues(params, n0, n)
+      for (j, param) in enumerate(params):
+        array = pointData.GetArray(str(param))
+        arrayNP = self.resizeArray(array, n)
+        arrayNP[n0:n] = valuesNP[:,j]
+        if len(modifiedIds) > 0:
+          column = table.getColumn(param)
+          if column is not None and len(column) > numpy.max(modifiedIds):
+            arrayNP[modifiedIds] = column[modifiedIds]
+        array.Modified()
+
+    # One vertex per point: offsets [0, 1, ..., n] and connectivity [0, 1, ..., n-1]. Only the
+    # entries for the new points are written. The arrays are shared with the cell array (no copy).
+    offsetsNP = self.resizeArray(self.vertOffsets, n + 1)
+    offsetsNP[n0:n+1] = numpy.arange(n0, n + 1)
+    connectivityNP = self.resizeArray(self.vertConnectivity, n)
+    connectivityNP[n0:n] = numpy.arange(n0, n)
+    self.vertOffsets.Modified()
+    self.vertConnectivity.Modified()
+    self.verts.SetData(self.vertOffsets, self.vertConnectivity)
+
+    self.nPoints = n
+    self.polyData.Modified()
+    if fParams:
+      self.setScalarParameter(self.scalarParam)
+    return n
+
+
+# Point clouds shared by the modules, keyed by the markups node ID. The entries must be removed when
+# the nodes are removed or the scene is closed, since the node IDs are reused (see
+# removeRecordedPointCloud()).
+recordedPointClouds = {}
+
+def getRecordedPointCloud(markupsNode):
+  # Returns the RecordedPointCloud for the markups node.
+
+  if markupsNode == None:
+    return None
+
+  nodeID = markupsNode.GetID()
+  cloud = recordedPointClouds.get(nodeID)
+  if cloud == None:
+    cloud = RecordedPointCloud(markupsNode)
+    recordedPointClouds[nodeID] = cloud
+  return cloud
+
+
+def removeRecordedPointCloud(nodeID=None):
+  # Remove the point cloud for the markups node ID (or all the point clouds if 'nodeID' is None) and
+  # its observers on the node.
+
+  if nodeID == None:
+    clouds = list(recordedPointClouds.values())
+    recordedPointClouds.clear()
+  else:
+    clouds = [recordedPointClouds.pop(nodeID, None)]
+  for cloud in clouds:
+    if cloud:
+      cloud.removeObservers()
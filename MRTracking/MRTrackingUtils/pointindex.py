@@ -0,0 +1,371 @@
+import numpy
+import slicer
+from MRTrackingUtils.egramtable import *
+
+#------------------------------------------------------------
+#
+# RecordedPointIndex class
+#
+
+class RecordedPointIndex():
+
+  # RecordedPointIndex keeps the positions of the points recorded in a markups fiducial node as
+  # a NumPy array, together with a uniform-grid spatial index (a hash table from grid cells to point
+  # indices). The array and the index are extended incrementally as new control points are added
+  # to the node. The index is rebuilt only when points are removed or moved.
+  #
+  # The egram parameters are not copied; they are read from the egram table of the node (see
+  # egramtable.py). The egram parameters of a node recorded by an older version (saved as the
+  # control point descriptions) are parsed once and moved to the egram table.
+  #
+  # Use getRecordedPointIndex() to obtain the index shared by all the modules for a markups node.
+
+  def __init__(self, cellSize=5.0):
+
+    self.cellSize = cellSize
+    self.markupsNodeID = None
+    self.observerTags = []
+    self.clear()
+
+
+  def clear(self):
+
+    self.nPoints = 0
+    self.pointsNP = numpy.zeros((0,3))
+    self.cells = {}          # (i, j, k) -> list of point indices
+    self.keyMin = None       # Range of the occupied cells
+    self.keyMax = None
+    self.fRebuild = False
+    self.nImported = 0       # Number of the control points whose descriptions have been examined
+
+
+  def reserve(self, nPoints):
+    # Grow the array geometrically to amortize the cost of adding points one by one.
+
+    capacity = self.pointsNP.shape[0]
+    if nPoints > capacity:
+      capacity = max(nPoints, 2 * capacity, 256)
+      points = numpy.zeros((capacity, 3))
+      points[:self.nPoints] = self.pointsNP[:self.nPoints]
+      self.pointsNP = points
+
+
+  def getCellKeys(self, points):
+
+    return numpy.floor(points / self.cellSize).astype(numpy.int64)
+
+
+  def add(self, points):
+    # Add (n, 3) points. Returns the indices of the added points.
+
+    points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+    n = points.shape[0]
+    if n == 0:
+      return numpy.zeros(0, dtype=int)
+
+    i0 = self.nPoints
+    self.reserve(i0 + n)
+    self.pointsNP[i0:i0+n] = points
+    self.nPoints = i0 + n
+
+    # Group the new points by cell (sorting by a linear cell code), so that each cell is looked up
+    # only once.
+    keys = self.getCellKeys(points)
+    keyMin = keys.min(axis=0)
+    keyMax = keys.max(axis=0)
+    k = keys - keyMin
+    dims = keyMax - keyMin + 1
+    code = (k[:,0] * dims[1] + k[:,1]) * dims[2] + k[:,2]
+    order = numpy.argsort(code, kind='stable')
+    starts = numpy.flatnonzero(numpy.diff(code[order], prepend=-1))
+    ends = numpy.append(starts[1:], n)
+    indices = (order + i0).tolist()
+    for (start, end, key) in zip(starts.tolist(), ends.tolist(), keys[order[starts]].tolist()):
+      self.cells.setdefault(tuple(key), []).extend(indices[start:end])
+
+    if self.keyMin is None:
+      self.keyMin = keyMin
+      self.keyMax = keyMax
+    else:
+      self.keyMin = numpy.minimum(self.keyMin, keyMin)
+      self.keyMax = numpy.maximum(self.keyMax, keyMax)
+
+    return numpy.arange(i0, i0 + n)
+
+
+  def setPoint(self, i, point):
+    # Overwrite the position of the i-th point (e.g., a point updated in place by VoxelRecordingFilter).
+
+    point = numpy.asarray(point, dtype=float)
+    oldKey = tuple(self.getCellKeys(self.pointsNP[i]))
+    key = self.getCellKeys(point)
+    if tuple(key) != oldKey:
+      self.cells[oldKey].remove(i)
+      if len(self.cells[oldKey]) == 0:
+        del self.cells[oldKey]
+      self.cells.setdefault(tuple(key), []).append(i)
+      self.keyMin = numpy.minimum(self.keyMin, key)
+      self.keyMax = numpy.maximum(self.keyMax, key)
+
+    self.pointsNP[i] = point
+
+
+  def getNumberOfPoints(self):
+
+    return self.nPoints
+
+
+  def getPoints(self):
+
+    return self.pointsNP[:self.nPoints]
+
+
+  def getEgramTable(self):
+
+    if self.markupsNodeID == None:
+      return None
+    return egramTables.get(self.markupsNodeID)
+
+
+  def getParameterNames(self):
+
+    table = self.getEgramTable()
+    if table == None:
+      return []
+    return table.getParameterNames()
+
+
+  def getValues(self, params=None):
+    # Returns the (n, m) egram parameters of the points for 'params' (default: all the parameters).
+    # The parameters that are not available are NaN.
+
+    table = self.getEgramTable()
+    if table == None:
+      if params == None:
+        params = []
+      return numpy.full((self.nPoints, len(params)), numpy.nan)
+    return table.getValues(params, 0, self.nPoints)
+
+
+  def getColumn(self, param):
+    # Returns the (n,) values of one parameter. The array is a view of the egram table if the table
+    # has all the points; the view must not be kept (see EgramTable.getColumn()).
+
+    table = self.getEgramTable()
+    column = None
+    if table:
+      column = table.getColumn(param)
+    if column is None:
+      return numpy.full(self.nPoints, numpy.nan)
+    if len(column) < self.nPoints:
+      return table.getValues([param], 0, self.nPoints)[:,0]
+    return column[:self.nPoints]
+
+
+  def getCandidates(self, keyMin, keyMax):
+    # Indices of the points in the cells between 'keyMin' and 'keyMax' (inclusive). If the range
+    # covers more cells than the points, all the points are returned instead of scanning the cells.
+
+    if self.nPoints == 0:
+      return numpy.zeros(0, dtype=int)
+    keyMin = numpy.maximum(keyMin, self.keyMin)
+    keyMax = numpy.minimum(keyMax, self.keyMax)
+    if numpy.any(keyMax < keyMin):
+      return numpy.zeros(0, dtype=int)
+    if numpy.prod(keyMax - keyMin + 1) > self.nPoints:
+      return numpy.arange(self.nPoints)
+
+    candidates = []
+    for i in range(keyMin[0], keyMax[0]+1):
+      for j in range(keyMin[1], keyMax[1]+1):
+        for k in range(keyMin[2], keyMax[2]+1):
+          c = self.cells.get((i, j, k))
+          if c:
+            candidates.extend(c)
+    return numpy.array(candidates, dtype=int)
+
+
+  def queryRadius(self, center, radius):
+    # Returns the indices of the points within 'radius' from 'center', sorted by the distance.
+
+    center = numpy.asarray(center, dtype=float)
+    keyMin = self.getCellKeys(center - radius)
+    keyMax = self.getCellKeys(center + radius)
+    candidates = self.getCandidates(keyMin, keyMax)
+    if len(candidates) == 0:
+      return candidates
+
+    d = numpy.linalg.norm(self.pointsNP[candidates] - center, axis=1)
+    inside = d <= radius
+    return candidates[inside][numpy.argsort(d[inside], kind='stable')]
+
+
+  def queryNearest(self, point, maxDistance=None):
+    #
+    # Returns a tuple (index, distance) of the point nearest to 'point'. The cells are searched in
+    # growing shells around the cell containing 'point', until no closer point can exist in the next
+    # shell. Returns (-1, None) if no point is found within 'maxDistance'.
+    #
+
+    if self.nPoints == 0:
+      return (-1, None)
+
+    point = numpy.asarray(point, dtype=float)
+    key = self.getCellKeys(point)
+
+    # Range of the shell radius; the shells outside the occupied cells are skipped.
+    rMin = int(max(0, numpy.max(numpy.concatenate((self.keyMin - key, key - self.keyMax)))))
+    rMax = int(numpy.max(numpy.abs(numpy.concatenate((self.keyMin - key, self.keyMax - key)))))
+    if maxDistance != None:
+      rMax = min(rMax, int(numpy.ceil(maxDistance / self.cellSize)))
+
+    bestIndex = -1
+    bestDistance = numpy.inf
+    for r in range(rMin, rMax + 1):
+      candidates = self.getCandidates(key - r, key + r)
+      if len(candidates) > 0:
+        d = numpy.linalg.norm(self.pointsNP[candidates] - point, axis=1)
+        i = numpy.argmin(d)
+        if d[i] < bestDistance:
+          bestDistance = d[i]
+          bestIndex = candidates[i]
+      # Any point outside the current shell is at least r * cellSize away.
+      if len(candidates) == self.nPoints or (bestIndex >= 0 and bestDistance <= r * self.cellSize):
+        break
+
+    if bestIndex < 0 or (maxDistance != None and bestDistance > maxDistance):
+      return (-1, None)
+    return (int(bestIndex), float(bestDistance))
+
+
+  #--------------------------------------------------
+  # Synchronization with the markups node
+  #
+
+  def setMarkupsNode(self, markupsNode):
+
+    self.removeObservers()
+    self.clear()
+    self.markupsNodeID = None
+    if markupsNode:
+      self.markupsNodeID = markupsNode.GetID()
+      getEgramTable(markupsNode)
+      # Points moved or removed by the user invalidate the index.
+      for event in [slicer.vtkMRMLMarkupsNode.PointEndInteractionEvent, slicer.vtkMRMLMarkupsNode.PointRemovedEvent]:
+        self.observerTags.append(markupsNode.AddObserver(event, self.onMarkupsInvalidated))
+
+
+  def removeObservers(self):
+
+    if self.markupsNodeID:
+      markupsNode = slicer.mrmlScene.GetNodeByID(self.markupsNodeID)
+      if markupsNode:
+        for tag in self.observerTags:
+          markupsNode.RemoveObserver(tag)
+    self.observerTags = []
+
+
+  def onMarkupsInvalidated(self, caller, event):
+
+    self.fRebuild = True
+
+
+  def update(self):
+    # Bring the index up to date with the markups node. Only the control points added since the
+    # last update are read.
+
+    if self.markupsNodeID == None:
+      return
+    markupsNode = slicer.mrmlScene.GetNodeByID(self.markupsNodeID)
+    if markupsNode == None:
+      self.clear()
+      return
+
+    nControlPoints = markupsNode.GetNumberOfControlPoints()
+    if self.fRebuild or nControlPoints < self.nPoints:
+      self.clear()
+
+    if nControlPoints == self.nPoints:
+      return
+
+    newPoints = numpy.zeros((nControlPoints - self.nPoints, 3))
+    pos = [0.0]*3
+    for (i, id) in enumerate(range(self.nPoints, nControlPoints)):
+      markupsNode.GetNthControlPointPosition(id, pos)
+      newPoints[i] = pos
+
+    # The descriptions of each control point are examined only once, even if they do not have
+    # the egram parameters (i.e., the table is not extended).
+    table = getEgramTable(markupsNode)
+    start = max(table.getNumberOfRows(), self.nImported)
+    if start < nControlPoints:
+      self.importDescriptions(markupsNode, table, start, nControlPoints)
+    self.nImported = nControlPoints
+
+    self.add(newPoints)
+
+
+  def importDescriptions(self, markupsNode, table, start, end):
+    # Move the egram parameters saved as the descriptions of the control points from 'start' to 'end'
+    # (by an older version) to the egram table.
+
+    values = []
+    for id in range(start, end):
+      desc = markupsNode.GetNthControlPointDescription(id)
+      try:
+        values.append([float(s) for s in desc.split(',')] if desc else [])
+      except ValueError:
+        values.append([])
+
+    nParams = max([len(v) for v in values])
+    if nParams == 0:
+      return
+
+    params = []
+    paramListStr = markupsNode.GetAttribute('MRTracking.EgramParamList')
+    if paramListStr:
+      params = paramListStr.split(',')
+    params = params + ['Param%d' % i for i in range(len(params), nParams)]
+
+    valuesNP = numpy.full((len(values), nParams), numpy.nan)
+    for (i, v) in enumerate(values):
+      valuesNP[i,:len(v)] = v
+    table.setValues(numpy.arange(start, end), valuesNP, params[:nParams])
+
+
+# Indices shared by the modules, keyed by the markups node ID. The entries must be removed when the
+# nodes are removed or the scene is closed, since the node IDs are reused (see
+# removeRecordedPointIndex()).
+recordedPointIndices = {}
+
+def getRecordedPointIndex(markupsNode, update=True):
+  # Returns the RecordedPointIndex for the markups node, updated to the current control points
+  # unless 'update' is False.
+
+  if markupsNode == None:
+    return None
+
+  nodeID = markupsNode.GetID()
+  index = recordedPointIndices.get(nodeID)
+  if index == None:
+    index = RecordedPointIndex()
+    index.setMarkupsNode(markupsNode)
+    recordedPointIndices[nodeID] = index
+
+  if update:
+    index.update()
+  return index
+
+
+def removeRecordedPointIndex(nodeID=None):
+  # Remove the index for the markups node ID (or all the indices if 'nodeID' is None) and its
+  # observers on the node.
+
+  if nodeID == None:
+    indices = list(recordedPointIndices.values())
+    recordedPointIndices.clear()
+  else:
+    indices = [recordedPointIndices.pop(nodeID, None)]
+  for index in indices:
+    if index:
+      index.removeObservers()
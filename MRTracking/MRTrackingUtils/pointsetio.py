@@ -0,0 +1,130 @@
+import numpy
+import slicer
+from MRTrackingUtils.pointindex import *
+from MRTrackingUtils.egramtable import *
+
+#------------------------------------------------------------
+#
+# Point set I/O
+#
+
+#
+# The recorded points are saved as a NumPy .npy file with a structured data type. Each record
+# consists of the coordinates ('x', 'y', 'z') followed by the egram parameters; the names of the
+# fields after the coordinates are the parameter names given by the 'MRTracking.EgramParamList'
+# attribute of the markups node. For example:
+#
+#   dtype([('x', '<f8'), ('y', '<f8'), ('z', '<f8'), ('Max(mV)', '<f8'), ('Min(mV)', '<f8'), ('LAT(ms)', '<f8')])
+#
+# The file is written chunk by chunk through a memory map, and read as a memory map, so that
+# neither side needs to hold a copy of the whole point set. The file is not compressed because
+# compressed data cannot be memory-mapped.
+#
+
+POINT_SET_COORDINATES = ['x', 'y', 'z']
+
+
+def getPointSetDataType(params):
+  # Raises ValueError if a parameter name is used twice or is one of the coordinate names.
+
+  names = POINT_SET_COORDINATES + [str(p) for p in params]
+  duplicates = sorted(set([name for name in names if names.count(name) > 1]))
+  if len(duplicates) > 0:
+    raise ValueError('Duplicate field names in the point set: %s' % ', '.join(duplicates))
+  return numpy.dtype([(name, numpy.float64) for name in names])
+
+
+def writePointSet(filename, points, values, params, chunkSize=65536):
+  #
+  # Write (n, 3) 'points' and (n, m) egram 'values' with the parameter names 'params' to 'filename'.
+  # 'points' can be any array that supports slicing (e.g., a memory map). 'values' can be either
+  # such an array, or a function values(start, end) that returns the rows from 'start' to 'end', so
+  # that the values are produced chunk by chunk.
+  #
+
+  nPoints = len(points)
+  nParams = len(params)
+  dtype = getPointSetDataType(params)
+  if not callable(values):
+    array = values
+    values = lambda start, end: array[start:end]
+
+  out = numpy.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=(nPoints,))
+
+  # View of the records as an (n, 3 + m) array of float64
+  outNP = out.view(numpy.float64).reshape(nPoints, 3 + nParams)
+  for i in range(0, nPoints, chunkSize):
+    outNP[i:i+chunkSize, 0:3] = points[i:i+chunkSize]
+    if nParams > 0:
+      outNP[i:i+chunkSize, 3:] = numpy.asarray(values(i, min(i + chunkSize, nPoints)))[:, 0:nParams]
+
+  out.flush()
+  del out
+
+
+def readPointSet(filename):
+  #
+  # Returns a tuple (points, values, params). 'points' ((n, 3)) and 'values' ((n, m)) are read-only
+  # views of the memory-mapped file.
+  #
+
+  data = numpy.load(filename, mmap_mode='r')
+  names = data.dtype.names
+  if names == None or list(names[0:3]) != POINT_SET_COORDINATES:
+    raise ValueError('%s is not a point set file.' % filename)
+
+  params = list(names[3:])
+  arrayNP = data.view(numpy.float64).reshape(data.shape[0], len(names))
+  return (arrayNP[:,0:3], arrayNP[:,3:], params)
+
+
+def exportPointSet(markupsNode, filename, chunkSize=65536):
+  # Save the points and egram parameters recorded in 'markupsNode'. Returns the number of points.
+
+  index = getRecordedPointIndex(markupsNode)
+  if index == None:
+    return 0
+
+  # The egram values are read from the egram table chunk by chunk (see writePointSet()).
+  params = index.getParameterNames()
+  nPoints = index.getNumberOfPoints()
+  table = index.getEgramTable()
+  if table == None:
+    params = []
+    values = numpy.zeros((nPoints, 0))
+  else:
+    values = lambda start, end: table.getValues(params, start, end)
+  writePointSet(filename, index.getPoints(), values, params, chunkSize)
+  return nPoints
+
+
+def importPointSet(markupsNode, filename, chunkSize=65536):
+  #
+  # Replace the control points in 'markupsNode' with the point set in 'filename'. The positions are
+  # set in one call from the memory-mapped view, and the egram parameters are copied from the file to the egram table
+  # (see egramtable.py) chunk by chunk. The point index shared by the other modules (see
+  # pointindex.py) is built directly from the file. Returns the number of points.
+  #
+
+  (points, values, params) = readPointSet(filename)
+  nPoints = points.shape[0]
+
+  table = getEgramTable(markupsNode)
+  wasModifying = markupsNode.StartModify()
+  markupsNode.RemoveAllControlPoints()
+  slicer.util.updateMarkupsControlPointsFromArray(markupsNode, points)
+  table.clear()
+  if len(params) > 0:
+    markupsNode.SetAttribute('MRTracking.EgramParamList', ','.join(params))
+    table.addParameters(params)
+    table.resize(nPoints)
+    for i in range(0, nPoints, chunkSize):
+      n = min(chunkSize, nPoints - i)
+      table.setValues(numpy.arange(i, i + n), values[i:i+n], params)
+  markupsNode.EndModify(wasModifying)
+
+  index = getRecordedPointIndex(markupsNode, update=False)
+  index.clear()
+  index.add(points)
+
+  return nPoints
@@ -2,6 +2,8 @@ import qt
 import ctk
 from MRTrackingUtils.catheter import *
 from MRTrackingUtils.qcomboboxcatheter import *
+from MRTrackingUtils.pointsetio import *
+from MRTrackingUtils.pointcloud import *
 from qt import QFrame
 
 class QPointRecordingFrame(QFrame):
@@ -116,6 +118,29 @@ class QPointRecordingFrame(QFrame):
     self.visibilityOnRadioButton.connect("clicked(bool)", self.onVisibilityChanged)
     self.visibilityOffRadioButton.connect("clicked(bool)", self.onVisibilityChanged)
 
+    # Display mode (markups control points or point cloud)
+    displayModeBoxLayout = qt.QHBoxLayout()
+    self.displayModeGroup = qt.QButtonGroup()
+    self.displayModeMarkupsRadioButton = qt.QRadioButton("Markups")
+    self.displayModeCloudRadioButton = qt.QRadioButton("Point Cloud")
+    self.displayModeMarkupsRadioButton.checked = 1
+    self.displayModeMarkupsRadioButton.setToolTip("Display the recorded points as markups control points.")
+    self.displayModeCloudRadioButton.setToolTip("Display the recorded points as a point cloud model colored by an egram parameter. Use it for a large number of points.")
+    displayModeBoxLayout.addWidget(self.displayModeMarkupsRadioButton)
+    self.displayModeGroup.addButton(self.displayModeMarkupsRadioButton)
+    displayModeBoxLayout.addWidget(self.displayModeCloudRadioButton)
+    self.displayModeGroup.addButton(self.displayModeCloudRadioButton)
+
+    self.cloudParamComboBox = qt.QComboBox()
+    self.cloudParamComboBox.addItem('None')
+    self.cloudParamComboBox.setToolTip("Egram parameter to color the point cloud.")
+    displayModeBoxLayout.addWidget(self.cloudParamComboBox)
+
+    pointLayout.addRow("Display Mode: ", displayModeBoxLayout)
+    self.displayModeMarkupsRadioButton.connect("clicked(bool)", self.onDisplayModeChanged)
+    self.displayModeCloudRadioButton.connect("clicked(bool)", self.onDisplayModeChanged)
+    self.cloudParamComboBox.connect('currentIndexChanged(int)', self.onCloudParamChanged)
+
 
     ## Trigger
     #if sum(self.trigger.values()) > 1: # If there is a choice for trigger
@@ -155,6 +180,24 @@ class QPointRecordingFrame(QFrame):
 
     pointLayout.addRow("Min. Distance: ",  self.pointRecordingDistanceSliderWidget)
 
+    # Voxel-based deduplication
+    self.pointRecordingVoxelSizeSliderWidget = ctk.ctkSliderWidget()
+    self.pointRecordingVoxelSizeSliderWidget.singleStep = 0.1
+    self.pointRecordingVoxelSizeSliderWidget.minimum = 0.0
+    self.pointRecordingVoxelSizeSliderWidget.maximum = 20.0
+    self.pointRecordingVoxelSizeSliderWidget.value = 0.0
+    self.pointRecordingVoxelSizeSliderWidget.setToolTip("Size of the voxels to keep only one point per voxel. If 0, all points are recorded.")
+
+    pointLayout.addRow("Voxel Size: ",  self.pointRecordingVoxelSizeSliderWidget)
+
+    self.pointRecordingVoxelModeComboBox = qt.QComboBox()
+    self.pointRecordingVoxelModeComboBox.addItem('Latest', 'latest')
+    self.pointRecordingVoxelModeComboBox.addItem('Mean', 'mean')
+    self.pointRecordingVoxelModeComboBox.addItem('Max Voltage', 'max')
+    self.pointRecordingVoxelModeComboBox.setToolTip("Point kept in each voxel.")
+
+    pointLayout.addRow("Voxel Mode: ",  self.pointRecordingVoxelModeComboBox)
+
     activeBoxLayout = qt.QHBoxLayout()
     self.activeGroup = qt.QButtonGroup()
     self.activeOnRadioButton = qt.QRadioButton("ON")
@@ -168,6 +211,8 @@ class QPointRecordingFrame(QFrame):
     pointLayout.addRow("Active: ", activeBoxLayout)
 
     self.pointRecordingDistanceSliderWidget.connect("valueChanged(double)", self.pointRecordingDistanceChanged)
+    self.pointRecordingVoxelSizeSliderWidget.connect("valueChanged(double)", self.pointRecordingVoxelChanged)
+    self.pointRecordingVoxelModeComboBox.connect('currentIndexChanged(int)', self.pointRecordingVoxelChanged)
     self.activeOnRadioButton.connect('clicked(bool)', self.onActive)
     self.activeOffRadioButton.connect('clicked(bool)', self.onActive)
 
@@ -196,8 +241,27 @@ class QPointRecordingFrame(QFrame):
     
     pointLayout.addRow("", buttonBoxLayout)
 
+    # Point set file
+    fileBoxLayout = qt.QHBoxLayout()
+
+    self.exportButton = qt.QPushButton()
+    self.exportButton.setCheckable(False)
+    self.exportButton.text = 'Export'
+    self.exportButton.setToolTip("Save the recorded points and egram parameters as a point set file (.npy).")
+    fileBoxLayout.addWidget(self.exportButton)
+
+    self.importButton = qt.QPushButton()
+    self.importButton.setCheckable(False)
+    self.importButton.text = 'Import'
+    self.importButton.setToolTip("Replace the recorded points with a point set file (.npy).")
+    fileBoxLayout.addWidget(self.importButton)
+
+    pointLayout.addRow("Point Set: ", fileBoxLayout)
+
     self.collectButton.connect(qt.SIGNAL("clicked()"), self.onCollectPoints)
     self.clearButton.connect(qt.SIGNAL("clicked()"), self.onClearPoints)
+    self.exportButton.connect(qt.SIGNAL("clicked()"), self.onExportPoints)
+    self.importButton.connect(qt.SIGNAL("clicked()"), self.onImportPoints)
 
   def onActive(self):
     td = self.catheter = self.catheterComboBox.getCurrentCatheter()
@@ -319,6 +383,7 @@ class QPointRecordingFrame(QFrame):
 
     for pos in positions:
       fNode.AddFiducial(pos[0], pos[1], pos[2])
+    self.updatePointCloud()
     
 
   def onClearPoints(self):
@@ -328,8 +393,43 @@ class QPointRecordingFrame(QFrame):
       fNode.RemoveAllMarkups()
       # Note: RemoveAllMarkups() does not invoke a PointModifiedEvent
       fNode.InvokeEvent(slicer.vtkMRMLMarkupsNode.PointModifiedEvent)
+      self.updatePointCloud(full=True)
       
 
+
+  def onExportPoints(self):
+
+    fNode = self.recordPointsSelector.currentNode()
+    if fNode == None:
+      return
+
+    filename = qt.QFileDialog.getSaveFileName(None, 'Export Point Set', '', 'Point set (*.npy)')
+    if filename:
+      try:
+        n = exportPointSet(fNode, filename)
+      except ValueError as e:
+        print('Error: Could not export the points: %s' % str(e))
+        return
+      print('Exported %d points to %s' % (n, filename))
+
+
+  def onImportPoints(self):
+
+    fNode = self.recordPointsSelector.currentNode()
+    if fNode == None:
+      return
+
+    filename = qt.QFileDialog.getOpenFileName(None, 'Import Point Set', '', 'Point set (*.npy)')
+    if filename:
+      try:
+        n = importPointSet(fNode, filename)
+      except ValueError as e:
+        print('Error: Could not import the points: %s' % str(e))
+        return
+      fNode.InvokeEvent(slicer.vtkMRMLMarkupsNode.PointModifiedEvent)
+      self.updatePointCloud(full=True)
+      print('Imported %d points from %s' % (n, filename))
+
       
   def onVisibilityChanged(self):
 
@@ -341,11 +441,77 @@ class QPointRecordingFrame(QFrame):
     fNode = self.recordPointsSelector.currentNode()
     
     if fNode:
-      dnode = fNode.GetDisplayNode()
-      dnode.SetVisibility(self.fiducialsVisible)
+      if self.displayModeCloudRadioButton.checked:
+        getRecordedPointCloud(fNode).setVisible(self.fiducialsVisible)
+        fNode.GetDisplayNode().SetVisibility(False)
+      else:
+        dnode = fNode.GetDisplayNode()
+        dnode.SetVisibility(self.fiducialsVisible)
 
     # TODO: Update the radio button, when the recordpointselector is updated.
 
+
+  def onDisplayModeChanged(self):
+
+    fNode = self.recordPointsSelector.currentNode()
+    if fNode == None:
+      return
+
+    visible = self.visibilityOnRadioButton.checked
+    cloud = getRecordedPointCloud(fNode)
+    if self.displayModeCloudRadioButton.checked:
+      cloud.setVisible(visible)
+      self.updateCloudParamComboBox()
+    else:
+      cloud.setVisible(False)
+      fNode.GetDisplayNode().SetVisibility(visible)
+
+
+  def onCloudParamChanged(self):
+
+    fNode = self.recordPointsSelector.currentNode()
+    if fNode == None:
+      return
+
+    param = None
+    if self.cloudParamComboBox.currentIndex > 0:   # The first item is 'None'
+      param = self.cloudParamComboBox.currentText
+    getRecordedPointCloud(fNode).setScalarParameter(param)
+
+
+  def updateCloudParamComboBox(self):
+
+    fNode = self.recordPointsSelector.currentNode()
+    if fNode == None:
+      return
+
+    paramList = getEgramTable(fNode).getParameterNames()
+    if paramList == [self.cloudParamComboBox.itemText(i) for i in range(1, self.cloudParamComboBox.count)]:
+      return
+    current = self.cloudParamComboBox.currentText
+    self.cloudParamComboBox.blockSignals(True)
+    self.cloudParamComboBox.clear()
+    self.cloudParamComboBox.addItem('None')
+    for p in paramList:
+      self.cloudParamComboBox.addItem(p)
+    i = self.cloudParamComboBox.findText(current)
+    self.cloudParamComboBox.setCurrentIndex(max(i, 0))
+    self.cloudParamComboBox.blockSignals(False)
+    self.onCloudParamChanged()
+
+
+  def updatePointCloud(self, full=False):
+    # Update the point cloud for the points added outside Catheter.recordPoints() (e.g., manual
+    # collection and import).
+
+    fNode = self.recordPointsSelector.currentNode()
+    if fNode == None or not self.displayModeCloudRadioButton.checked:
+      return
+    cloud = getRecordedPointCloud(fNode)
+    if cloud.isVisible():
+      cloud.update(full)
+      self.updateCloudParamComboBox()
+
     
   def onRecordPointsSelected(self):
     
@@ -378,6 +544,9 @@ class QPointRecordingFrame(QFrame):
           fNode.SetAndObserveDisplayNodeID(fdnode.GetID())
         if fNode:
           fdnode.SetTextScale(0.0)  # Hide the label
+
+      if self.displayModeCloudRadioButton.checked:
+        self.onDisplayModeChanged()
       
       
   def recordPointsUpdated(self,caller,event):
@@ -385,6 +554,8 @@ class QPointRecordingFrame(QFrame):
       fNode = slicer.mrmlScene.GetNodeByID(self.recordPointsNodeID)
       nPoints = fNode.GetNumberOfFiducials()
       self.printNumPoints(nPoints)
+      if self.displayModeCloudRadioButton.checked:
+        self.updateCloudParamComboBox()
 
       
   def printNumPoints(self, n):
@@ -401,6 +572,15 @@ class QPointRecordingFrame(QFrame):
       return
     catheter.pointRecordingDistance = d
 
+
+  def pointRecordingVoxelChanged(self):
+    catheter = self.catheterComboBox.getCurrentCatheter()
+    if catheter == None:
+      return
+    catheter.pointRecordingFilter.setCellSize(self.pointRecordingVoxelSizeSliderWidget.value)
+    catheter.pointRecordingFilter.setMode(self.pointRecordingVoxelModeComboBox.currentData)
+    self.updatePointCloud(full=True)
+
     
   def controlPointsNodeUpdated(self,caller,event):
     td = self.catheterComboBox.getCurrentCatheter()
@@ -0,0 +1,168 @@
+import numpy
+from MRTrackingUtils.pointindex import *
+from MRTrackingUtils.egramtable import *
+
+#------------------------------------------------------------
+#
+# VoxelRecordingFilter class
+#
+
+class VoxelRecordingFilter():
+
+  # VoxelRecordingFilter keeps at most one recorded point per cell of a uniform grid (voxel hash).
+  # When a new point falls in a cell that already has a point, the control point of the cell is
+  # updated in place instead of adding a new one. The representative of each cell is determined by
+  # 'mode':
+  #
+  #   'latest' : The latest point and its egram parameters
+  #   'mean'   : The running mean of the positions and the egram parameters
+  #   'max'    : The point with the largest value of the egram parameter 'voltageParam'
+  #
+  # The number of control points in the markups node is bounded by the number of occupied cells.
+  # The filter is disabled if 'cellSize' is 0.
+
+  def __init__(self, cellSize=0.0, mode='latest', voltageParam='Max(mV)'):
+
+    self.cellSize = cellSize
+    self.mode = mode
+    self.voltageParam = voltageParam
+    self.reset()
+
+
+  def reset(self):
+
+    self.markupsNodeID = None
+    self.nControlPoints = 0    # Number of control points in the node after the last update
+    self.cells = {}            # (i, j, k) -> slot
+    self.nSlots = 0
+    self.controlPointIndices = numpy.zeros(0, dtype=int)
+    self.counts = numpy.zeros(0, dtype=int)
+    self.positions = numpy.zeros((0,3))
+    self.values = numpy.zeros((0,0))
+    self.modifiedIds = numpy.zeros(0, dtype=int)  # Control points updated in place by the last record()
+
+
+  def isEnabled(self):
+
+    return self.cellSize > 0.0
+
+
+  def setCellSize(self, cellSize):
+
+    if cellSize != self.cellSize:
+      self.cellSize = cellSize
+      self.reset()
+
+
+  def setMode(self, mode):
+
+    if mode != self.mode:
+      self.mode = mode
+      self.reset()
+
+
+  def reserve(self, nSlots, nParams):
+    # Grow the arrays geometrically, and resize the egram parameter array if the number of
+    # parameters has been changed.
+
+    capacity = len(self.counts)
+    if nSlots > capacity:
+      capacity = max(nSlots, 2 * capacity, 256)
+      self.controlPointIndices = numpy.resize(self.controlPointIndices, capacity)
+      self.counts = numpy.resize(self.counts, capacity)
+      positions = numpy.zeros((capacity, 3))
+      positions[:self.nSlots] = self.positions[:self.nSlots]
+      self.positions = positions
+    if self.values.shape[0] != capacity or self.values.shape[1] != nParams:
+      values = numpy.zeros((capacity, nParams))
+      n = min(nParams, self.values.shape[1])
+      values[:self.nSlots,:n] = self.values[:self.nSlots,:n]
+      self.values = values
+
+
+  def allocateSlot(self):
+
+    slot = self.nSlots
+    self.nSlots = self.nSlots + 1
+    return slot
+
+
+  def record(self, markupsNode, points, values, header):
+    #
+    # Record (n, 3) 'points' with (n, m) egram 'values' in 'markupsNode'. 'header' is the list of the
+    # egram parameter names. Returns the number of control points added to the node.
+    #
+
+    # Start over if the node has been switched or edited outside the filter.
+    if markupsNode.GetID() != self.markupsNodeID or markupsNode.GetNumberOfControlPoints() != self.nControlPoints:
+      self.reset()
+      self.markupsNodeID = markupsNode.GetID()
+      self.nControlPoints = markupsNode.GetNumberOfControlPoints()
+
+    points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+    values = numpy.asarray(values, dtype=float)
+    if values.ndim != 2 or values.shape[0] < points.shape[0]:
+      values = numpy.zeros((points.shape[0], 0))
+    values = values[:points.shape[0]]
+    nParams = values.shape[1]
+    self.reserve(self.nSlots + points.shape[0], nParams)
+    voltageIndex = 0
+    if header and self.voltageParam in header:
+      voltageIndex = list(header).index(self.voltageParam)
+
+    # The point index shared with the other modules is updated in place for the modified points.
+    index = recordedPointIndices.get(self.markupsNodeID)
+
+    # Slots of the control points added or modified; their egram parameters are written to the
+    # egram table at the end.
+    modifiedSlots = []
+
+    nAdded = 0
+    keys = numpy.floor(points / self.cellSize).astype(numpy.int64)
+    for i in range(points.shape[0]):
+      key = tuple(keys[i])
+      slot = self.cells.get(key)
+
+      if slot == None:
+        slot = self.allocateSlot()
+        self.cells[key] = slot
+        self.counts[slot] = 1
+        self.positions[slot] = points[i]
+        self.values[slot] = values[i]
+        id = markupsNode.AddFiducial(points[i,0], points[i,1], points[i,2])
+        self.controlPointIndices[slot] = id
+        modifiedSlots.append(slot)
+        nAdded = nAdded + 1
+        continue
+
+      self.counts[slot] = self.counts[slot] + 1
+      if self.mode == 'mean':
+        w = 1.0 / self.counts[slot]
+        self.positions[slot] = self.positions[slot] + w * (points[i] - self.positions[slot])
+        self.values[slot] = self.values[slot] + w * (values[i] - self.values[slot])
+      elif self.mode == 'max':
+        if nParams == 0 or values[i,voltageIndex] <= self.values[slot,voltageIndex]:
+          continue
+        self.positions[slot] = points[i]
+        self.values[slot] = values[i]
+      else: # 'latest'
+        self.positions[slot] = points[i]
+        self.values[slot] = values[i]
+
+      id = int(self.controlPointIndices[slot])
+      p = self.positions[slot]
+      markupsNode.SetNthControlPointPosition(id, p[0], p[1], p[2])
+      modifiedSlots.append(slot)
+      if index and id < index.getNumberOfPoints():
+        index.setPoint(id, p)
+
+    slots = numpy.array(modifiedSlots, dtype=int)
+    if header and nParams > 0 and len(slots) > 0:
+      getEgramTable(markupsNode).setValues(self.controlPointIndices[slots], self.values[slots], list(header)[:nParams])
+
+    # The control points existing before this call and updated in place
+    ids = numpy.unique(self.controlPointIndices[slots])
+    self.modifiedIds = ids[ids < self.nControlPoints]
+
+    self.nControlPoints = markupsNode.GetNumberOfControlPoints()
+    return nAdded
@@ -5,7 +5,13 @@ import vtk
 import functools
 import time
 import numpy
+from vtk.util import numpy_support
 from MRTrackingUtils.qcomboboxcatheter import *
+from MRTrackingUtils.registrationbuffer import *
+from MRTrackingUtils.registrationsolver import *
+from MRTrackingUtils.distortion import *
+from MRTrackingUtils.trackinghistory import *
+from MRTrackingUtils.combinedtracking import *
 
 #------------------------------------------------------------
 #
@@ -27,20 +33,57 @@ class MRTrackingFiducialRegistration():
     # Transformation
     self.registrationTransformNode = None
     self.registrationTransform = None
+    self.linearTransform = vtk.vtkTransform()           # Reused for rigid/similarity/affine registration
+    self.linearTransformMatrix = vtk.vtkMatrix4x4()
+    self.registrationMatrix = None                      # 4x4 NumPy array for the linear registration
+    self.tpsWarp = ThinPlateSplineWarp()                # NumPy thin plate spline for the spline registration
+    self.tpsTransform = None                            # vtkThinPlateSplineTransform for the transform node
+    self.tpsTransformMTime = -1
+    self.tpsLandmarkSpacing = 5.0                       # mm; landmarks closer than this are merged.
     self.applyTransform = None # Specifiy the data node under the transform -- TODO: Will be obsolete. Use 'transformedCatheter'
     self.transformedCatheter = None # Specifiy a Catheter class instance to which the registration transform is applied. (Replaces self.applyTransform)
     
-    self.sizeCircularBuffer = 24 # 8 time points x 3 (x, y, z) = 24
-    self.pCircularBuffer = 0
+    self.sizeCircularBuffer = 240    # Pairs of points; the pairs of each collection are decimated (see 'bufferSpacing')
+    self.bufferSpacing = 2.0         # mm; the pairs of one collection closer than this are merged in the buffer.
+
+    # Registration points
+    # The pairs of points are kept in a ring buffer (RegistrationPointBuffer). The fiducial nodes
+    # are only used to visualize the points, and updated at most every 'visualizationInterval' seconds.
+    self.pointBuffer = RegistrationPointBuffer(self.sizeCircularBuffer)
+    self.visualizationInterval = 1.0 # seconds
+    self.prevVisualizationTime = 0.0
+    self.prevVisualizationMTime = -1
+
+    # If 'manualFiducials' is True, the points in the fiducial nodes have been given by the user
+    # (i.e., selected after loading from a file, or placed manually after clearing the points), and
+    # are used for registration when the buffer is empty. Otherwise, the fiducial nodes only hold
+    # copies of the buffer, which may be stale.
+    self.manualFiducials = False
+
+    # Recursive estimation
+    # If 'recursiveEstimation' is True, the rigid/similarity/affine transforms are estimated recursively
+    # from exponentially time-decayed statistics of the pairs, instead of the points in the buffer.
+    self.recursiveEstimation = False
+    self.decayTime = 30.0            # seconds
+    self.estimator = RecursiveRegistrationEstimator(self.decayTime)
+
+    # Robust estimation
+    # If 'robustEstimation' is True, the pairs with residuals larger than 'inlierThreshold' are
+    # excluded from registration as outliers.
+    self.robustEstimation = False
+    self.inlierThreshold = 5.0       # mm
+
+    # Distortion correction
+    self.distortionGridSpacing = 10.0 # mm
 
     ## For automatic registration update
     self.autoUpdate = False
     self.prevNCoilsTo = 0
     self.prevNCoilsFrom = 0
     self.prevCollectionTime = 0.0
+    self.prevPairingTime = 0.0       # Time stamp of the last sample examined for pairing
 
     self.minNumFiducials = 10
-    self.maxNumFiducials = 100
 
     self.catheters = None            # CatheterCollection
 
@@ -52,6 +95,7 @@ class MRTrackingFiducialRegistration():
     self.pointExpiration = 30.0      # seconds
 
     self.combineTracking = False
+    self.combinedTracking = CombinedTracking()   # Fuses the coils of 'from' and 'to' into one tracking data node
     
     
   def setCatheterCollection(self, cath):
@@ -145,11 +189,14 @@ class MRTrackingFiducialRegistration():
     transTypeBoxLayout = qt.QHBoxLayout()
     self.transTypeGroup = qt.QButtonGroup()
     self.rigidTypeRadioButton = qt.QRadioButton("Rigid")
+    self.similarityTypeRadioButton = qt.QRadioButton("Similarity")
     self.affineTypeRadioButton = qt.QRadioButton("Affine")
     self.splineTypeRadioButton = qt.QRadioButton("Thin Plate Spline")
     self.rigidTypeRadioButton.checked = 1
     transTypeBoxLayout.addWidget(self.rigidTypeRadioButton)
     self.transTypeGroup.addButton(self.rigidTypeRadioButton)
+    transTypeBoxLayout.addWidget(self.similarityTypeRadioButton)
+    self.transTypeGroup.addButton(self.similarityTypeRadioButton)
     transTypeBoxLayout.addWidget(self.affineTypeRadioButton)
     self.transTypeGroup.addButton(self.affineTypeRadioButton)
     transTypeBoxLayout.addWidget(self.splineTypeRadioButton)
@@ -173,6 +220,57 @@ class MRTrackingFiducialRegistration():
 
     registrationLayout.addRow("Automatic Update: ", autoUpdateBoxLayout)
 
+    #
+    # Estimation (batch or recursive)
+    #
+
+    estimationBoxLayout = qt.QHBoxLayout()
+    self.estimationGroup = qt.QButtonGroup()
+    self.estimationBatchRadioButton = qt.QRadioButton("Batch")
+    self.estimationRecursiveRadioButton = qt.QRadioButton("Recursive")
+    self.estimationBatchRadioButton.checked = 1
+    self.estimationRecursiveRadioButton.setToolTip("Update the rigid/similarity/affine transform recursively with time-decayed weights for the points.")
+    estimationBoxLayout.addWidget(self.estimationBatchRadioButton)
+    self.estimationGroup.addButton(self.estimationBatchRadioButton)
+    estimationBoxLayout.addWidget(self.estimationRecursiveRadioButton)
+    self.estimationGroup.addButton(self.estimationRecursiveRadioButton)
+
+    registrationLayout.addRow("Estimation: ", estimationBoxLayout)
+
+    #
+    # Robust estimation (outlier rejection)
+    #
+
+    robustBoxLayout = qt.QHBoxLayout()
+    self.robustGroup = qt.QButtonGroup()
+    self.robustOnRadioButton = qt.QRadioButton("ON")
+    self.robustOffRadioButton = qt.QRadioButton("OFF")
+    self.robustOffRadioButton.checked = 1
+    self.robustOnRadioButton.setToolTip("Reject outliers by RANSAC. In the recursive estimation, new pairs with large residuals are not used.")
+    robustBoxLayout.addWidget(self.robustOnRadioButton)
+    self.robustGroup.addButton(self.robustOnRadioButton)
+    robustBoxLayout.addWidget(self.robustOffRadioButton)
+    self.robustGroup.addButton(self.robustOffRadioButton)
+
+    registrationLayout.addRow("Outlier Rejection: ", robustBoxLayout)
+
+    self.inlierThresholdSliderWidget = ctk.ctkSliderWidget()
+    self.inlierThresholdSliderWidget.singleStep = 0.1
+    self.inlierThresholdSliderWidget.minimum = 0.1
+    self.inlierThresholdSliderWidget.maximum = 50.0
+    self.inlierThresholdSliderWidget.value = self.inlierThreshold
+    self.inlierThresholdSliderWidget.setToolTip("Maximum residual (mm) for a pair of points to be considered as an inlier.")
+    registrationLayout.addRow("Inlier Threshold (mm): ",  self.inlierThresholdSliderWidget)
+
+    # Landmark spacing for thin plate spline
+    self.tpsLandmarkSpacingSliderWidget = ctk.ctkSliderWidget()
+    self.tpsLandmarkSpacingSliderWidget.singleStep = 0.5
+    self.tpsLandmarkSpacingSliderWidget.minimum = 0.0
+    self.tpsLandmarkSpacingSliderWidget.maximum = 50.0
+    self.tpsLandmarkSpacingSliderWidget.value = self.tpsLandmarkSpacing
+    self.tpsLandmarkSpacingSliderWidget.setToolTip("Landmarks for thin plate spline within a voxel of this size are merged. (0: no decimation)")
+    registrationLayout.addRow("TPS Landmark Spacing (mm): ",  self.tpsLandmarkSpacingSliderWidget)
+
     #
     # Overwrite Transform
     #
@@ -220,6 +318,15 @@ class MRTrackingFiducialRegistration():
     self.pointExpirationSliderWidget.value = self.pointExpiration
     #self.minIntervalSliderWidget.setToolTip("")
     registrationLayout.addRow("Point Exp. (s): ",  self.pointExpirationSliderWidget)
+
+    # Time constant for the recursive estimation
+    self.decayTimeSliderWidget = ctk.ctkSliderWidget()
+    self.decayTimeSliderWidget.singleStep = 1.0
+    self.decayTimeSliderWidget.minimum = 1.0
+    self.decayTimeSliderWidget.maximum = 1000.0
+    self.decayTimeSliderWidget.value = self.decayTime
+    self.decayTimeSliderWidget.setToolTip("Time constant for the weights of the points in the recursive estimation.")
+    registrationLayout.addRow("Decay Time (s): ",  self.decayTimeSliderWidget)
     
     #
     # Collect/Clear button
@@ -280,6 +387,62 @@ class MRTrackingFiducialRegistration():
     
     registrationLayout.addRow("FRE (mm): ", self.freLineEdit)
 
+    self.inlierLineEdit = qt.QLineEdit()
+    self.inlierLineEdit.text = '--'
+    self.inlierLineEdit.readOnly = True
+    self.inlierLineEdit.frame = True
+    self.inlierLineEdit.styleSheet = "QLineEdit { background:transparent; }"
+    self.inlierLineEdit.setToolTip("Number of inliers / points, and the residuals. The outliers are shown as unselected points in the fiducials.")
+
+    registrationLayout.addRow("Inliers: ", self.inlierLineEdit)
+
+    #
+    # Distortion correction
+    #
+
+    distortionBoxLayout = qt.QHBoxLayout()
+    self.distortionGroup = qt.QButtonGroup()
+    self.distortionOnRadioButton = qt.QRadioButton("ON")
+    self.distortionOffRadioButton = qt.QRadioButton("OFF")
+    self.distortionOffRadioButton.checked = 1
+    self.distortionOnRadioButton.setToolTip("Correct the registered coil positions of the 'From' catheter with the distortion grid.")
+    distortionBoxLayout.addWidget(self.distortionOnRadioButton)
+    self.distortionGroup.addButton(self.distortionOnRadioButton)
+    distortionBoxLayout.addWidget(self.distortionOffRadioButton)
+    self.distortionGroup.addButton(self.distortionOffRadioButton)
+
+    registrationLayout.addRow("Distortion Correction: ", distortionBoxLayout)
+
+    self.distortionGridSpacingSliderWidget = ctk.ctkSliderWidget()
+    self.distortionGridSpacingSliderWidget.singleStep = 1.0
+    self.distortionGridSpacingSliderWidget.minimum = 1.0
+    self.distortionGridSpacingSliderWidget.maximum = 50.0
+    self.distortionGridSpacingSliderWidget.value = self.distortionGridSpacing
+    self.distortionGridSpacingSliderWidget.setToolTip("Spacing of the distortion grid built from the registration residuals.")
+    registrationLayout.addRow("Grid Spacing (mm): ",  self.distortionGridSpacingSliderWidget)
+
+    distortionButtonBoxLayout = qt.QHBoxLayout()
+
+    self.buildDistortionButton = qt.QPushButton()
+    self.buildDistortionButton.setCheckable(False)
+    self.buildDistortionButton.text = 'Build from Residuals'
+    self.buildDistortionButton.setToolTip("Build the distortion grid from the residuals of the current registration.")
+    distortionButtonBoxLayout.addWidget(self.buildDistortionButton)
+
+    self.loadDistortionButton = qt.QPushButton()
+    self.loadDistortionButton.setCheckable(False)
+    self.loadDistortionButton.text = 'Load'
+    self.loadDistortionButton.setToolTip("Load a distortion grid (.npz) or a grid transform file.")
+    distortionButtonBoxLayout.addWidget(self.loadDistortionButton)
+
+    self.saveDistortionButton = qt.QPushButton()
+    self.saveDistortionButton.setCheckable(False)
+    self.saveDistortionButton.text = 'Save'
+    self.saveDistortionButton.setToolTip("Save the distortion grid (.npz).")
+    distortionButtonBoxLayout.addWidget(self.saveDistortionButton)
+
+    registrationLayout.addRow("", distortionButtonBoxLayout)
+
     #
     # Combined tracking
     #
@@ -311,10 +474,23 @@ class MRTrackingFiducialRegistration():
     self.applyTransformOffRadioButton.connect("clicked(bool)", self.onApplyTransformChanged)
     self.autoUpdateOnRadioButton.connect("clicked(bool)", self.onAutoUpdateChanged)
     self.autoUpdateOffRadioButton.connect("clicked(bool)", self.onAutoUpdateChanged)
+    self.estimationBatchRadioButton.connect("clicked(bool)", self.onEstimationChanged)
+    self.estimationRecursiveRadioButton.connect("clicked(bool)", self.onEstimationChanged)
+    self.robustOnRadioButton.connect("clicked(bool)", self.onEstimationChanged)
+    self.robustOffRadioButton.connect("clicked(bool)", self.onEstimationChanged)
+    self.inlierThresholdSliderWidget.connect("valueChanged(double)", self.onPointSelectionParametersChanged)
+    self.tpsLandmarkSpacingSliderWidget.connect("valueChanged(double)", self.onPointSelectionParametersChanged)
     self.maxTimeDifferenceSliderWidget.connect("valueChanged(double)", self.onPointSelectionParametersChanged)
     self.minIntervalSliderWidget.connect("valueChanged(double)", self.onPointSelectionParametersChanged)
     self.pointExpirationSliderWidget.connect("valueChanged(double)", self.onPointSelectionParametersChanged)
+    self.decayTimeSliderWidget.connect("valueChanged(double)", self.onPointSelectionParametersChanged)
     self.trackingDataSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onTrackingDataSelected)
+    self.distortionOnRadioButton.connect("clicked(bool)", self.onDistortionCorrectionChanged)
+    self.distortionOffRadioButton.connect("clicked(bool)", self.onDistortionCorrectionChanged)
+    self.distortionGridSpacingSliderWidget.connect("valueChanged(double)", self.onPointSelectionParametersChanged)
+    self.buildDistortionButton.connect(qt.SIGNAL("clicked()"), self.onBuildDistortionGrid)
+    self.loadDistortionButton.connect(qt.SIGNAL("clicked()"), self.onLoadDistortionGrid)
+    self.saveDistortionButton.connect(qt.SIGNAL("clicked()"), self.onSaveDistortionGrid)
 
 
   def onFromCatheterSelected(self):
@@ -325,6 +501,9 @@ class MRTrackingFiducialRegistration():
       return
 
     self.fromCatheter.registration = self
+    self.combinedTracking.setCatheters(self.fromCatheter, self.toCatheter)
+    self.pointBuffer.clear()
+    self.estimator.reset()
 
     # TODO: Should the catheter keep the fiducial node, or should the registration class (this class) manages
     # the fiducial nodes for both 'to' and 'from' catheters? Fiducials are always paired with 'to' catheter,
@@ -340,6 +519,7 @@ class MRTrackingFiducialRegistration():
     dnode.SetVisibility(self.fiducialsVisible)
     
     self.fromFiducialsSelector.setCurrentNode(fiducialsNode)
+    self.manualFiducials = False
 
     
   def onToCatheterSelected(self):
@@ -350,6 +530,9 @@ class MRTrackingFiducialRegistration():
       return
 
     self.toCatheter.registration = self
+    self.combinedTracking.setCatheters(self.fromCatheter, self.toCatheter)
+    self.pointBuffer.clear()
+    self.estimator.reset()
     
     fiducialsNode = self.toCatheter.getRegistrationFiducialNode()
     if fiducialsNode == None:
@@ -361,6 +544,7 @@ class MRTrackingFiducialRegistration():
     dnode.SetVisibility(self.fiducialsVisible)
 
     self.toFiducialsSelector.setCurrentNode(fiducialsNode)
+    self.manualFiducials = False
 
 
   def onFromFiducialsSelected(self):
@@ -372,6 +556,7 @@ class MRTrackingFiducialRegistration():
       dnode = fiducialsNode.GetDisplayNode()
       dnode.SetVisibility(self.fiducialsVisible)
       self.fromFiducialsSelector.setCurrentNode(fiducialsNode)
+      self.manualFiducials = True
     
       
   def onToFiducialsSelected(self):
@@ -383,6 +568,7 @@ class MRTrackingFiducialRegistration():
       dnode = fiducialsNode.GetDisplayNode()
       dnode.SetVisibility(self.fiducialsVisible)
       self.toFiducialsSelector.setCurrentNode(fiducialsNode)
+      self.manualFiducials = True
     
 
   def onCollectPoints(self, auto=False):
@@ -434,13 +620,8 @@ class MRTrackingFiducialRegistration():
       return
 
     ## Get TrackingData
-    coilPos0 = numpy.array(self.fromCatheter.coilPositions)
-    coilPos0.resize(8)
-    coilPos1 = numpy.array(self.toCatheter.coilPositions)
-    coilPos1.resize(8)
-    coilPos0 = coilPos0[self.fromCatheter.activeCoils] # Remove inactive coils
-    coilPos1 = coilPos1[self.toCatheter.activeCoils] # Remove inactive coils
-    # TODO: Catheter class should provide this feature
+    coilPos0 = self.fromCatheter.getActiveCoilDistances()
+    coilPos1 = self.toCatheter.getActiveCoilDistances()
 
     print('==== coils ====')
     print(coilPos0)
@@ -468,20 +649,6 @@ class MRTrackingFiducialRegistration():
     print(pointList0)
     print(pointList1)
 
-    # NOTE: Never use getInterpolatedFiducialPoints() with self.fromCatheter, because
-    #  getInterpolatedFiducialPoints() calculates interpolated points based on the curve length
-    #  in the post-registration coordinate system. This is not an issue when the function is called
-    #  from self.toCatheter, because self.toCatheter is never transformed after registration.
-    [pointList1Interp, pointMask1Interp] = self.toCatheter.getInterpolatedFiducialPoints(coilPos0)
-    
-    print('==== Interp reg points ====')
-    print(pointList1Interp)
-    print(pointMask1Interp)
-
-    if pointList1Interp == None:
-      print("Error: Could not estimate the fiducial points.")
-      return
-    
     # Check time stamp
     curve0Time = float(curve0Node.GetAttribute('MRTracking.lastTS'))
     curve1Time = float(curve1Node.GetAttribute('MRTracking.lastTS'))
@@ -495,150 +662,176 @@ class MRTrackingFiducialRegistration():
     if (timeElapsed0 < self.minInterval) and (timeElapsed1 < self.minInterval):
       return False
 
-    # Check if the acquisition time difference between the two curves are small enough
-    if abs(curve0Time - curve1Time) > self.maxTimeDifference:
+    # Pair the samples recorded in the tracking histories since the last collection. The catheter
+    # tracked at the lower rate is used as the reference, and the positions of the other catheter are
+    # interpolated at the time stamps of the reference samples. A pair is formed only if the two samples
+    # used for interpolation are at most 'maxTimeDifference' apart. All the pairs are added to the
+    # recursive estimator, whose time decay takes care of a static pose. The pairs added to the
+    # buffer are decimated spatially (see decimateLandmarks()), so that a nearly static pose does not
+    # overwrite the poses of the previous collections.
+    # The tracking histories must keep the samples of the interval between the collections.
+    for catheter in [self.fromCatheter, self.toCatheter]:
+      catheter.trackingHistory.setDuration(2.0 * self.minInterval)
+    (pairTimes, pairPoints0, pairPoints1, self.prevPairingTime) = pairTrackingSamples(self.fromCatheter.trackingHistory,
+                                                                                      self.toCatheter.trackingHistory,
+                                                                                      self.prevPairingTime,
+                                                                                      self.maxTimeDifference)
+    if len(pairTimes) == 0:
       return False
             
     self.prevCollectionTime = currentTime
-                                                
-    k = 0
-    trans = vtk.vtkMatrix4x4()
-    pos0 = [0.0] * 3
-    pos1 = [0.0] * 3
-
-    #nCoils0 = len(pointList0)
-    nPoints0 = len(pointMask1Interp)
-    nPoints1 = len(pointMask1Interp)
-    nPoints = min(nPoints0, nPoints1)
-    
-    for j in range(nPoints):
 
-      if pointMask1Interp[j] == False:
-        # Skip if the point is not valid.
+    mode = self.getTransformMode()
+    nAdded = 0
+    bufferFromPoints = []
+    bufferToPoints = []
+    for k in range(len(pairTimes)):
+      # The corresponding points on the 'to' catheter are interpolated along the curve through the
+      # coil positions at the time of the pair.
+      # NOTE: Never interpolate the points on self.fromCatheter using getInterpolatedFiducialPoints(),
+      #  which calculates interpolated points based on the curve length in the post-registration
+      #  coordinate system.
+      [toPointList, toPointMask] = self.toCatheter.getInterpolatedFiducialPointsFromCoils(pairPoints1[k], coilPos0)
+      if toPointList is None:
         continue
-      
-      #pos0 = pointList0[j].copy()
-      #pos1 = pointList1Interp[j].copy()
-      pos0 = pointList0[j]
-      pos1 = pointList1Interp[j]
-
-      # Record the coordinates
-      nCurve0 = curve0FiducialsNode.GetNumberOfFiducials()
-      
-      if nCurve0 > self.sizeCircularBuffer: # Overwrite a previous point.
-        # Note: Time stamp is recorded as a label.
-        curve0FiducialsNode.SetNthFiducialPosition(self.pCircularBuffer, pos0[0], pos0[1], pos0[2])
-        curve1FiducialsNode.SetNthFiducialPosition(self.pCircularBuffer, pos1[0], pos1[1], pos1[2])
-        curve0FiducialsNode.SetNthFiducialLabel(self.pCircularBuffer, str(curve0Time))
-        curve1FiducialsNode.SetNthFiducialLabel(self.pCircularBuffer, str(curve1Time))
-        self.pCircularBuffer = (self.pCircularBuffer + 1) % self.sizeCircularBuffer
-      else: # Add a new point
-        curve0FiducialsNode.AddFiducial(pos0[0], pos0[1], pos0[2], str(curve0Time))
-        curve1FiducialsNode.AddFiducial(pos1[0], pos1[1], pos1[2], str(curve1Time))
-
-      print('Add From (%f, %f, %f)' % (pos0[0], pos0[1], pos0[2]))
-      print('Add To (%f, %f, %f)' % (pos1[0], pos1[1], pos1[2]))
-
-      
-    # Combined tracking data
-    ctdnode = self.trackingDataSelector.currentNode()
-    
-    if ctdnode:
 
-      # Replace pointList0/pointList1 with coil points in the world coordinate system.
-      pointList0 = self.fromCatheter.getCoilPointsAlongCurve()
-      pointList1 = self.toCatheter.getCoilPointsAlongCurve()
-      
-      self.InitializeCombinedTrackingData(ctdnode)
-
-      # Create a list of tuples consisting of catheter index and coil position
-      # (e.g., [(0, 5), (0, 10), ..., (0, 40)])
-      coilList = []
-      
-      # Determine which tracking data is newer
-      if timeElapsed0 < timeElapsed1:
-
-        # Catheter 0 is up-to-date. We use pointList0 and pointList0Interp
-        [pointList0Interp, pointMask0Interp] = self.fromCatheter.getInterpolatedFiducialPoints(coilPos1, world=True)
-
-        n = min(len(pointList0), len(coilPos0))
-        for i in range(n):
-          cp = coilPos0[i]
-          point = pointList0[i]
-          coilList.append((cp, point))
-
-        n = min(len(pointList0Interp), len(coilPos1))
-        for i in range(n):
-          if pointMask0Interp[i]:
-            cp = coilPos1[i]
-            point = pointList0Interp[i]
-            coilList.append((cp, point))
-              
-      else:
-        # Catheter 1 is up-to-date. We use pointList1 and pointList1Interp
-        n = min(len(pointList1), len(coilPos1))
-        for i in range(n):
-          cp = coilPos1[i]
-          point = pointList1[i]
-          coilList.append((cp, point))
-
-        n = min(len(pointList1Interp), len(coilPos0))
-        for i in range(n):
-          if pointMask1Interp[i]:
-            cp = coilPos0[i]
-            point = pointList1Interp[i]
-            coilList.append((cp, point))
-
-      # Sort the list by coil position
-      coilList.sort(key=lambda v: v[0])
-
-      t = vtk.vtkMatrix4x4()
-      t.Identity()
-      for i in range(0, len(coilList)):
-        p = coilList[i][1]
-        t.SetElement(0, 3, p[0])
-        t.SetElement(1, 3, p[1])
-        t.SetElement(2, 3, p[2])
-        tnode = ctdnode.GetTransformNode(i)
-        tnode.SetMatrixTransformToParent(t)
-        
-      ctdnode.SetAttribute('MRTracking.lastIndex', str(len(coilList)-1))
+      # Record the coordinates of the valid pairs.
+      nPoints = min(pairPoints0.shape[1], len(toPointMask))
+      mask = toPointMask[:nPoints]
+      fromPointsNP = pairPoints0[k,:nPoints][mask]
+      toPointsNP = toPointList[:nPoints][mask]
+      bufferFromPoints.append(fromPointsNP)
+      bufferToPoints.append(toPointsNP)
+
+      # In the robust recursive estimation, the new pairs inconsistent with the current estimate
+      # are not added to the statistics.
+      if self.robustEstimation and mode != 'spline' and self.estimator.nPairs > self.minNumFiducials:
+        matrix = self.estimator.estimate(mode)
+        if matrix is not None:
+          residuals = calculateResiduals(transformPoints(matrix, fromPointsNP), toPointsNP)
+          inlierMask = residuals < self.inlierThreshold
+          fromPointsNP = fromPointsNP[inlierMask]
+          toPointsNP = toPointsNP[inlierMask]
+      self.estimator.add(fromPointsNP, toPointsNP, pairTimes[k])
+      nAdded = nAdded + fromPointsNP.shape[0]
+
+    nBuffered = 0
+    if len(bufferFromPoints) > 0:
+      (fromPointsNP, toPointsNP) = decimateLandmarks(numpy.concatenate(bufferFromPoints),
+                                                     numpy.concatenate(bufferToPoints), self.bufferSpacing)
+      self.pointBuffer.add(fromPointsNP, toPointsNP, pairTimes[-1])
+      nBuffered = fromPointsNP.shape[0]
+
+    print('Added %d pairs of points from %d samples (%d pairs to the buffer).' % (nAdded, len(pairTimes), nBuffered))
 
-      
     # Discard expired points
-    self.discardExpiredPoints(curve0FiducialsNode, curve1FiducialsNode, currentTime)
+    self.discardExpiredPoints(currentTime)
+
+    # Update the fiducial nodes. In the automatic mode, the update is throttled.
+    self.updateFiducialsVisualization(force=(not auto))
     
     # Check if it is ready for new registration
-    # TODO: Should we also check the number of fiducials for toFiducialsNode?
-    if curve0FiducialsNode.GetNumberOfFiducials() >  self.minNumFiducials:
+    if self.recursiveEstimation:
+      nPoints = self.estimator.nPairs
+    else:
+      nPoints = self.pointBuffer.getNumberOfPoints()
+    if nPoints >  self.minNumFiducials:
       return True
     else:
       return False
     
     
-  def discardExpiredPoints(self, fidNode0, fidNode1, currentTime):
-    
-    nCurve0 = fidNode0.GetNumberOfFiducials()
-    nCurve1 = fidNode1.GetNumberOfFiducials()
+  def discardExpiredPoints(self, currentTime):
 
-    if nCurve0 != nCurve1:
-      print('Error: the numbers of the fiducials for registration do not match')
-      return 0
+    nExpired = self.pointBuffer.discardExpired(currentTime, self.pointExpiration)
+    if nExpired > 0:
+      print('%d points have been expired.' % nExpired)
 
-    i = 0
-    while i < fidNode0.GetNumberOfFiducials():
-      ts0 = float(fidNode0.GetNthFiducialLabel(i))
-      ts1 = float(fidNode1.GetNthFiducialLabel(i))
-      if (currentTime - ts0 > self.pointExpiration) or (currentTime - ts1 > self.pointExpiration):
-        print('Point has been expired. ')
-        fidNode0.RemoveNthControlPoint(i)
-        fidNode1.RemoveNthControlPoint(i)
-      else:
-        i += 1
+      # The recursive estimate is built from the same pairs. Once all of them have expired,
+      # the statistics are reset so that stale pairs are not used for the registration.
+      if self.pointBuffer.getNumberOfPoints() == 0:
+        self.estimator.reset()
+
+
+  def updateFiducialsVisualization(self, force=False):
+    #
+    # Copy the points in the buffer to the fiducial nodes. Unless 'force' is True, the fiducial
+    # nodes are updated only when they are visible, and at most every 'visualizationInterval' seconds.
+    #
+
+    if self.pointBuffer.mTime == self.prevVisualizationMTime:
+      return
+
+    currentTime = time.time()
+    if not force:
+      if not self.fiducialsVisible:
+        return
+      if currentTime - self.prevVisualizationTime < self.visualizationInterval:
+        return
+
+    if self.fromCatheter == None or self.toCatheter == None:
+      return
+
+    fromFiducialsNode = self.fromCatheter.getRegistrationFiducialNode()
+    toFiducialsNode = self.toCatheter.getRegistrationFiducialNode()
+    if fromFiducialsNode == None or toFiducialsNode == None:
+      return
+
+    (fromPointsNP, toPointsNP, timeStamps, weights) = self.pointBuffer.getPoints()
+    slicer.util.updateMarkupsControlPointsFromArray(fromFiducialsNode, fromPointsNP)
+    slicer.util.updateMarkupsControlPointsFromArray(toFiducialsNode, toPointsNP)
+
+    # Show the outliers as unselected points
+    (residuals, inlierMask) = self.pointBuffer.getResiduals()
+    for node in [fromFiducialsNode, toFiducialsNode]:
+      prevState = node.StartModify()
+      for i in range(len(inlierMask)):
+        node.SetNthControlPointSelected(i, bool(inlierMask[i]))
+      node.EndModify(prevState)
+
+    self.prevVisualizationTime = currentTime
+    self.prevVisualizationMTime = self.pointBuffer.mTime
+    self.manualFiducials = False
+
+
+  def getRegistrationPoints(self):
+    #
+    # Returns the pairs of registration points as NumPy arrays (fromPoints, toPoints, weights).
+    # If no point has been collected in the buffer, the points in the fiducial nodes are used only
+    # if they have been given by the user (see 'manualFiducials'). The fiducial nodes updated from
+    # the buffer are not used, since they may still show the pairs that have already expired.
+    #
+
+    if self.pointBuffer.getNumberOfPoints() > 0:
+      (fromPointsNP, toPointsNP, timeStamps, weights) = self.pointBuffer.getPoints()
+      return (fromPointsNP, toPointsNP, weights)
+
+    if not self.manualFiducials:
+      print('Error: no registration point is available.')
+      return (None, None, None)
+
+    fromFiducialsNode = self.fromCatheter.getRegistrationFiducialNode()
+    toFiducialsNode = self.toCatheter.getRegistrationFiducialNode()
+
+    if fromFiducialsNode == None or toFiducialsNode == None:
+      print('Error: no fiducial point is available.')
+      return (None, None, None)
+
+    fromPointsNP = slicer.util.arrayFromMarkupsControlPoints(fromFiducialsNode)
+    toPointsNP = slicer.util.arrayFromMarkupsControlPoints(toFiducialsNode)
+
+    if fromPointsNP.shape[0] != toPointsNP.shape[0]:
+      print("ERROR: The numbers of fixed and moving landmarks do not match.")
+      return (None, None, None)
+
+    return (fromPointsNP, toPointsNP, numpy.ones(fromPointsNP.shape[0]))
 
         
   def onClearPoints(self):
 
+    self.pointBuffer.clear()
+    self.estimator.reset()
+
     fromFiducialsNode = self.fromCatheter.getRegistrationFiducialNode()
     toFiducialsNode = self.toCatheter.getRegistrationFiducialNode()
     
@@ -648,160 +841,173 @@ class MRTrackingFiducialRegistration():
     if toFiducialsNode:
       toFiducialsNode.RemoveAllMarkups()
 
-      
-  def onRunRegistration(self):
+    # The fiducial nodes are now empty. Points placed in them from now on are given by the user.
+    self.prevVisualizationMTime = self.pointBuffer.mTime
+    self.manualFiducials = True
 
-    fromFiducialsNode = self.fromCatheter.getRegistrationFiducialNode()
-    toFiducialsNode = self.toCatheter.getRegistrationFiducialNode()
-    
-    if fromFiducialsNode == None or toFiducialsNode == None:
-      print('Error: no fiducial point is available.')
-
-    ## Copy fiducials to vtkPoint
-    fromPoints = vtk.vtkPoints()
-    toPoints = vtk.vtkPoints()
-
-    nFrom = fromFiducialsNode.GetNumberOfFiducials()
-    nTo = toFiducialsNode.GetNumberOfFiducials()
+      
+  def onRunRegistration(self, auto=False):
 
-    if nFrom != nTo:
-      print("ERROR: The numbers of fixed and moving landmarks do not match.")
+    (fromPointsNP, toPointsNP, weights) = self.getRegistrationPoints()
+    if fromPointsNP is None:
       return
 
-    fromPoints.SetNumberOfPoints(nFrom)
-    toPoints.SetNumberOfPoints(nFrom)
+    # In the recursive estimation, the linear transforms are computed from the statistics kept in
+    # self.estimator. (Thin plate spline always uses the points in the buffer.)
+    fRecursive = self.recursiveEstimation and self.estimator.nPairs > 0
+    fFromBuffer = self.pointBuffer.getNumberOfPoints() > 0
 
-    for i in range(nFrom):
-      pos = [0.0]*3
-      fromFiducialsNode.GetNthFiducialPosition(i, pos)
-      fromPoints.SetPoint(i, pos)
-      toFiducialsNode.GetNthFiducialPosition(i, pos)
-      toPoints.SetPoint(i, pos)
+    # Check if we keep previous transform or overwrite. In the automatic update, the current
+    # transform node is always updated in place.
+    overwriteTransform = (self.overwriteTransformOnRadioButton.checked == 1) or auto
 
-    # Check if we keep previous transform or overwrite
-    overwriteTransform = self.overwriteTransformOnRadioButton.checked
-    classType = None
-    nodeName = None
-    if self.registrationTransformNode:
-      classType = self.registrationTransformNode.GetClassName()
-      nodeName = self.registrationTransformNode.GetName()
-      
-    # Rigid registration
-    if self.rigidTypeRadioButton.checked == 1:
-
-      if overwriteTransform == 1:
-        if classType != 'vtkMRMLLinearTransformNode' and nodeName != 'RegistrationTransform-Rigid':
-          try:
-            self.registrationTransformNode = slicer.util.getNode('RegistrationTransform-Rigid')
-          except slicer.util.MRMLNodeNotFoundException:
-            self.registrationTransformNode = None
+    mode = self.getTransformMode()
+    nPoints = fromPointsNP.shape[0]
+    if nPoints == 0:
+      print('Error: no fiducial point is available.')
+      return
+    inlierMask = numpy.ones(nPoints, dtype=bool)
+
+    # Rigid/similarity/affine registration
+    # The transforms are computed in closed form, and the matrix of the transform node is updated in place.
+    if mode != 'spline':
+      matrix = None
+      if fRecursive:
+        matrix = self.estimator.estimate(mode)
+      elif self.robustEstimation:
+        (matrix, inlierMask, residuals) = solveRobust(fromPointsNP, toPointsNP, mode, weights, self.inlierThreshold)
       else:
-        self.registrationTransformNode = None
-      
-      if self.registrationTransformNode == None:
-        # Create linear transform node to store the registration result
-        self.registrationTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode')
-        self.registrationTransformNode.SetName('RegistrationTransform-Rigid')
-
-      landmarkTransform = vtk.vtkLandmarkTransform()
-      landmarkTransform.SetSourceLandmarks(fromPoints)
-      landmarkTransform.SetTargetLandmarks(toPoints)
-      landmarkTransform.SetModeToRigidBody()
-      landmarkTransform.Update()
-
-      calculatedTransform = vtk.vtkMatrix4x4()
-      landmarkTransform.GetMatrix(calculatedTransform)
-      
-      self.registrationTransformNode.SetMatrixTransformToParent(calculatedTransform)
-      self.registrationTransform = landmarkTransform
+        matrix = solveLinear(fromPointsNP, toPointsNP, mode, weights)
+
+      if matrix is None:
+        print('Error: Could not compute the registration transform from %d points.' % nPoints)
+        return
+      self.setRegistrationTransformNode('vtkMRMLLinearTransformNode', 'RegistrationTransform-' + mode.capitalize(), overwriteTransform)
+      slicer.util.updateTransformMatrixFromArray(self.registrationTransformNode, matrix)
+      slicer.util.updateVTKMatrixFromArray(self.linearTransformMatrix, matrix)
+      self.linearTransform.SetMatrix(self.linearTransformMatrix)
+      self.registrationTransform = self.linearTransform
+      self.registrationMatrix = matrix
+      transformedFromPointsNP = transformPoints(matrix, fromPointsNP)
 
-    # Affine registration
-    if self.affineTypeRadioButton.checked == 1:
-      
-      if overwriteTransform == 1:
-        if classType != 'vtkMRMLLinearTransformNode' and nodeName != 'RegistrationTransform-Affine':
-          try:
-            self.registrationTransformNode = slicer.util.getNode('RegistrationTransform-Affine')
-          except slicer.util.MRMLNodeNotFoundException:
-            self.registrationTransformNode = None
-      else:
-        self.registrationTransformNode = None
-      
-      if self.registrationTransformNode == None:
-        # Create linear transform node to store the registration result
-        self.registrationTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode')
-        self.registrationTransformNode.SetName('RegistrationTransform-Affine')
-
-      landmarkTransform = vtk.vtkLandmarkTransform()
-      landmarkTransform.SetSourceLandmarks(fromPoints)
-      landmarkTransform.SetTargetLandmarks(toPoints)
-      landmarkTransform.SetModeToAffine()
-      landmarkTransform.Update()
-    
-      calculatedTransform = vtk.vtkMatrix4x4()
-      landmarkTransform.GetMatrix(calculatedTransform)
-      self.registrationTransformNode.SetMatrixTransformToParent(calculatedTransform)
-      self.registrationTransform = landmarkTransform
-      
     # Thin plate spline
-    if self.splineTypeRadioButton.checked == 1:
-
-      if overwriteTransform == 1:
-        if classType != 'vtkMRMLTransformNode' and nodeName != 'RegistrationTransform-Spline':
-          try:
-            self.registrationTransformNode = slicer.util.getNode('RegistrationTransform-Spline')
-          except slicer.util.MRMLNodeNotFoundException:
-            self.registrationTransformNode = None
-      else:
-        self.registrationTransformNode = None
-
-      if self.registrationTransformNode == None:
-        self.registrationTransformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode')
-        self.registrationTransformNode.SetName('RegistrationTransform-Spline')
-      
-      tpsTransform = vtk.vtkThinPlateSplineTransform()
-      tpsTransform.SetBasisToR()
+    else:
 
-      # Set inputs. Note that the source and target depend on how the registration transform is applied.
-      # If SetAndObserveTransformFromParent() is used, use 'to' as a source and 'from' as a target.
-      # If SetAndObserveTransformToParent() is used, use 'from' as a source and 'to' as a target.
-      #Note that 'from' points are set as targets unlike rigid/affine registration.
-      tpsTransform.SetSourceLandmarks(fromPoints)
-      tpsTransform.SetTargetLandmarks(toPoints)
-      tpsTransform.Update()
+      self.setRegistrationTransformNode('vtkMRMLTransformNode', 'RegistrationTransform-Spline', overwriteTransform)
+
+      # In the robust mode, the outliers are detected by robust affine registration, and excluded
+      # from the landmarks.
+      if self.robustEstimation:
+        (matrix, inlierMask, residuals) = solveRobust(fromPointsNP, toPointsNP, 'affine', weights, self.inlierThreshold)
+        if numpy.count_nonzero(inlierMask) < 4:
+          inlierMask = numpy.ones(nPoints, dtype=bool)
+
+      # Merge redundant landmarks, and solve the spline. If the landmarks have not been changed since
+      # the last registration, the cached weights are used.
+      (sourceLandmarks, targetLandmarks) = decimateLandmarks(fromPointsNP[inlierMask], toPointsNP[inlierMask], self.tpsLandmarkSpacing)
+      if not self.tpsWarp.fit(sourceLandmarks, targetLandmarks):
+        print('Error: Could not compute the thin plate spline from %d landmarks.' % sourceLandmarks.shape[0])
+        return
+
+      # The same landmarks are given to vtkThinPlateSplineTransform for the transform node. The catheter
+      # points are transformed by self.tpsWarp (see transformPointsNP()). If a new transform node is
+      # created, a new vtkThinPlateSplineTransform is also created for it.
+      if not overwriteTransform:
+        self.tpsTransform = None
+      if self.tpsTransform == None:
+        self.tpsTransformMTime = -1
+        self.tpsTransform = vtk.vtkThinPlateSplineTransform()
+        self.tpsTransform.SetBasisToR()
+
+      if self.tpsTransformMTime != self.tpsWarp.mTime:
+        fromPoints = vtk.vtkPoints()
+        toPoints = vtk.vtkPoints()
+        fromPoints.SetData(numpy_support.numpy_to_vtk(self.tpsWarp.sourceLandmarks, deep=True))
+        toPoints.SetData(numpy_support.numpy_to_vtk(self.tpsWarp.targetLandmarks, deep=True))
+
+        # Set inputs. Note that the source and target depend on how the registration transform is applied.
+        # If SetAndObserveTransformFromParent() is used, use 'to' as a source and 'from' as a target.
+        # If SetAndObserveTransformToParent() is used, use 'from' as a source and 'to' as a target.
+        #Note that 'from' points are set as targets unlike rigid/affine registration.
+        self.tpsTransform.SetSourceLandmarks(fromPoints)
+        self.tpsTransform.SetTargetLandmarks(toPoints)
+        self.tpsTransform.Modified()
+        self.tpsTransformMTime = self.tpsWarp.mTime
+
+      if self.registrationTransformNode.GetTransformToParent() != self.tpsTransform:
+        self.registrationTransformNode.SetAndObserveTransformToParent(self.tpsTransform)
+      self.registrationTransform = self.tpsTransform
+      self.registrationMatrix = None
+
+      transformedFromPointsNP = self.tpsWarp.evaluate(fromPointsNP)
 
-      self.registrationTransformNode.SetAndObserveTransformToParent(tpsTransform)
-      self.registrationTransform = tpsTransform
-    #
-    # TODO: The function create a new transform node instance (either vtkMRMLLinearTransformNode or
-    # vtkMRMLTransformNode) everytime called for the debugging purpose. It should clean up the old
-    # transform node after creating a new one.
-    #
-          
     #
     # Check registration error
+    # FRE is calculated from the inliers. The residuals for all the points are stored in the buffer
+    # to visualize the outliers.
     #
-    fre = self.CalculateRegistrationError(fromPoints, toPoints, self.registrationTransform)
-    print ("FRE: %.6f mm" % fre)
+    residuals = calculateResiduals(transformedFromPointsNP, toPointsNP)
+    if fFromBuffer:
+      self.pointBuffer.setResiduals(residuals, inlierMask)
+
+    fre = calculateFRE(transformedFromPointsNP[inlierMask], toPointsNP[inlierMask])
+    if not auto:
+      print ("FRE: %.6f mm" % fre)
     self.freLineEdit.text = "%.6f" % fre
-    
-    
-  def CalculateRegistrationError(self, fromPoints, toPoints, transform):
+    self.inlierLineEdit.text = "%d / %d (median: %.3f mm, max: %.3f mm)" % (numpy.count_nonzero(inlierMask), nPoints,
+                                                                            numpy.median(residuals), numpy.max(residuals))
+
+
+  def transformPointsNP(self, points):
+    # Transform an (n, 3) array of points by the current registration transform.
+
+    if self.registrationMatrix is not None:
+      return transformPoints(self.registrationMatrix, points)
+    elif self.registrationTransform == self.tpsTransform and self.tpsWarp.isValid():
+      return self.tpsWarp.evaluate(points)
+    return numpy.array(points)
+
 
-    # Transform the from points
-    transformedFromPoints = vtk.vtkPoints()
-    transform.TransformPoints(fromPoints, transformedFromPoints)
+  def getTransformMode(self):
+    # Returns 'rigid', 'similarity', 'affine' or 'spline' based on the selected transform type.
 
-    # Calculate the RMS distance between the to points and the transformed from points
-    sumSquaredError = 0
-    for i in range(toPoints.GetNumberOfPoints()):
-      currentToPoint = [0, 0, 0]
-      toPoints.GetPoint(i, currentToPoint)
-      currentTransformedFromPoint = [0, 0, 0];
-      transformedFromPoints.GetPoint(i, currentTransformedFromPoint)
-      sumSquaredError = sumSquaredError + vtk.vtkMath.Distance2BetweenPoints(currentToPoint, currentTransformedFromPoint)
+    if self.similarityTypeRadioButton.checked == 1:
+      return 'similarity'
+    elif self.affineTypeRadioButton.checked == 1:
+      return 'affine'
+    elif self.splineTypeRadioButton.checked == 1:
+      return 'spline'
+    return 'rigid'
 
-    return numpy.sqrt(sumSquaredError / toPoints.GetNumberOfPoints())
+
+  def setRegistrationTransformNode(self, className, nodeName, overwriteTransform):
+    #
+    # Set self.registrationTransformNode to store the registration result. If 'overwriteTransform' is
+    # True, the current node (or the node with the given name) is reused. Otherwise, a new node is created.
+    #
+    # TODO: If 'overwriteTransform' is False, the function creates a new transform node instance everytime
+    # called for the debugging purpose. It should clean up the old transform node after creating a new one.
+    #
+
+    classType = None
+    currentName = None
+    if self.registrationTransformNode:
+      classType = self.registrationTransformNode.GetClassName()
+      currentName = self.registrationTransformNode.GetName()
+
+    if overwriteTransform:
+      if classType != className and currentName != nodeName:
+        try:
+          self.registrationTransformNode = slicer.util.getNode(nodeName)
+        except slicer.util.MRMLNodeNotFoundException:
+          self.registrationTransformNode = None
+    else:
+      self.registrationTransformNode = None
+
+    if self.registrationTransformNode == None:
+      # Create a transform node to store the registration result
+      self.registrationTransformNode = slicer.mrmlScene.AddNewNodeByClass(className)
+      self.registrationTransformNode.SetName(nodeName)
 
     
   def onVisibilityChanged(self):
@@ -822,6 +1028,9 @@ class MRTrackingFiducialRegistration():
       dnode = toFiducialsNode.GetDisplayNode()
       dnode.SetVisibility(self.fiducialsVisible)
 
+    if self.fiducialsVisible:
+      self.updateFiducialsVisualization(force=True)
+
 
   def onApplyTransformChanged(self):
 
@@ -847,12 +1056,101 @@ class MRTrackingFiducialRegistration():
       self.autoUpdate = False
 
       
+  def onEstimationChanged(self):
+
+    if self.estimationRecursiveRadioButton.checked:
+      self.recursiveEstimation = True
+    else:
+      self.recursiveEstimation = False
+
+    if self.robustOnRadioButton.checked:
+      self.robustEstimation = True
+    else:
+      self.robustEstimation = False
+
+
   def onPointSelectionParametersChanged(self):
 
     # Make sure to convert from millisecond to second
     self.maxTimeDifference = self.maxTimeDifferenceSliderWidget.value / 1000.0
     self.minInterval = self.minIntervalSliderWidget.value / 1000.0
     self.pointExpiration = self.pointExpirationSliderWidget.value
+    self.decayTime = self.decayTimeSliderWidget.value
+    self.inlierThreshold = self.inlierThresholdSliderWidget.value
+    self.tpsLandmarkSpacing = self.tpsLandmarkSpacingSliderWidget.value
+    self.distortionGridSpacing = self.distortionGridSpacingSliderWidget.value
+    self.estimator.decayTime = self.decayTime
+
+
+  def onDistortionCorrectionChanged(self):
+
+    if self.fromCatheter == None:
+      return
+
+    self.fromCatheter.setDistortionCorrection(self.distortionOnRadioButton.checked == True)
+    self.fromCatheter.updateCatheterNode()
+
+
+  def onBuildDistortionGrid(self):
+    #
+    # Build a distortion grid for the 'From' catheter from the residuals of the current registration.
+    # The residuals are the displacements from the registered 'from' points to the 'to' points.
+    #
+
+    if self.fromCatheter == None or self.registrationTransform == None:
+      print('Error: Registration has not been performed.')
+      return
+
+    (fromPointsNP, toPointsNP, weights) = self.getRegistrationPoints()
+    if fromPointsNP is None or fromPointsNP.shape[0] == 0:
+      print('Error: No registration point is available.')
+      return
+
+    registeredPointsNP = self.transformPointsNP(fromPointsNP)
+
+    # Exclude the outliers detected in the last registration.
+    if self.pointBuffer.getNumberOfPoints() == fromPointsNP.shape[0]:
+      (residuals, inlierMask) = self.pointBuffer.getResiduals()
+      registeredPointsNP = registeredPointsNP[inlierMask]
+      toPointsNP = toPointsNP[inlierMask]
+
+    grid = DistortionGrid()
+    if grid.buildFromResiduals(registeredPointsNP, toPointsNP - registeredPointsNP, self.distortionGridSpacing):
+      self.fromCatheter.setDistortionGrid(grid)
+      print('Distortion grid: %s points' % str(grid.getDimensions()))
+
+
+  def onLoadDistortionGrid(self):
+
+    if self.fromCatheter == None:
+      return
+
+    filename = qt.QFileDialog.getOpenFileName(None, 'Load Distortion Grid', '', 'Distortion grid (*.npz);;Grid transform (*.nrrd *.nhdr *.mha *.nii *.nii.gz *.h5);;All files (*)')
+    if not filename:
+      return
+
+    grid = DistortionGrid()
+    if filename.endswith('.npz'):
+      fLoaded = grid.load(filename)
+    else:
+      gridTransformNode = slicer.util.loadTransform(filename)
+      fLoaded = (gridTransformNode != None) and grid.setFromGridTransformNode(gridTransformNode)
+
+    if fLoaded:
+      self.fromCatheter.setDistortionGrid(grid)
+    else:
+      print('Error: Could not load a distortion grid from %s' % filename)
+
+
+  def onSaveDistortionGrid(self):
+
+    if self.fromCatheter == None or not self.fromCatheter.distortionGrid.isValid():
+      print('Error: No distortion grid is available.')
+      return
+
+    filename = qt.QFileDialog.getSaveFileName(None, 'Save Distortion Grid', '', 'Distortion grid (*.npz)')
+    if filename:
+      self.fromCatheter.distortionGrid.save(filename)
 
 
   def onTrackingDataSelected(self):
@@ -860,6 +1158,7 @@ class MRTrackingFiducialRegistration():
     tdnode = self.trackingDataSelector.currentNode()
 
     # TODO: self.combineTracking may not be needed.
+    self.combinedTracking.setTrackingDataNode(tdnode)
     if tdnode == None:
       self.combineTracking = False
       return
@@ -869,51 +1168,17 @@ class MRTrackingFiducialRegistration():
       
   def updatePoints(self):
 
+    # The combined tracking data are updated at the tracking rate.
+    self.combinedTracking.update()
+
     if self.autoUpdate:
       r = self.onCollectPoints(True)
       if r:
-        self.onRunRegistration()
+        self.onRunRegistration(True)
         print("updatePoints(self): Running registration")
       else:
         #print("updatePoints(self): Skipping")
         pass
-      
-    
-  def InitializeCombinedTrackingData(self, ctdnode):
-    
-    if ctdnode == None:
-      return
-
-    #pointListFrom = self.fromCatheter.getFiducialPoints()
-    #pointListTo   = self.toCatheter.getFiducialPoints()
-    pointListFrom = self.fromCatheter.getCoilPointsAlongCurve()
-    pointListTo = self.toCatheter.getCoilPointsAlongCurve()
-    
-    # Make sure that the number of transforms under the combined tracking data node matches
-    # the total number of tracking coils. Note that not all the transforms will be used
-    # because the numbers of valid coils depends the fesibility of interpolation.
-    nTransforms =  ctdnode.GetNumberOfTransformNodes()
-    nCoilsFrom = len(pointListFrom)
-    nCoilsTo   = len(pointListTo)
-    nCoilsTotal = nCoilsFrom + nCoilsTo
-    
-    t = vtk.vtkMatrix4x4()
-    t.Identity()
-    
-    # NOTE: vtkMRMLIGTLTrackingDataBundleNode does not have a function to remove the transforms
-    # under the node. If the tracking data node has been previously used for other purposes, 
-    # the names of the child transforms might not match.
-
-    # We add child node, if the current number of child nodes are less than what we need.
-    # The newly added nodes have a name 'Combined-?' where '?' is an index.
-    if nTransforms < nCoilsTotal:
-      for i in range(nTransforms, nCoilsTotal):
-        ctdnode.UpdateTransformNode('Combined-' + str(i), t, 1)
-
-    # We cannot remove unused child nodes. To prevent the Catheter class to use the child tracking
-    # nodes that are not actively updated, we set the 'MRTracking.lastIndex' attribute.
-
-    ctdnode.SetAttribute('MRTracking.lastIndex', str(nCoilsTotal - 1))
     
 
 
@@ -0,0 +1,126 @@
+import numpy
+
+#------------------------------------------------------------
+#
+# RegistrationPointBuffer class
+#
+
+class RegistrationPointBuffer():
+
+  # RegistrationPointBuffer keeps pairs of corresponding points for point-based registration
+  # in a preallocated ring buffer. Each entry consists of:
+  #
+  #   fromPoints[i] : position on the 'from' catheter (x, y, z)
+  #   toPoints[i]   : position on the 'to' catheter (x, y, z)
+  #   timeStamps[i] : acquisition time (the older of the two tracking time stamps)
+  #   weights[i]    : weight used by the registration solver
+  #
+  # When the buffer is full, the oldest entry is overwritten. Expired entries are invalidated
+  # at once by discardExpired(); their slots are reused as new entries are added.
+
+  def __init__(self, capacity=24):
+
+    self.allocate(capacity)
+
+
+  def allocate(self, capacity):
+
+    self.capacity = capacity
+    self.fromPoints = numpy.zeros((capacity, 3))
+    self.toPoints = numpy.zeros((capacity, 3))
+    self.timeStamps = numpy.zeros(capacity)
+    self.weights = numpy.ones(capacity)
+    self.valid = numpy.zeros(capacity, dtype=bool)
+    self.residuals = numpy.zeros(capacity)             # Residuals after the last registration
+    self.inliers = numpy.ones(capacity, dtype=bool)    # Inlier flags after the last registration
+    self.head = 0            # Index of the slot for the next entry
+    self.mTime = 0           # Incremented every time the contents are changed
+
+
+  def clear(self):
+
+    self.valid[:] = False
+    self.head = 0
+    self.mTime = self.mTime + 1
+
+
+  def add(self, fromPoints, toPoints, timeStamp, weight=1.0):
+    # Add one or more pairs of points. 'fromPoints' and 'toPoints' are (n, 3) arrays.
+    # 'timeStamp' and 'weight' can be either scalars or arrays with n elements.
+
+    fromPoints = numpy.asarray(fromPoints, dtype=float).reshape(-1, 3)
+    toPoints = numpy.asarray(toPoints, dtype=float).reshape(-1, 3)
+    n = fromPoints.shape[0]
+    if n == 0:
+      return
+
+    timeStamp = numpy.broadcast_to(numpy.asarray(timeStamp, dtype=float), (n,))
+    weight = numpy.broadcast_to(numpy.asarray(weight, dtype=float), (n,))
+
+    # If more entries than the capacity are given, only the newest ones are kept.
+    if n > self.capacity:
+      fromPoints = fromPoints[-self.capacity:]
+      toPoints = toPoints[-self.capacity:]
+      timeStamp = timeStamp[-self.capacity:]
+      weight = weight[-self.capacity:]
+      n = self.capacity
+
+    index = (self.head + numpy.arange(n)) % self.capacity
+    self.fromPoints[index] = fromPoints
+    self.toPoints[index] = toPoints
+    self.timeStamps[index] = timeStamp
+    self.weights[index] = weight
+    self.valid[index] = True
+    self.residuals[index] = 0.0
+    self.inliers[index] = True
+    self.head = (self.head + n) % self.capacity
+    self.mTime = self.mTime + 1
+
+
+  def discardExpired(self, currentTime, expiration):
+    # Invalidate the entries older than 'expiration' (seconds). Returns the number of discarded entries.
+
+    expired = numpy.logical_and(self.valid, (currentTime - self.timeStamps) > expiration)
+    nExpired = numpy.count_nonzero(expired)
+    if nExpired > 0:
+      self.valid[expired] = False
+      self.mTime = self.mTime + 1
+    return nExpired
+
+
+  def getNumberOfPoints(self):
+
+    return numpy.count_nonzero(self.valid)
+
+
+  def getOrderedIndices(self):
+    # Indices of the valid entries from the oldest to the newest.
+
+    order = (self.head + numpy.arange(self.capacity)) % self.capacity
+    return order[self.valid[order]]
+
+
+  def setResiduals(self, residuals, inlierMask):
+    # Set the residuals and inlier flags for the valid entries, given in the same order as getPoints().
+
+    index = self.getOrderedIndices()
+    if len(index) != len(residuals):
+      return
+    self.residuals[index] = residuals
+    self.inliers[index] = inlierMask
+    self.mTime = self.mTime + 1
+
+
+  def getResiduals(self):
+    # Returns a tuple (residuals, inlierMask) for the valid entries in the same order as getPoints().
+
+    index = self.getOrderedIndices()
+    return (self.residuals[index], self.inliers[index])
+
+
+  def getPoints(self):
+    # Returns a tuple (fromPoints, toPoints, timeStamps, weights) of the valid entries ordered
+    # from the oldest to the newest.
+
+    index = self.getOrderedIndices()
+    return (self.fromPoints[index], self.toPoints[index], self.timeStamps[index], self.weights[index])
@@ -0,0 +1,412 @@
+import numpy
+
+#------------------------------------------------------------
+#
+# Point-based registration solvers
+#
+# The functions in this file compute the transform that maps 'fromPoints' to 'toPoints'
+# ((n, 3) NumPy arrays of corresponding points) in closed form. The linear transforms are
+# returned as 4x4 homogeneous matrices (NumPy arrays), which can be written to an existing
+# transform node using slicer.util.updateTransformMatrixFromArray().
+#
+
+def normalizeWeights(weights, nPoints):
+
+  if weights is None:
+    return numpy.full(nPoints, 1.0/nPoints)
+
+  w = numpy.asarray(weights, dtype=float)
+  s = numpy.sum(w)
+  if s <= 0.0:
+    return numpy.full(nPoints, 1.0/nPoints)
+  return w / s
+
+
+def solveSimilarityFromMoments(mFrom, mTo, cov, varFrom, scaling=False):
+  #
+  # Compute a rigid (or similarity if 'scaling' is True) transform from the weighted moments of
+  # the corresponding points (Umeyama, IEEE TPAMI 13(4), 1991):
+  #
+  #   mFrom, mTo : weighted centroids of the 'from' and 'to' points
+  #   cov        : weighted cross-covariance matrix, sum(w * (to - mTo) (from - mFrom)^T)
+  #   varFrom    : weighted variance of the 'from' points, sum(w * |from - mFrom|^2)
+  #
+
+  (U, S, Vt) = numpy.linalg.svd(cov)
+  D = numpy.ones(3)
+  if numpy.linalg.det(U) * numpy.linalg.det(Vt) < 0.0:
+    D[2] = -1.0   # Avoid reflection
+
+  R = (U * D) @ Vt
+
+  c = 1.0
+  if scaling and varFrom > 0.0:
+    c = numpy.sum(S * D) / varFrom
+
+  matrix = numpy.eye(4)
+  matrix[0:3,0:3] = c * R
+  matrix[0:3,3] = mTo - c * (R @ mFrom)
+  return matrix
+
+
+def solveSimilarity(fromPoints, toPoints, weights=None, scaling=False):
+  # Rigid (scaling=False) or similarity (scaling=True) transform by weighted Kabsch/Umeyama.
+
+  nPoints = fromPoints.shape[0]
+  if nPoints < 3:
+    return None
+
+  w = normalizeWeights(weights, nPoints)
+  mFrom = w @ fromPoints
+  mTo = w @ toPoints
+  dFrom = fromPoints - mFrom
+  dTo = toPoints - mTo
+
+  cov = (dTo * w[:,None]).T @ dFrom
+  varFrom = numpy.sum(w * numpy.sum(dFrom * dFrom, axis=1))
+
+  return solveSimilarityFromMoments(mFrom, mTo, cov, varFrom, scaling)
+
+
+def solveAffine(fromPoints, toPoints, weights=None):
+  # Affine transform by weighted linear least squares.
+
+  nPoints = fromPoints.shape[0]
+  if nPoints < 4:
+    return None
+
+  w = numpy.sqrt(normalizeWeights(weights, nPoints))
+  A = numpy.empty((nPoints, 4))
+  A[:,0:3] = fromPoints
+  A[:,3] = 1.0
+
+  (X, residuals, rank, s) = numpy.linalg.lstsq(A * w[:,None], toPoints * w[:,None], rcond=None)
+  if rank < 4:  # The points are (nearly) coplanar.
+    return None
+
+  matrix = numpy.eye(4)
+  matrix[0:3,:] = X.T
+  return matrix
+
+
+def transformPoints(matrix, points):
+  # Apply a 4x4 homogeneous matrix to an (n, 3) array of points.
+
+  return points @ matrix[0:3,0:3].T + matrix[0:3,3]
+
+
+def calculateResiduals(transformedFromPoints, toPoints):
+  # Distances between the transformed 'from' points and the 'to' points.
+
+  return numpy.linalg.norm(transformedFromPoints - toPoints, axis=1)
+
+
+def calculateFRE(transformedFromPoints, toPoints):
+  # Fiducial registration error (RMS distance).
+
+  if toPoints.shape[0] == 0:
+    return 0.0
+  return numpy.sqrt(numpy.mean(numpy.sum(numpy.square(transformedFromPoints - toPoints), axis=1)))
+
+
+def solveSimilarityBatch(fromPoints, toPoints, scaling=False):
+  # Batched version of solveSimilarity() without weights. 'fromPoints' and 'toPoints' are
+  # (k, n, 3) arrays of k sets of corresponding points. Returns a (k, 4, 4) array of matrices.
+
+  k = fromPoints.shape[0]
+  mFrom = numpy.mean(fromPoints, axis=1)
+  mTo = numpy.mean(toPoints, axis=1)
+  dFrom = fromPoints - mFrom[:,None,:]
+  dTo = toPoints - mTo[:,None,:]
+  cov = numpy.einsum('kni,knj->kij', dTo, dFrom) / fromPoints.shape[1]
+
+  (U, S, Vt) = numpy.linalg.svd(cov)
+  D = numpy.ones((k, 3))
+  D[:,2] = numpy.where(numpy.linalg.det(U) * numpy.linalg.det(Vt) < 0.0, -1.0, 1.0)
+  R = (U * D[:,None,:]) @ Vt
+
+  c = numpy.ones(k)
+  if scaling:
+    varFrom = numpy.sum(dFrom * dFrom, axis=(1,2)) / fromPoints.shape[1]
+    fValid = varFrom > 0.0
+    c[fValid] = numpy.sum(S * D, axis=1)[fValid] / varFrom[fValid]
+
+  matrices = numpy.tile(numpy.eye(4), (k, 1, 1))
+  matrices[:,0:3,0:3] = c[:,None,None] * R
+  matrices[:,0:3,3] = mTo - numpy.einsum('kij,kj->ki', matrices[:,0:3,0:3], mFrom)
+  return matrices
+
+
+def solveAffineBatch(fromPoints, toPoints):
+  # Batched least-squares affine transforms for (k, n, 3) arrays of corresponding points (n >= 4).
+
+  k = fromPoints.shape[0]
+  A = numpy.ones(fromPoints.shape[0:2] + (4,))
+  A[:,:,0:3] = fromPoints
+  X = numpy.linalg.pinv(A) @ toPoints   # (k, 4, 3)
+
+  matrices = numpy.tile(numpy.eye(4), (k, 1, 1))
+  matrices[:,0:3,:] = numpy.transpose(X, (0, 2, 1))
+  return matrices
+
+
+def solveLinear(fromPoints, toPoints, mode='rigid', weights=None):
+  # mode: 'rigid', 'similarity' or 'affine'
+
+  if mode == 'affine':
+    return solveAffine(fromPoints, toPoints, weights)
+  return solveSimilarity(fromPoints, toPoints, weights, scaling=(mode == 'similarity'))
+
+
+def solveRobust(fromPoints, toPoints, mode='rigid', weights=None, threshold=5.0, nHypotheses=100, nRefinements=3, rng=None):
+  #
+  # Robust estimation of a linear transform by RANSAC. 'nHypotheses' minimal subsets are drawn
+  # at once, and the transforms for all the subsets and their residuals for all the points are
+  # evaluated as batched array operations. The transform with the largest (weighted) number of inliers,
+  # i.e., the points with residuals smaller than 'threshold' (mm), is then refined by least squares
+  # over the inliers.
+  #
+  # Returns a tuple (matrix, inlierMask, residuals). 'matrix' is None if the transform cannot be determined.
+  #
+
+  nPoints = fromPoints.shape[0]
+  nMinPoints = 3
+  if mode == 'affine':
+    nMinPoints = 4
+
+  if nPoints < nMinPoints:
+    return (None, numpy.zeros(nPoints, dtype=bool), numpy.zeros(nPoints))
+
+  if weights is None:
+    weights = numpy.ones(nPoints)
+  if rng is None:
+    rng = numpy.random.default_rng()
+
+  # Draw minimal subsets without replacement
+  samples = numpy.argsort(rng.random((nHypotheses, nPoints)), axis=1)[:,0:nMinPoints]
+  if mode == 'affine':
+    matrices = solveAffineBatch(fromPoints[samples], toPoints[samples])
+  else:
+    matrices = solveSimilarityBatch(fromPoints[samples], toPoints[samples], scaling=(mode == 'similarity'))
+
+  transformed = numpy.einsum('kij,nj->kni', matrices[:,0:3,0:3], fromPoints) + matrices[:,None,0:3,3]
+  residuals = numpy.linalg.norm(transformed - toPoints[None,:,:], axis=2)
+  scores = numpy.sum((residuals < threshold) * weights[None,:], axis=1)
+  best = numpy.argmax(scores)
+
+  matrix = matrices[best]
+  inlierMask = residuals[best] < threshold
+  residuals = residuals[best]
+
+  for i in range(nRefinements):
+    if numpy.count_nonzero(inlierMask) < nMinPoints:
+      break
+    refined = solveLinear(fromPoints[inlierMask], toPoints[inlierMask], mode, weights[inlierMask])
+    if refined is None:
+      break
+    matrix = refined
+    residuals = calculateResiduals(transformPoints(matrix, fromPoints), toPoints)
+    newMask = residuals < threshold
+    if numpy.array_equal(newMask, inlierMask):
+      break
+    inlierMask = newMask
+
+  return (matrix, inlierMask, residuals)
+
+
+#------------------------------------------------------------
+#
+# RecursiveRegistrationEstimator class
+#
+
+class RecursiveRegistrationEstimator():
+
+  # RecursiveRegistrationEstimator updates the registration estimate recursively as new pairs of
+  # points arrive. Instead of keeping the points, it keeps the following weighted sufficient statistics:
+  #
+  #   sumW : sum(w)
+  #   M    : sum(w * xh xh^T)  (4x4), where xh = (x, y, z, 1) is a 'from' point
+  #   C    : sum(w * y xh^T)   (3x4), where y is a 'to' point
+  #
+  # The centroids, the cross-covariance and the variance for the rigid/similarity transforms, and
+  # the normal equations for the affine transform are all obtained from these statistics. Old pairs
+  # are forgotten gradually by multiplying the statistics by exp(-dt / decayTime) every time new pairs
+  # are added, where dt is the time elapsed since the last update. Both the update and the estimation
+  # take constant time regardless of the number of pairs.
+
+  def __init__(self, decayTime=30.0):
+
+    self.decayTime = decayTime  # seconds
+    self.reset()
+
+
+  def reset(self):
+
+    self.sumW = 0.0
+    self.M = numpy.zeros((4,4))
+    self.C = numpy.zeros((3,4))
+    self.lastTime = None
+    self.nPairs = 0             # Number of pairs added since the last reset.
+
+
+  def decay(self, currentTime):
+
+    if self.lastTime != None and self.decayTime > 0.0:
+      dt = currentTime - self.lastTime
+      if dt > 0.0:
+        f = numpy.exp(-dt / self.decayTime)
+        self.sumW = self.sumW * f
+        self.M = self.M * f
+        self.C = self.C * f
+    if self.lastTime == None or currentTime > self.lastTime:
+      self.lastTime = currentTime
+
+
+  def add(self, fromPoints, toPoints, timeStamp, weight=1.0):
+    # Add pairs of points acquired at 'timeStamp'. 'fromPoints' and 'toPoints' are (n, 3) arrays.
+
+    fromPoints = numpy.asarray(fromPoints, dtype=float).reshape(-1, 3)
+    toPoints = numpy.asarray(toPoints, dtype=float).reshape(-1, 3)
+    n = fromPoints.shape[0]
+    if n == 0:
+      return
+
+    self.decay(timeStamp)
+
+    w = numpy.broadcast_to(numpy.asarray(weight, dtype=float), (n,))
+    xh = numpy.empty((n, 4))
+    xh[:,0:3] = fromPoints
+    xh[:,3] = 1.0
+
+    self.sumW = self.sumW + numpy.sum(w)
+    self.M = self.M + (xh * w[:,None]).T @ xh
+    self.C = self.C + (toPoints * w[:,None]).T @ xh
+    self.nPairs = self.nPairs + n
+
+
+  def estimate(self, mode='rigid'):
+    # Compute the transform from the current statistics. 'mode' is either 'rigid', 'similarity' or
+    # 'affine'. Returns None if the transform cannot be determined.
+
+    if self.sumW <= 0.0:
+      return None
+
+    if mode == 'affine':
+      if self.nPairs < 4:
+        return None
+      try:
+        X = numpy.linalg.solve(self.M.T, self.C.T)
+      except numpy.linalg.LinAlgError:
+        return None
+      matrix = numpy.eye(4)
+      matrix[0:3,:] = X.T
+      return matrix
+
+    if self.nPairs < 3:
+      return None
+
+    mFrom = self.M[0:3,3] / self.sumW
+    mTo = self.C[:,3] / self.sumW
+    cov = self.C[:,0:3] / self.sumW - numpy.outer(mTo, mFrom)
+    varFrom = numpy.trace(self.M[0:3,0:3]) / self.sumW - mFrom @ mFrom
+
+    return solveSimilarityFromMoments(mFrom, mTo, cov, varFrom, scaling=(mode == 'similarity'))
+
+
+#------------------------------------------------------------
+#
+# Thin plate spline
+#
+
+def decimateLandmarks(fromPoints, toPoints, spacing):
+  #
+  # Merge the pairs of landmarks whose 'from' points fall in the same voxel of a grid with the
+  # given spacing (mm). The pairs in each voxel are replaced by their mean. Redundant landmarks
+  # (e.g., points collected while the catheter stays still) make the thin plate spline system
+  # large and ill-conditioned.
+  #
+
+  if spacing <= 0.0 or fromPoints.shape[0] == 0:
+    return (fromPoints, toPoints)
+
+  keys = numpy.floor(fromPoints / spacing).astype(numpy.int64)
+  (uniqueKeys, inverse) = numpy.unique(keys, axis=0, return_inverse=True)
+  inverse = inverse.reshape(-1)
+  nVoxels = uniqueKeys.shape[0]
+  counts = numpy.bincount(inverse, minlength=nVoxels).astype(float)
+
+  fromMean = numpy.zeros((nVoxels, 3))
+  toMean = numpy.zeros((nVoxels, 3))
+  numpy.add.at(fromMean, inverse, fromPoints)
+  numpy.add.at(toMean, inverse, toPoints)
+
+  return (fromMean / counts[:,None], toMean / counts[:,None])
+
+
+class ThinPlateSplineWarp():
+
+  # ThinPlateSplineWarp computes a 3D thin plate spline with the kernel U(r) = r (equivalent to
+  # vtkThinPlateSplineTransform with SetBasisToR()) in NumPy. The kernel weights are solved once in
+  # fit(), and cached until different landmarks are given. evaluate() warps an (n, 3) array of points
+  # at once.
+
+  def __init__(self):
+
+    self.sourceLandmarks = numpy.zeros((0,3))
+    self.targetLandmarks = numpy.zeros((0,3))
+    self.weights = None        # (n, 3) kernel weights
+    self.affine = None         # (4, 3) affine part
+    self.mTime = 0             # Incremented every time the weights are solved
+
+
+  def fit(self, sourceLandmarks, targetLandmarks):
+    # Solve the kernel weights. Returns False if the system cannot be solved.
+
+    if self.weights is not None and \
+       numpy.array_equal(sourceLandmarks, self.sourceLandmarks) and \
+       numpy.array_equal(targetLandmarks, self.targetLandmarks):
+      return True   # Use the cached weights
+
+    n = sourceLandmarks.shape[0]
+    if n < 4:
+      self.weights = None
+      return False
+
+    K = numpy.linalg.norm(sourceLandmarks[:,None,:] - sourceLandmarks[None,:,:], axis=2)
+    P = numpy.ones((n, 4))
+    P[:,0:3] = sourceLandmarks
+
+    L = numpy.zeros((n+4, n+4))
+    L[0:n,0:n] = K
+    L[0:n,n:] = P
+    L[n:,0:n] = P.T
+    Y = numpy.zeros((n+4, 3))
+    Y[0:n] = targetLandmarks
+
+    try:
+      X = numpy.linalg.solve(L, Y)
+    except numpy.linalg.LinAlgError:
+      X = numpy.linalg.lstsq(L, Y, rcond=None)[0]
+
+    self.sourceLandmarks = numpy.array(sourceLandmarks)
+    self.targetLandmarks = numpy.array(targetLandmarks)
+    self.weights = X[0:n]
+    self.affine = X[n:]
+    self.mTime = self.mTime + 1
+    return True
+
+
+  def isValid(self):
+
+    return self.weights is not None
+
+
+  def evaluate(self, points):
+    # Warp an (m, 3) array of points.
+
+    points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+    if self.weights is None:
+      return numpy.array(points)
+
+    r = numpy.linalg.norm(points[:,None,:] - self.sourceLandmarks[None,:,:], axis=2)
+    return r @ self.weights + points @ self.affine[0:3] + self.affine[3]
@@ -0,0 +1,136 @@
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+#------------------------------------------------------------
+#
+# ScalarStatistics class
+#
+
+class ScalarStatistics():
+
+  # ScalarStatistics holds the value histogram and a percentile table of a scalar array (e.g., a
+  # parameter map on a surface model). They are computed once per array, so that the color range
+  # can be set to a robust range (e.g., 1-99 percentiles) and the coverage of a window can be
+  # obtained without scanning the values again.
+  #
+  # The statistics are stored in the field data of the poly data as a vtkDoubleArray named
+  # 'MRTracking.Statistics.<array name>':
+  #
+  #   [mtime, nValid, min, max, nBins, percentiles (0, 0.5, ..., 100), counts (nBins)]
+  #
+  # where 'mtime' is the modification time of the scalar array at the time of computation. The
+  # statistics are recomputed if the array has been modified (see getScalarStatistics()).
+
+  PERCENTILES = numpy.linspace(0.0, 100.0, 201)
+
+  def __init__(self, nBins=256):
+
+    self.nBins = nBins
+    self.nValid = 0
+    self.min = numpy.nan
+    self.max = numpy.nan
+    self.percentiles = numpy.full(len(self.PERCENTILES), numpy.nan)
+    self.counts = numpy.zeros(nBins)
+
+
+  def compute(self, valuesNP):
+
+    valuesNP = numpy.asarray(valuesNP, dtype=float).reshape(-1)
+    valuesNP = valuesNP[numpy.isfinite(valuesNP)]
+    self.nValid = len(valuesNP)
+    if self.nValid == 0:
+      self.__init__(self.nBins)
+      return
+
+    self.percentiles = numpy.percentile(valuesNP, self.PERCENTILES)
+    self.min = self.percentiles[0]
+    self.max = self.percentiles[-1]
+    (self.counts, edges) = numpy.histogram(valuesNP, bins=self.nBins, range=(self.min, self.max))
+    self.counts = self.counts.astype(float)
+
+
+  def getRange(self):
+
+    return (self.min, self.max)
+
+
+  def getPercentile(self, p):
+
+    return float(numpy.interp(p, self.PERCENTILES, self.percentiles))
+
+
+  def getRobustRange(self, clip=1.0):
+    # Range between the 'clip' and (100 - 'clip') percentiles.
+
+    return (self.getPercentile(clip), self.getPercentile(100.0 - clip))
+
+
+  def getHistogram(self):
+    # Returns a tuple (counts, edges).
+
+    return (self.counts, numpy.linspace(self.min, self.max, self.nBins + 1))
+
+
+  def getFractionInRange(self, lower, upper):
+    # Fraction of the values between 'lower' and 'upper', from the cumulative histogram (the values
+    # are assumed to be uniformly distributed within each bin).
+
+    if self.nValid == 0 or upper < lower:
+      return 0.0
+    if self.max == self.min:
+      return 1.0 if lower <= self.min <= upper else 0.0
+
+    edges = numpy.linspace(self.min, self.max, self.nBins + 1)
+    cumulative = numpy.concatenate(([0.0], numpy.cumsum(self.counts)))
+    c = numpy.interp([lower, upper], edges, cumulative)
+    return float((c[1] - c[0]) / self.nValid)
+
+
+  def toArray(self, mtime):
+
+    header = numpy.array([mtime, self.nValid, self.min, self.max, self.nBins], dtype=float)
+    return numpy.concatenate((header, self.percentiles, self.counts))
+
+
+  def fromArray(self, arrayNP):
+    # Returns the modification time of the scalar array stored in 'arrayNP'.
+
+    self.nValid = int(arrayNP[1])
+    self.min = arrayNP[2]
+    self.max = arrayNP[3]
+    self.nBins = int(arrayNP[4])
+    nPercentiles = len(self.PERCENTILES)
+    self.percentiles = numpy.array(arrayNP[5:5+nPercentiles])
+    self.counts = numpy.array(arrayNP[5+nPercentiles:5+nPercentiles+self.nBins])
+    return int(arrayNP[0])
+
+
+def getScalarStatistics(polyData, name, nBins=256):
+  #
+  # Returns the ScalarStatistics for the point scalars 'name' of 'polyData', or None if there is no
+  # such array. The statistics cached in the field data are used unless the array has been modified.
+  #
+
+  if polyData == None:
+    return None
+  array = polyData.GetPointData().GetArray(name)
+  if array == None:
+    return None
+
+  statsName = 'MRTracking.Statistics.' + name
+  fieldData = polyData.GetFieldData()
+  stats = ScalarStatistics(nBins)
+  statsArray = fieldData.GetArray(statsName)
+  if statsArray != None:
+    mtime = stats.fromArray(numpy_support.vtk_to_numpy(statsArray))
+    if mtime == array.GetMTime():
+      return stats
+
+  stats = ScalarStatistics(nBins)
+  stats.compute(numpy_support.vtk_to_numpy(array))
+  statsArray = numpy_support.numpy_to_vtk(stats.toArray(array.GetMTime()), deep=True)
+  statsArray.SetName(statsName)
+  fieldData.RemoveArray(statsName)
+  fieldData.AddArray(statsArray)
+  return stats
@@ -0,0 +1,269 @@
+import numpy
+import vtk
+import SimpleITK as sitk
+from scipy import ndimage
+from vtk.util import numpy_support
+
+#------------------------------------------------------------
+#
+# SurfaceGenerator class
+#
+
+class SurfaceGenerator():
+
+  # SurfaceGenerator generates a surface model from the recorded points in three stages:
+  #
+  #   1. Density  : Point density volume (vtkPointDensityFilter) in a cubic box 1.5 times larger
+  #                 than the bounding box of the points.
+  #   2. Label    : Binary threshold, dilation, hole filling and erosion (SimpleITK or scipy.ndimage). The kernel
+  #                 radius is given by the point distance factor.
+  #   3. Surface  : Marching cubes, windowed sinc smoothing and decimation (VTK).
+  #
+  # The generator is kept alive between runs. The images are passed between the stages in memory
+  # (no volume node in the MRML scene), and each stage is skipped if its inputs have not been
+  # changed since the last run. For example, changing only the point distance factor reuses the
+  # density volume.
+  #
+  # The density is read as a NumPy view of the output of vtkPointDensityFilter, and thresholded
+  # into a preallocated array. The label is written into another preallocated array, which is
+  # the (shared, not copied) scalar array of the input image of the marching cubes. The morphology
+  # is performed either by SimpleITK ('sitk'; the binary image is passed as a view, and the result
+  # is copied once into the label array) or by scipy.ndimage ('scipy'; the result is written into
+  # the label array directly).
+
+  def __init__(self, resolution=256, morphology='sitk'):
+
+    self.resolution = resolution
+    self.morphology = morphology
+
+    self.pointsPoly = vtk.vtkPolyData()
+    self.density = vtk.vtkPointDensityFilter()
+    self.density.SetInputData(self.pointsPoly)
+    self.density.SetDensityEstimateToFixedRadius()
+    self.density.SetDensityFormToNumberOfPoints()
+    self.density.ComputeGradientOff()
+
+    self.labelImage = vtk.vtkImageData()
+    self.binNP = None            # Thresholded density
+    self.workNP = None           # Work array for scipy.ndimage
+    self.labelNP = None          # Scalars of self.labelImage
+
+    self.marchingCubes = vtk.vtkMarchingCubes()
+    self.marchingCubes.SetInputData(self.labelImage)
+    self.marchingCubes.ComputeNormalsOff()
+    self.marchingCubes.ComputeGradientsOff()
+    self.marchingCubes.SetValue(0, 1.0)
+
+    self.smoothFilter = vtk.vtkWindowedSincPolyDataFilter()
+    self.smoothFilter.SetInputConnection(self.marchingCubes.GetOutputPort())
+    self.smoothFilter.SetNumberOfIterations(10)
+    self.smoothFilter.BoundarySmoothingOff()
+    self.smoothFilter.FeatureEdgeSmoothingOff()
+    self.smoothFilter.SetFeatureAngle(120)
+    self.smoothFilter.SetPassBand(0.001)
+    self.smoothFilter.NonManifoldSmoothingOn()
+    self.smoothFilter.NormalizeCoordinatesOn()
+
+    self.decimate = vtk.vtkDecimatePro()
+    self.decimate.SetInputConnection(self.smoothFilter.GetOutputPort())
+    self.decimate.SetTargetReduction(0.1)
+    self.decimate.PreserveTopologyOn()
+
+    self.clear()
+
+
+  def clear(self):
+
+    self.densityKey = None
+    self.labelKey = None
+    self.surfaceKey = None
+    self.densityNP = None
+    self.pixelSize = 0.0
+    self.surface = None
+
+
+  def getBounds(self, pointsNP):
+    # Cubic box 1.5 times larger than the bounding box of the points.
+
+    origin = (numpy.min(pointsNP, axis=0) + numpy.max(pointsNP, axis=0)) / 2.0
+    fovMax = numpy.max(numpy.max(pointsNP, axis=0) - numpy.min(pointsNP, axis=0))
+    boundingBoxRange = (fovMax * 1.5)/2.0 # From the center to the end (1/2 of each dimension)
+    b = numpy.zeros((3,2))
+    b[:,0] = origin - boundingBoxRange
+    b[:,1] = origin + boundingBoxRange
+    return b.reshape(-1)
+
+
+  def updateDensity(self, pointsNP):
+
+    bounds = self.getBounds(pointsNP)
+    res = self.resolution
+    pixelSize = (bounds[1] - bounds[0]) / res
+
+    # Note: the algorithm fails when the bounding box is too small..
+    if pixelSize < 0.5:
+      pixelSize = 0.5
+
+    key = (pointsNP.shape[0], hash(pointsNP.tobytes()), tuple(bounds), res, pixelSize)
+    if key == self.densityKey:
+      return False
+
+    print('Running vtkPointDensityFilter...')
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(pointsNP, deep=True))
+    self.pointsPoly.SetPoints(points)
+
+    self.density.SetSampleDimensions(res, res, res)
+    self.density.SetRadius(pixelSize)
+    self.density.SetModelBounds(bounds)
+    self.density.Modified()
+    self.density.Update()
+
+    imdata = self.density.GetOutput()
+    dims = imdata.GetDimensions()
+    # The x index changes the fastest in vtkImageData; the array is indexed as [z, y, x] (same as SimpleITK).
+    self.densityNP = numpy_support.vtk_to_numpy(imdata.GetPointData().GetScalars()).reshape(dims[2], dims[1], dims[0])
+    self.densityOrigin = imdata.GetOrigin()
+    self.densitySpacing = imdata.GetSpacing()
+    self.pixelSize = pixelSize
+    self.densityKey = key
+    return True
+
+
+  def allocateLabel(self, shape):
+    # Allocate the arrays for the label, and share the label array with the input image of the
+    # marching cubes.
+
+    if self.labelNP is not None and self.labelNP.shape == shape:
+      return
+
+    self.binNP = numpy.zeros(shape, dtype=numpy.uint8)
+    self.workNP = numpy.zeros(shape, dtype=numpy.uint8)
+    self.labelNP = numpy.zeros(shape, dtype=numpy.uint8)
+    (nz, ny, nx) = shape
+    self.labelImage.SetDimensions(nx, ny, nz)
+    # The NumPy array must be kept while the VTK array refers to it (deep=False).
+    self.labelImage.GetPointData().SetScalars(numpy_support.numpy_to_vtk(self.labelNP.reshape(-1), deep=False))
+
+
+  def getBall(self, radius):
+
+    r = numpy.arange(-radius, radius + 1)
+    (z, y, x) = numpy.meshgrid(r, r, r, indexing='ij')
+    return (x*x + y*y + z*z) <= radius * radius
+
+
+  def updateLabel(self, pointDistanceFactor):
+
+    # Calculate the radius parameter for dilation and erosion
+    radiusInPixel = int(numpy.ceil(pointDistanceFactor / self.pixelSize))
+    if radiusInPixel < 1.0:
+      radiusInPixel = 1
+
+    key = (self.densityKey, radiusInPixel, self.morphology)
+    if key == self.labelKey:
+      return False
+
+    self.allocateLabel(self.densityNP.shape)
+
+    print('Applying BinaryThreshold...')
+    numpy.logical_and(self.densityNP >= 1.0, self.densityNP <= 256, out=self.binNP, casting='unsafe')
+
+    if self.morphology == 'scipy':
+      self.runMorphologySciPy(radiusInPixel)
+    else:
+      self.runMorphologySimpleITK(radiusInPixel)
+
+    self.labelImage.SetOrigin(self.densityOrigin)
+    self.labelImage.SetSpacing(self.densitySpacing)
+    self.labelImage.GetPointData().GetScalars().Modified()
+    self.labelImage.Modified()
+
+    self.labelKey = key
+    return True
+
+
+  def runMorphologySciPy(self, radiusInPixel):
+
+    print('Dilating the image...')
+    ndimage.binary_dilation(self.binNP, structure=self.getBall(radiusInPixel), output=self.workNP)
+
+    print('Filling holes...')
+    ndimage.binary_fill_holes(self.workNP, structure=numpy.ones((3,3,3)), output=self.binNP)
+
+    print('Eroding the image...')
+    if radiusInPixel > 1:
+      ndimage.binary_erosion(self.binNP, structure=self.getBall(radiusInPixel-1), output=self.labelNP)
+    else:
+      self.labelNP[...] = self.binNP
+
+
+  def runMorphologySimpleITK(self, radiusInPixel):
+
+    # GetImageViewFromArray() (SimpleITK 2.1 or later) does not copy the array.
+    if hasattr(sitk, 'GetImageViewFromArray'):
+      binImage = sitk.GetImageViewFromArray(self.binNP)
+    else:
+      binImage = sitk.GetImageFromArray(self.binNP)
+    binImage.SetOrigin(self.densityOrigin)
+    binImage.SetSpacing(self.densitySpacing)
+
+    # Dilate the target label
+    print('Dilating the image...')
+    dilateFilter = sitk.BinaryDilateImageFilter()
+    dilateFilter.SetBoundaryToForeground(False)
+    dilateFilter.SetKernelRadius(radiusInPixel)
+    dilateFilter.SetKernelType(sitk.sitkBall)
+    dilateFilter.SetForegroundValue(1)
+    dilateFilter.SetBackgroundValue(0)
+    dilateImage = dilateFilter.Execute(binImage)
+
+    # Fill holes in the target label
+    print('Filling holes...')
+    fillHoleFilter = sitk.BinaryFillholeImageFilter()
+    fillHoleFilter.SetForegroundValue(1)
+    fillHoleFilter.SetFullyConnected(True)
+    fillHoleImage = fillHoleFilter.Execute(dilateImage)
+
+    # Erode the label
+    print('Eroding the image...')
+    erodeFilter = sitk.BinaryErodeImageFilter()
+    erodeFilter.SetBoundaryToForeground(False)
+    erodeFilter.SetKernelType(sitk.sitkBall)
+    erodeFilter.SetKernelRadius(radiusInPixel-1) # 1 pixel smaller than the radius for dilation.
+    erodeFilter.SetForegroundValue(1)
+    erodeFilter.SetBackgroundValue(0)
+    erodeImage = erodeFilter.Execute(fillHoleImage)
+
+    # Copy the result to the input image of the marching cubes.
+    self.labelNP[...] = sitk.GetArrayViewFromImage(erodeImage)
+
+
+  def updateSurface(self):
+
+    if self.labelKey == self.surfaceKey:
+      return False
+
+    print('Running marching cubes...')
+    self.decimate.Update()
+    self.surface = vtk.vtkPolyData()
+    self.surface.DeepCopy(self.decimate.GetOutput())
+    self.surfaceKey = self.labelKey
+    return True
+
+
+  def update(self, pointsNP, pointDistanceFactor):
+    #
+    # Generate the surface from (n, 3) 'pointsNP'. Returns a tuple (polyData, modified), where
+    # 'modified' is False if the surface from the last run has been reused. A new vtkPolyData is
+    # returned whenever the surface is regenerated.
+    #
+
+    pointsNP = numpy.ascontiguousarray(pointsNP, dtype=float)
+    if pointsNP.shape[0] == 0:
+      return (None, False)
+
+    self.updateDensity(pointsNP)
+    self.updateLabel(pointDistanceFactor)
+    modified = self.updateSurface()
+    return (self.surface, modified)
@@ -0,0 +1,204 @@
+import numpy
+import vtk
+import slicer
+from vtk.util import numpy_support
+from scipy.spatial import cKDTree
+
+#------------------------------------------------------------
+#
+# SurfaceLOD class
+#
+
+class SurfaceLOD():
+
+  # SurfaceLOD holds a surface mesh at several levels of detail (LOD). Level 0 is the full-resolution
+  # mesh, and each of the other levels is obtained by decimating the previous level with
+  # vtkDecimatePro. The levels are generated once for each surface (build()), and the model node
+  # displays one of them at a time (setLevel()). A coarse level is used for interaction and for
+  # previewing the parameter map, since the RBF interpolation is evaluated at every vertex of the
+  # displayed mesh.
+  #
+  # The point scalars are propagated between the levels through a vertex correspondence precomputed
+  # in build():
+  #
+  #   Level i -> level 0 : Inverse-distance weighted average of the 'nNeighbors' nearest vertices
+  #                        of level i (fineIndices[i], fineWeights[i]).
+  #   Level 0 -> level i : Nearest vertex of level 0 (coarseIndices[i]). vtkDecimatePro does not
+  #                        move the points, so this is the same vertex.
+  #
+  # An array is propagated only if the new level does not have it, or its copy on the new level is
+  # older than the array on the current level. The age is given by the 'origin' time, which is the
+  # MTime of the array on the level where it was computed (e.g., by the parameter mapping); a copy
+  # inherits the origin of its source. For example, a map computed on the full level is not replaced
+  # by the copy interpolated from the coarse level when switching back to the full level.
+  #
+  # Use getSurfaceLOD() to obtain the LOD shared by the modules for a model node.
+
+  LEVEL_NAMES = ['Full', 'Medium', 'Coarse']
+
+  def __init__(self, reductions=None, nNeighbors=3):
+
+    if reductions is None:
+      reductions = [0.0, 0.75, 0.95]
+    self.reductions = reductions
+    self.nNeighbors = nNeighbors
+    self.level = 0
+    self.clear()
+
+
+  def clear(self):
+
+    self.levels = []
+    self.fineIndices = []
+    self.fineWeights = []
+    self.coarseIndices = []
+    self.copies = {}         # (level, name) -> (MTime of the copy, origin time)
+
+
+  def getNumberOfLevels(self):
+
+    return len(self.levels)
+
+
+  def getLevel(self, i):
+
+    return self.levels[i]
+
+
+  def hasLevel(self, polyData):
+    # Check if 'polyData' is one of the levels (i.e., the LOD is up to date with the model node).
+
+    return any([polyData == level for level in self.levels])
+
+
+  def getPointsNP(self, polyData):
+
+    return numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+
+
+  def build(self, polyData):
+    # Generate the levels from the full-resolution mesh 'polyData' and the vertex correspondence.
+
+    self.clear()
+    self.levels.append(polyData)
+    self.fineIndices.append(None)
+    self.fineWeights.append(None)
+    self.coarseIndices.append(None)
+    if polyData.GetNumberOfPoints() == 0:
+      return
+
+    fullPointsNP = self.getPointsNP(polyData)
+    fullTree = cKDTree(fullPointsNP)
+
+    for i in range(1, len(self.reductions)):
+      # Reduction relative to the previous level
+      r = 1.0 - (1.0 - self.reductions[i]) / (1.0 - self.reductions[i-1])
+      decimate = vtk.vtkDecimatePro()
+      decimate.SetInputData(self.levels[i-1])
+      decimate.SetTargetReduction(r)
+      decimate.PreserveTopologyOn()
+      decimate.Update()
+      level = vtk.vtkPolyData()
+      level.DeepCopy(decimate.GetOutput())
+      self.levels.append(level)
+
+      pointsNP = self.getPointsNP(level)
+      k = min(self.nNeighbors, pointsNP.shape[0])
+      (d, indices) = cKDTree(pointsNP).query(fullPointsNP, k=k)
+      d = d.reshape(fullPointsNP.shape[0], k)
+      indices = indices.reshape(fullPointsNP.shape[0], k)
+      weights = 1.0 / numpy.maximum(d, 1e-6)
+      weights = weights / numpy.sum(weights, axis=1)[:,None]
+      self.fineIndices.append(indices)
+      self.fineWeights.append(weights)
+
+      (d, indices) = fullTree.query(pointsNP, k=1)
+      self.coarseIndices.append(indices)
+
+    self.level = min(self.level, len(self.levels) - 1)
+
+
+  def propagate(self, values, fromLevel, toLevel):
+    # Propagate the point scalars 'values' ((n,) or (n, c) array) from one level to another.
+
+    if fromLevel == toLevel:
+      return values
+    if fromLevel != 0:
+      values = numpy.sum(values[self.fineIndices[fromLevel]] * self.fineWeights[fromLevel][(...,) + (None,) * (values.ndim - 1)], axis=1)
+    if toLevel != 0:
+      values = values[self.coarseIndices[toLevel]]
+    return values
+
+
+  def getOrigin(self, level, name, array):
+    # Origin time of the array 'name' on the level (see the comment at the top).
+
+    copy = self.copies.get((level, name))
+    if copy and copy[0] == array.GetMTime():
+      return copy[1]
+    return array.GetMTime()
+
+
+  def setLevel(self, modelNode, level, scalarNames=None):
+    #
+    # Display the level 'level' in 'modelNode'. The point scalars in 'scalarNames' on the currently
+    # displayed level are propagated to the new level.
+    #
+
+    if level < 0 or level >= len(self.levels):
+      return
+    prevLevel = self.level
+    self.level = level
+
+    if scalarNames is None:
+      scalarNames = []
+
+    polyData = self.levels[level]
+    if prevLevel != level:
+      prevPointData = self.levels[prevLevel].GetPointData()
+      for scalarName in scalarNames:
+        array = prevPointData.GetArray(scalarName)
+        if array == None:
+          continue
+        origin = self.getOrigin(prevLevel, scalarName, array)
+        targetArray = polyData.GetPointData().GetArray(scalarName)
+        if targetArray != None and self.getOrigin(level, scalarName, targetArray) >= origin:
+          continue
+        valuesNP = self.propagate(numpy_support.vtk_to_numpy(array), prevLevel, level)
+        newArray = numpy_support.numpy_to_vtk(numpy.ascontiguousarray(valuesNP), deep=True)
+        newArray.SetName(scalarName)
+        polyData.GetPointData().AddArray(newArray)
+        self.copies[(level, scalarName)] = (newArray.GetMTime(), origin)
+      activeScalars = prevPointData.GetScalars()
+      if activeScalars != None and activeScalars.GetName() in scalarNames:
+        polyData.GetPointData().SetActiveScalars(activeScalars.GetName())
+
+    if modelNode and modelNode.GetPolyData() != polyData:
+      modelNode.SetAndObservePolyData(polyData)
+
+
+# LODs shared by the modules, keyed by the model node ID. The entries must be removed when the
+# nodes are removed or the scene is closed, since the node IDs are reused (see removeSurfaceLOD()).
+surfaceLODs = {}
+
+def getSurfaceLOD(modelNode, create=False):
+  # Returns the SurfaceLOD for the model node, or None if it has not been built.
+
+  if modelNode == None:
+    return None
+
+  nodeID = modelNode.GetID()
+  lod = surfaceLODs.get(nodeID)
+  if lod == None and create:
+    lod = SurfaceLOD()
+    surfaceLODs[nodeID] = lod
+  return lod
+
+
+def removeSurfaceLOD(nodeID=None):
+  # Remove the LOD for the model node ID, or all the LODs if 'nodeID' is None.
+
+  if nodeID == None:
+    surfaceLODs.clear()
+  else:
+    surfaceLODs.pop(nodeID, None)
@@ -3,12 +3,18 @@ import qt
 import slicer
 import vtk
 import numpy
-import sitkUtils
-import SimpleITK as sitk
-from scipy.interpolate import Rbf
+from vtk.util import numpy_support
 from MRTrackingUtils.qcomboboxcatheter import *
 from MRTrackingUtils.qpointrecordingframe  import *
 from MRTrackingUtils.panelbase import *
+from MRTrackingUtils.pointindex import *
+from MRTrackingUtils.egramtable import *
+from MRTrackingUtils.pointcloud import *
+from MRTrackingUtils.surfacelod import *
+from MRTrackingUtils.surfacegenerator import *
+from MRTrackingUtils.parametermapper import *
+from MRTrackingUtils.scalarstatistics import *
+from MRTrackingUtils.activationmap import *
 
 #from scipy.interpolate import griddata
 
@@ -28,8 +34,12 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
     self.lookupTable = None
     self.defaultEgramValueRange = [0.0, 20.0]
     self.prevParamStr = ''
+    self.colorRanges = {}        # Color range for each parameter
     self.recordingMarkupsNode = None
     self.recordingMarkupsTag = ''
+    self.surfaceGenerator = SurfaceGenerator()
+    self.geodesicMapper = GeodesicParameterMapper()
+    self.addSceneObservers()
 
   def buildMainPanel(self, frame):
 
@@ -76,6 +86,13 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
     #self.minIntervalSliderWidget.setToolTip("")
 
     modelLayout.addRow("Point Disntace Factor: ",  self.pointDistanceFactorSliderWidget)
+
+    # Library for the dilation, hole filling and erosion of the point density (see surfacegenerator.py)
+    self.morphologySelector = qt.QComboBox()
+    self.morphologySelector.addItem('SimpleITK')
+    self.morphologySelector.addItem('SciPy')
+    self.morphologySelector.setToolTip("Library used for the morphological operations. SciPy writes the result directly into the label image without copying.")
+    modelLayout.addRow("Morphology: ",  self.morphologySelector)
     
     self.generateSurfaceButton = qt.QPushButton()
     self.generateSurfaceButton.setCheckable(False)
@@ -83,6 +100,21 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
     self.generateSurfaceButton.setToolTip("Generate a surface model from the collected points.")
 
     modelLayout.addRow(" ",  self.generateSurfaceButton)
+
+    # Level of detail of the displayed surface. The parameter map is computed on the displayed level.
+    lodBoxLayout = qt.QHBoxLayout()
+    self.lodGroup = qt.QButtonGroup()
+    self.lodRadioButton = []
+    for name in SurfaceLOD.LEVEL_NAMES:
+      button = qt.QRadioButton(name)
+      lodBoxLayout.addWidget(button)
+      self.lodGroup.addButton(button)
+      button.connect("clicked(bool)", self.onLODChanged)
+      self.lodRadioButton.append(button)
+    self.lodRadioButton[0].checked = 1
+    self.lodRadioButton[0].setToolTip("Full-resolution surface for the final map.")
+    self.lodRadioButton[-1].setToolTip("Coarse surface for interaction and map preview.")
+    modelLayout.addRow("Level of Detail: ", lodBoxLayout)
     
 
     # Parameter map
@@ -111,6 +143,14 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
     #self.minIntervalSliderWidget.setToolTip("")
     mappingLayout.addRow("Surface Distance: ",  self.surfaceDistanceSliderWidget)
 
+    # Interpolation in the 3D space (RBF) or along the surface (geodesic distance)
+    self.interpolationSelector = qt.QComboBox()
+    self.interpolationSelector.addItem('RBF')               # Euclidean distance
+    self.interpolationSelector.addItem('Geodesic (Heat)')   # Heat method
+    self.interpolationSelector.addItem('Geodesic (Graph)')  # Shortest path along the edges
+    self.interpolationSelector.setToolTip("Geodesic modes interpolate along the surface, so that the values do not leak across thin walls. For the geodesic modes, epsilon is the maximum distance of the points (0=no limit).")
+    mappingLayout.addRow("Interpolation:",  self.interpolationSelector)
+
     # Epsilon factor for radius basis function
     # Note: The default value for scipy.interpolate.Rbf is the average distance between the points.
     #       The slider may need to be updated to what the function comes up with.
@@ -131,6 +171,11 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
     self.rbfSelector.addItem('quintic')       # r**5
     self.rbfSelector.addItem('thin_plate')    # r**2 * log(r)
     mappingLayout.addRow("Function:",  self.rbfSelector)
+
+    self.mapAllCheckBox = qt.QCheckBox()
+    self.mapAllCheckBox.checked = 0
+    self.mapAllCheckBox.setToolTip("Map all the egram parameters at once. The selected parameter can be switched without mapping again.")
+    mappingLayout.addRow("All Parameters:",  self.mapAllCheckBox)
     
     self.mapModelButton = qt.QPushButton()
     self.mapModelButton.setCheckable(False)
@@ -149,14 +194,126 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
     self.colorRangeWidget.maximum = 50.0
     mappingLayout.addRow("Color range: ", self.colorRangeWidget)
 
+    #-- Auto range (robust range from the precomputed percentiles)
+    autoRangeBoxLayout = qt.QHBoxLayout()
+    self.autoRangeClipSliderWidget = ctk.ctkSliderWidget()
+    self.autoRangeClipSliderWidget.singleStep = 0.5
+    self.autoRangeClipSliderWidget.minimum = 0.0
+    self.autoRangeClipSliderWidget.maximum = 25.0
+    self.autoRangeClipSliderWidget.value = 1.0
+    self.autoRangeClipSliderWidget.setToolTip("Percentage of the values clipped at each end of the auto range (e.g., 1.0 = 1-99 percentiles).")
+    autoRangeBoxLayout.addWidget(self.autoRangeClipSliderWidget)
+
+    self.autoRangeButton = qt.QPushButton()
+    self.autoRangeButton.setCheckable(False)
+    self.autoRangeButton.text = 'Auto'
+    self.autoRangeButton.setToolTip("Set the color range to the percentiles of the mapped values.")
+    autoRangeBoxLayout.addWidget(self.autoRangeButton)
+    mappingLayout.addRow("Auto Range (%): ", autoRangeBoxLayout)
+
+    self.rangeCoverageLabel = qt.QLabel()
+    self.rangeCoverageLabel.setText('--')
+    mappingLayout.addRow("Vertices in Range: ", self.rangeCoverageLabel)
+
+
+    # Activation map (isochrones and conduction velocity from 'LAT(ms)')
+    activationGroupBox = ctk.ctkCollapsibleGroupBox()
+    activationGroupBox.title = "Activation Map"
+    activationGroupBox.collapsed = True
+    layout.addWidget(activationGroupBox)
+    activationLayout = qt.QFormLayout(activationGroupBox)
+
+    self.isochroneCheckBox = qt.QCheckBox()
+    self.isochroneCheckBox.checked = 0
+    self.isochroneCheckBox.setToolTip("Show the isochrones of the LAT map.")
+    activationLayout.addRow("Isochrones:",  self.isochroneCheckBox)
+
+    self.isochroneSpacingSliderWidget = ctk.ctkSliderWidget()
+    self.isochroneSpacingSliderWidget.singleStep = 1.0
+    self.isochroneSpacingSliderWidget.minimum = 1.0
+    self.isochroneSpacingSliderWidget.maximum = 100.0
+    self.isochroneSpacingSliderWidget.value = 10.0
+    self.isochroneSpacingSliderWidget.setToolTip("Interval between the isochrones (ms).")
+    activationLayout.addRow("Spacing (ms): ",  self.isochroneSpacingSliderWidget)
+
+    self.velocityCheckBox = qt.QCheckBox()
+    self.velocityCheckBox.checked = 0
+    self.velocityCheckBox.setToolTip("Show the conduction velocity vectors computed from the gradient of the LAT map.")
+    activationLayout.addRow("CV Vectors:",  self.velocityCheckBox)
+
+    self.vectorScaleSliderWidget = ctk.ctkSliderWidget()
+    self.vectorScaleSliderWidget.singleStep = 0.5
+    self.vectorScaleSliderWidget.minimum = 0.5
+    self.vectorScaleSliderWidget.maximum = 20.0
+    self.vectorScaleSliderWidget.value = 3.0
+    self.vectorScaleSliderWidget.setToolTip("Length of the arrows (mm).")
+    activationLayout.addRow("Vector Scale (mm): ",  self.vectorScaleSliderWidget)
+
+    self.maxVelocitySliderWidget = ctk.ctkSliderWidget()
+    self.maxVelocitySliderWidget.singleStep = 0.1
+    self.maxVelocitySliderWidget.minimum = 0.1
+    self.maxVelocitySliderWidget.maximum = 20.0
+    self.maxVelocitySliderWidget.value = 5.0
+    self.maxVelocitySliderWidget.setToolTip("Triangles with a higher conduction velocity (i.e., almost flat LAT) are excluded.")
+    activationLayout.addRow("Max CV (m/s): ",  self.maxVelocitySliderWidget)
+
+    self.updateActivationButton = qt.QPushButton()
+    self.updateActivationButton.setCheckable(False)
+    self.updateActivationButton.text = 'Update Activation Map'
+    self.updateActivationButton.setToolTip("Generate the isochrones and conduction velocity vectors from the LAT map.")
+    activationLayout.addRow(" ",  self.updateActivationButton)
+
+    self.velocityLabel = qt.QLabel()
+    self.velocityLabel.setText('--')
+    activationLayout.addRow("Median CV (m/s): ", self.velocityLabel)
+
     #self.paramSelector.view().pressed.connect(self.onUpdateParamSelector)
     
     self.modelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onModelSelected)
     self.generateSurfaceButton.connect('clicked(bool)', self.onGenerateSurface)
     
     self.mapModelButton.connect('clicked(bool)', self.onMapModel)
+    self.paramSelector.connect('currentIndexChanged(int)', self.onParamSelected)
     self.colorRangeWidget.connect('valuesChanged(double, double)', self.onUpdateColorRange)
+    self.autoRangeButton.connect('clicked(bool)', self.onAutoRange)
+    self.isochroneCheckBox.connect('toggled(bool)', self.onUpdateActivationMap)
+    self.velocityCheckBox.connect('toggled(bool)', self.onUpdateActivationMap)
+    self.updateActivationButton.connect('clicked(bool)', self.onUpdateActivationMap)
+    
     
+  #--------------------------------------------------
+  # Observers
+
+  def addSceneObservers(self):
+    # The data cached for the model nodes are discarded when the nodes are removed or the scene
+    # is closed, because the node IDs may be reused for new nodes.
+    slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeAboutToBeRemovedEvent, self.onNodeRemovedEvent)
+    slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.EndCloseEvent, self.onSceneClosedEvent)
+
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemovedEvent(self, caller, event, obj=None):
+
+    if obj == None:
+      return
+    if obj.IsA('vtkMRMLModelNode'):
+      removeSurfaceLOD(obj.GetID())
+      removeActivationMap(obj.GetID())
+    elif obj.IsA('vtkMRMLMarkupsNode'):
+      removeRecordedPointIndex(obj.GetID())
+      removeEgramTable(obj.GetID())
+      removeRecordedPointCloud(obj.GetID())
+
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onSceneClosedEvent(self, caller, event, obj=None):
+
+    removeSurfaceLOD()
+    removeActivationMap()
+    removeRecordedPointIndex()
+    removeEgramTable()
+    removeRecordedPointCloud()
+
     
   #--------------------------------------------------
   # GUI Slots
@@ -198,6 +355,27 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
         dnode.SetOpacity(0.5)
 
 
+  def getSelectedLOD(self):
+
+    for (i, button) in enumerate(self.lodRadioButton):
+      if button.checked:
+        return i
+    return 0
+
+
+  def onLODChanged(self):
+    # Switch the displayed level. The current parameter maps are propagated to the new level.
+
+    modelNode = self.modelSelector.currentNode()
+    lod = getSurfaceLOD(modelNode)
+    if lod == None or not lod.hasLevel(modelNode.GetPolyData()):
+      return
+    pointData = modelNode.GetPolyData().GetPointData()
+    scalarNames = [pointData.GetArrayName(i) for i in range(pointData.GetNumberOfArrays())]
+    lod.setLevel(modelNode, self.getSelectedLOD(), scalarNames)
+    self.updateActivationMap(modelNode)
+    
+
   def onResetPointRecording(self):
     td = self.currentCatheter        
     markupsNode = td.pointRecordingMarkupsNode
@@ -210,6 +388,10 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
     markupsNode = td.pointRecordingMarkupsNode
     modelNode = self.modelSelector.currentNode()
     pdf = self.pointDistanceFactorSliderWidget.value
+    if self.morphologySelector.currentText == 'SciPy':
+      self.surfaceGenerator.morphology = 'scipy'
+    else:
+      self.surfaceGenerator.morphology = 'sitk'
     
     if markupsNode:
       self.generateSurfaceModel(markupsNode, modelNode, pdf)
@@ -233,28 +415,13 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
 
       if paramIndex < 0: # 'None' is selected
         return
-      
-      if paramStr == 'Max(mV)':
-        self.colorRangeWidget.minimum = -50.0
-        self.colorRangeWidget.maximum = 50.0
-      elif paramStr == 'Min(mV)':
-        self.colorRangeWidget.minimum = -50.0
-        self.colorRangeWidget.maximum = 50.0
-      elif paramStr == 'LAT(ms)':
-        self.colorRangeWidget.minimum = -1000.0
-        self.colorRangeWidget.maximum = 1000.0
-      else: # Default
-        self.colorRangeWidget.minimum = -100.0
-        self.colorRangeWidget.maximum = 100.0
-
-      # Change the color range only when the parameter has been changed.
-      scalarRangeMin = self.defaultEgramValueRange[0]
-      scalarRangeMax = self.defaultEgramValueRange[1]
-      if paramStr == self.prevParamStr:
-        scalarRangeMin = self.colorRangeWidget.minimumValue 
-        scalarRangeMax = self.colorRangeWidget.maximumValue
-
-      self.prevParamStr = paramStr
+
+      # If 'All Parameters' is checked, the maps for all the parameters are computed at once.
+      # Each map is stored as point scalars named after the parameter, so that another parameter
+      # can be displayed without mapping again (see onParamSelected()).
+      params = [paramStr]
+      if self.mapAllCheckBox.checked:
+        params = paramList
 
       surfaceDistance = self.surfaceDistanceSliderWidget.value
       epsilon = self.epsilonSliderWidget.value
@@ -263,98 +430,180 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
       # Select points to be used for mapping
       pointsNP = self.fiducialsToNP(markupsNode)
       
-      # Combine the point coordinates and the distances into a NumPy N-D array
+      # Distances from the surface
       distanceNP = self.getPointDistances(pointsNP, modelPoly)
 
       # Get an array of egram parameters
-      egramNP = self.fiducialsToEgram(markupsNode, paramList)
+      egramNP = self.fiducialsToEgram(markupsNode, params)
       
-      # Combine the point coordinates, distances, and egram parameters
-      # pointsNP = np.array([[x_0, y_0, z_0, dist_0, egram0_0, egram1_0, ...., egramM_0],
-      #                      [x_1, y_1, z_1, dist_1, egram1_1, egram1_1, ...., egramM_1],
-      #                      [x_2, y_2, z_2, dist_2, egram1_2, egram1_2, ...., egramM_2],
-      #                                 ...
-      #                      [x_N, y_N, z_N, dist_N, egram1_N, egram1_N, ...., egramM_N]])
+      # Threashold by distance
+      mask = numpy.abs(distanceNP[:,0]) <= surfaceDistance
+      pointsNP = pointsNP[mask]
+      egramNP = egramNP[mask]
       
-      pointsNP = numpy.concatenate((pointsNP, distanceNP, egramNP), axis=1)
+      # Points on the surface
+      surfacePoints = numpy_support.vtk_to_numpy(modelPoly.GetPoints().GetData())
+
+      interpolation = self.interpolationSelector.currentText
+      if interpolation.startswith('Geodesic'):
+        # Geodesic interpolation on the mesh. The mapper caches the sparse factorizations for the
+        # mesh, so that the next map on the same surface is faster (see parametermapper.py).
+        mapper = self.geodesicMapper
+        mapper.method = 'graph' if interpolation == 'Geodesic (Graph)' else 'heat'
+        mapper.radius = epsilon
+        mapper.setMesh(surfacePoints, self.getTrianglesNP(modelPoly))
+      else:
+        # Radial basis function (RBF) interplation. The RBF system is solved once for all the parameters
+        # (see parametermapper.py).
+        mapper = RBFParameterMapper(rbfName, epsilon)
+      grid = mapper.map(pointsNP, egramNP, surfacePoints)
 
-      # Threashold by distance (5mm)
-      pointsNP = pointsNP[numpy.abs(pointsNP[:,3]) <= surfaceDistance,:]
-      
-      polyDataNormals = vtk.vtkPolyDataNormals()
-      polyDataNormals.SetInputData(modelPoly)
-      polyDataNormals.ComputeCellNormalsOn()
-      polyDataNormals.Update()
-      polyData = polyDataNormals.GetOutput()
-      
-      # Copy obtain points from the surface map
-      nPoints = polyData.GetNumberOfPoints()
-      nCells = polyData.GetNumberOfCells()
-      pSurface=[0.0, 0.0, 0.0]
-      minDistancePoint = [0.0, 0.0, 0.0]
-      
-      ## Create a list of points on the surface
-      surfacePoints = numpy.ndarray(shape=(nPoints,3))
-      
-      p=[0.0, 0.0, 0.0]
-      for id in range(nPoints):
-        polyData.GetPoint(id, p)
-        surfacePoints[id,:] = p
-        
-      # Copy markups to numpy array
-      pointsX = pointsNP[:,0]
-      pointsY = pointsNP[:,1]
-      pointsZ = pointsNP[:,2]
-      values  = pointsNP[:,4+paramIndex]
-      
-      surfacePointsX = surfacePoints[:,0]
-      surfacePointsY = surfacePoints[:,1]
-      surfacePointsZ = surfacePoints[:,2]
+      for (j, param) in enumerate(params):
+        pointValue = numpy_support.numpy_to_vtk(numpy.ascontiguousarray(grid[:,j]), deep=True)
+        pointValue.SetName(param)
+        modelPoly.GetPointData().AddArray(pointValue)
+        # Precompute the histogram and percentiles of the map (see scalarstatistics.py)
+        getScalarStatistics(modelPoly, param)
+        self.colorRanges.pop(param, None)
+      modelPoly.Modified()
 
-      # Radial basis function (RBF) interplation
-      # The following code is for SciPy version < 1.70
-      # A new RBF interpolator has been introduced version 1.70. Consider updating the code
-      # once 3D Slicer updates its SciPy version.
+      self.showParameterMap(modelNode, paramStr)
+      if 'LAT(ms)' in params:
+        self.updateActivationMap(modelNode)
 
-      if epsilon == 0.0:
-        rbfi = Rbf(pointsX, pointsY, pointsZ, values, function=rbfName)  # radial basis function interpolator instance
-      else:
-        rbfi = Rbf(pointsX, pointsY, pointsZ, values, epsilon=epsilon, function=rbfName)
-        
-      grid = rbfi(surfacePointsX, surfacePointsY, surfacePointsZ)
-
-      pointValue = vtk.vtkDoubleArray()
-      pointValue.SetName("Colors")
-      pointValue.SetNumberOfComponents(1)
-      pointValue.SetNumberOfTuples(nPoints)
-      pointValue.Reset()
-      pointValue.FillComponent(0,0.0);
-      
-      for id in range(nPoints):
-        pointValue.InsertValue(id, grid[id])
-      
-      modelNode.AddPointScalars(pointValue)
-      modelNode.SetActivePointScalars("Colors", vtk.vtkDataSetAttributes.SCALARS)
-      modelNode.Modified()
+
+  def onParamSelected(self):
+    # Display the map for the selected parameter, if it has already been computed.
+
+    modelNode = self.modelSelector.currentNode()
+    paramStr = self.paramSelector.currentText
+    if modelNode and paramStr != '' and paramStr != 'None':
+      self.showParameterMap(modelNode, paramStr)
+
+
+  def setColorRangeLimits(self, paramStr):
+
+    if paramStr == 'Max(mV)':
+      self.colorRangeWidget.minimum = -50.0
+      self.colorRangeWidget.maximum = 50.0
+    elif paramStr == 'Min(mV)':
+      self.colorRangeWidget.minimum = -50.0
+      self.colorRangeWidget.maximum = 50.0
+    elif paramStr == 'LAT(ms)':
+      self.colorRangeWidget.minimum = -1000.0
+      self.colorRangeWidget.maximum = 1000.0
+    else: # Default
+      self.colorRangeWidget.minimum = -100.0
+      self.colorRangeWidget.maximum = 100.0
+
+
+  def showParameterMap(self, modelNode, paramStr):
+    # Color the model by the point scalars for 'paramStr'. Returns False if the map is not available.
+
+    modelPoly = modelNode.GetPolyData()
+    if modelPoly == None or modelPoly.GetPointData().GetArray(paramStr) == None:
+      return False
+
+    # The color range of the parameter is kept while the map is unchanged. For a new map, the robust
+    # range obtained from the cached percentiles is used.
+    stats = getScalarStatistics(modelPoly, paramStr)
+    if paramStr in self.colorRanges:
+      (scalarRangeMin, scalarRangeMax) = self.colorRanges[paramStr]
+    elif stats.nValid > 0:
+      (scalarRangeMin, scalarRangeMax) = stats.getRobustRange(self.autoRangeClipSliderWidget.value)
+    else:
+      (scalarRangeMin, scalarRangeMax) = self.defaultEgramValueRange
+
+    # Change the limits of the slider, making sure that it covers the values. The signals are
+    # blocked, because the current values may be clamped.
+    self.colorRangeWidget.blockSignals(True)
+    self.setColorRangeLimits(paramStr)
+    if stats.nValid > 0:
+      self.colorRangeWidget.minimum = min(self.colorRangeWidget.minimum, stats.min)
+      self.colorRangeWidget.maximum = max(self.colorRangeWidget.maximum, stats.max)
+    self.colorRangeWidget.blockSignals(False)
+
+    self.prevParamStr = paramStr
+
+    modelNode.SetActivePointScalars(paramStr, vtk.vtkDataSetAttributes.SCALARS)
+    modelNode.Modified()
       
-      displayNode = modelNode.GetModelDisplayNode()
-      displayNode.SetActiveScalarName("Colors")
-      displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeFileColdToHotRainbow.txt')
-      displayNode.SetScalarRangeFlag(0) # Manual
-      displayNode.SetScalarRange(scalarRangeMin, scalarRangeMax)
-      displayNode.SetScalarVisibility(1)
-      displayNode.Modified()
+    displayNode = modelNode.GetModelDisplayNode()
+    displayNode.SetActiveScalarName(paramStr)
+    displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeFileColdToHotRainbow.txt')
+    displayNode.SetScalarRangeFlag(0) # Manual
+    displayNode.SetScalarRange(scalarRangeMin, scalarRangeMax)
+    displayNode.SetScalarVisibility(1)
+    displayNode.Modified()
       
-      if self.scalarBarWidget == None:
-        self.createScalarBar();
-      self.scalarBarWidget.SetEnabled(1)
+    if self.scalarBarWidget == None:
+      self.createScalarBar();
+    self.scalarBarWidget.SetEnabled(1)
       
-      actor = self.scalarBarWidget.GetScalarBarActor()
-      actor.SetTitle(paramStr)
+    actor = self.scalarBarWidget.GetScalarBarActor()
+    actor.SetTitle(paramStr)
+
+    if self.lookupTable:
+      self.lookupTable.SetRange(scalarRangeMin, scalarRangeMax)
+
+    self.colorRangeWidget.setValues(scalarRangeMin, scalarRangeMax)
+    self.updateRangeCoverage(scalarRangeMin, scalarRangeMax)
+
+    return True
+
+
+  def onAutoRange(self):
+
+    modelNode = self.modelSelector.currentNode()
+    if modelNode == None:
+      return
+    stats = getScalarStatistics(modelNode.GetPolyData(), self.prevParamStr)
+    if stats == None or stats.nValid == 0:
+      return
+    (minValue, maxValue) = stats.getRobustRange(self.autoRangeClipSliderWidget.value)
+    self.colorRangeWidget.setValues(minValue, maxValue)
 
-      if self.lookupTable:
-        self.lookupTable.SetRange(scalarRangeMin, scalarRangeMax)
 
+  def updateRangeCoverage(self, min, max):
+    # Show the fraction of the vertices within the color range, from the cached histogram.
+
+    modelNode = self.modelSelector.currentNode()
+    stats = None
+    if modelNode:
+      stats = getScalarStatistics(modelNode.GetPolyData(), self.prevParamStr)
+    if stats == None or stats.nValid == 0:
+      self.rangeCoverageLabel.setText('--')
+      return
+    self.rangeCoverageLabel.setText('%.1f %%' % (stats.getFractionInRange(min, max) * 100.0))
+
+
+  def onUpdateActivationMap(self):
+
+    self.updateActivationMap(self.modelSelector.currentNode())
+
+
+  def updateActivationMap(self, modelNode):
+    # Update the isochrones and CV vectors from the LAT map (see activationmap.py). Called whenever
+    # the LAT map or the displayed level is changed; the geometry of the mesh is cached, so that
+    # only the LAT-dependent part is recomputed.
+
+    if modelNode == None:
+      return
+    isochrones = bool(self.isochroneCheckBox.checked)
+    vectors = bool(self.velocityCheckBox.checked)
+    amap = getActivationMap(modelNode)
+    if not (isochrones or vectors):
+      amap.setVisible(False, False)
+      return
+
+    amap.spacing = self.isochroneSpacingSliderWidget.value
+    amap.vectorScale = self.vectorScaleSliderWidget.value
+    amap.maxVelocity = self.maxVelocitySliderWidget.value
+    if not amap.update('LAT(ms)', isochrones, vectors):
+      print('No LAT map on the model.')
+      self.velocityLabel.setText('--')
+      return
+    self.velocityLabel.setText('%.2f' % amap.getMedianVelocity())
 
 
   def getEgramParameterSelected(self, markupsNode):
@@ -387,6 +636,10 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
 
     if self.lookupTable:
       self.lookupTable.SetRange(min, max)      
+
+    if self.prevParamStr != '':
+      self.colorRanges[self.prevParamStr] = (min, max)
+    self.updateRangeCoverage(min, max)
       
       
   def createScalarBar(self):
@@ -456,127 +709,33 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
       fnode = caller
       dispNode = fnode.GetDisplayNode()
       pt = dispNode.GetActiveControlPoint()
-      desc = fnode.GetNthControlPointDescription(pt)
-      print('Egram: %s' % desc)
+      index = getRecordedPointIndex(fnode)
+      if pt < 0 or pt >= index.getNumberOfPoints():
+        return
+      table = getEgramTable(fnode)
+      params = table.getParameterNames()
+      values = table.getValues(params, pt, pt + 1)[0]
+      print('Egram: ' + ', '.join(['%s=%f' % (p, v) for (p, v) in zip(params, values)]))
 
       
           
   def generateSurfaceModel(self, markupsNode, modelNode, pointDistanceFactor):
-
-    svnode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLScalarVolumeNode')
+    # The surface generation pipeline is kept between runs (see surfacegenerator.py); the stages
+    # with unchanged inputs (e.g., the density volume when only 'pointDistanceFactor' is changed)
+    # are skipped.
 
     print('Generating a surface model from tracking data... ')
-    
-    ## Generate a scalar volume node
-    # Get the bounding box
-    print('Calculating bounding box... ')    
-    bounds = [0.0] * 6
-    markupsNode.GetBounds(bounds)
-    print(bounds)
-
-    b = numpy.array(bounds)
-    b = b.reshape((3,2))
-    origin = numpy.mean(b, axis=1)
-    fov = numpy.abs(b[:,1]-b[:,0])
-    fovMax = numpy.max(fov)
-    boundingBoxRange = (fovMax * 1.5)/2.0 # 1.5 times larger than the bounding box; from the center to the end (1/2 of each dimension)
-    b[:,0] = origin - boundingBoxRange
-    b[:,1] = origin + boundingBoxRange
-    bounds = b.reshape(-1)
-    print(bounds)
-    res = 256
-
-    print('Converting fiducials to poly data...')
-    poly = self.fiducialsToPoly(markupsNode)
-   
-    #Note: Altenatively, vtkImageEllipsoidSource may be used to generate a volume.
-    # Generate density field from points
-    # Use fixed radius
-    print('Running vtkPointDensityFilter...')
-    dens = vtk.vtkPointDensityFilter()
-    dens.SetInputData(poly)
-
-    # TODO - is the resolution good enoguh?
-    dens.SetSampleDimensions(res, res, res)
-    dens.SetDensityEstimateToFixedRadius()
-    # TODO - Does this radius work for every case?
-    pixelSize = boundingBoxRange * 2 / res
-
-    # Note: the algorithm fails when the bounding box is too small..
-    if pixelSize < 0.5:
-      pixelSize = 0.5
-    
-    radius = pixelSize
-    dens.SetRadius(radius)
-    #dens.SetDensityEstimateToRelativeRadius()
-    #dens.SetRelativeRadius(2.5)
-    #dens.SetDensityFormToVolumeNormalized()
-    dens.SetDensityFormToNumberOfPoints()
-    dens.SetModelBounds(bounds)
-    dens.ComputeGradientOn()
-    dens.Update()
-
-    print('Creating an image node...')    
-    # Crete an image node - geometric parameters (origin, spacing) must be moved to the node object
-    #imnode = slicer.vtkMRMLScalarVolumeNode()
-    imnode = slicer.mrmlScene.CreateNodeByClass('vtkMRMLScalarVolumeNode')
-    imnode.SetName('MRTracking_SurfaceMap_tmp')
-    imdata = dens.GetOutput()
-    imnode.SetAndObserveImageData(imdata)
-    imnode.SetOrigin(imdata.GetOrigin())
-    imnode.SetSpacing(imdata.GetSpacing())
-    #imdata.SetOrigin([0.0, 0.0, 0.0])
-    #imdata.SetSpacing([1.0, 1.0, 1.0])
-    slicer.mrmlScene.AddNode(imnode)
-
-    print('Applying BinaryThreshold...')    
-    image  = sitkUtils.PullVolumeFromSlicer(imnode.GetID())
-    binImage = sitk.BinaryThreshold(image, lowerThreshold=1.0, upperThreshold=256, insideValue=1, outsideValue=0)
-
-    # Calculate the radius parameter for dilation and erosion
-    radiusInPixel = int(numpy.ceil(pointDistanceFactor / pixelSize))
-    if radiusInPixel < 1.0:
-      radiusInPixel = 1
-
-    # Dilate the target label
-    print('Dilating the image...')    
-    dilateFilter = sitk.BinaryDilateImageFilter()
-    dilateFilter.SetBoundaryToForeground(False)
-    dilateFilter.SetKernelRadius(radiusInPixel)
-    dilateFilter.SetKernelType(sitk.sitkBall)
-    dilateFilter.SetForegroundValue(1)
-    dilateFilter.SetBackgroundValue(0)
-    dilateImage = dilateFilter.Execute(binImage)
-
-    # Fill holes in the target label
-    print('Filling holes...')    
-    fillHoleFilter = sitk.BinaryFillholeImageFilter()
-    fillHoleFilter.SetForegroundValue(1)
-    fillHoleFilter.SetFullyConnected(True)
-    fillHoleImage = fillHoleFilter.Execute(dilateImage)
-
-    # Erode the label
-    print('Eroding the image...')    
-    erodeFilter = sitk.BinaryErodeImageFilter()
-    erodeFilter.SetBoundaryToForeground(False)
-    erodeFilter.SetKernelType(sitk.sitkBall)
-    erodeFilter.SetKernelRadius(radiusInPixel-1) # 1 pixel smaller than the radius for dilation.
-    erodeFilter.SetForegroundValue(1)
-    erodeFilter.SetBackgroundValue(0)
-    erodeImage = erodeFilter.Execute(fillHoleImage)
-
-    print('Pushing the volume to the MRML scene...')    
-    sitkUtils.PushVolumeToSlicer(erodeImage, imnode.GetName(), 0, True)
-    imdata = imnode.GetImageData()
-
-    imdata.SetOrigin(imnode.GetOrigin())
-    imdata.SetSpacing(imnode.GetSpacing())
-
-    print('Running marching cubes...')    
-    poly = self.marchingCubes(imdata)
-    modelNode.SetAndObservePolyData(poly)
-
-    slicer.mrmlScene.RemoveNode(imnode)
+    pointsNP = self.fiducialsToNP(markupsNode)
+    (poly, modified) = self.surfaceGenerator.update(pointsNP, pointDistanceFactor)
+    if poly == None:
+      print('No points.')
+      return
+
+    lod = getSurfaceLOD(modelNode, create=True)
+    if modified or not lod.hasLevel(modelNode.GetPolyData()):
+      print('Generating levels of detail...')
+      lod.build(poly)
+    lod.setLevel(modelNode, self.getSelectedLOD())
     print('Done.')    
     
     
@@ -608,32 +767,32 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
 
 
   def fiducialsToNP(self, markupsNode):
-  
-    nPoints = markupsNode.GetNumberOfFiducials()
-    pos = [0.0]*3
-    pointsNP = numpy.ndarray(shape=(nPoints,3))
-      
-    for i in range(nPoints):
-      markupsNode.GetNthFiducialPosition(i, pos)
-      pointsNP[i,:] = pos
-    
-    return pointsNP
+    # The positions are obtained from the point index shared with the other modules (see pointindex.py),
+    # which only reads the control points added since the last call.
+
+    index = getRecordedPointIndex(markupsNode)
+    return numpy.array(index.getPoints())
   
 
   def fiducialsToEgram(self, markupsNode, paramList):
 
-    nParams = len(paramList)
-    nPoints = markupsNode.GetNumberOfFiducials()
-    values = numpy.ndarray(shape=(nPoints, nParams))
-    
-    for i in range(nPoints):
-      desc = markupsNode.GetNthControlPointDescription(i)
-      paramsStr = desc.split(',')
-      params = [float(s) for s in paramsStr]
-      values[i,:] = params[0:nParams]
+    # The egram parameters are read from the numeric columns of the egram table (see egramtable.py).
+    index = getRecordedPointIndex(markupsNode)
+    return index.getValues(paramList)
+
+
 
-    return values
+  def getTrianglesNP(self, modelPoly):
+    # Returns an (nT, 3) array of the point indices of the triangles. vtkTriangleFilter does not
+    # change the points.
 
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputData(modelPoly)
+    triangleFilter.PassVertsOff()
+    triangleFilter.PassLinesOff()
+    triangleFilter.Update()
+    polys = triangleFilter.GetOutput().GetPolys()
+    return numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).reshape(-1, 3)
 
 
   def getPointDistances(self, pointsNP, modelPoly):
@@ -649,41 +808,3 @@ class MRTrackingSurfaceMapping(MRTrackingPanelBase):
       distanceNP[i,0] = distance.EvaluateFunction(pos)
 
     return distanceNP
-  
-
-  def marchingCubes(self, imageData):
-    
-    mc = vtk.vtkMarchingCubes()
-    mc.SetInputData(imageData)
-    mc.ComputeNormalsOff()
-    mc.ComputeGradientsOff()
-    mc.SetValue(0, 1.0)
-    mc.Update()
-    
-    #smoothFilter = vtk.vtkSmoothPolyDataFilter()
-    ##smoothFilter.SetInputConnection(confilter.GetOutputPort())
-    #smoothFilter.SetInputData(mc.GetOutput())
-    #smoothFilter.SetNumberOfIterations(15)
-    #smoothFilter.SetRelaxationFactor(0.1)
-    #smoothFilter.FeatureEdgeSmoothingOff()
-    #smoothFilter.BoundarySmoothingOn()
-    #smoothFilter.Update()
-
-    smoothFilter2 = vtk.vtkWindowedSincPolyDataFilter()
-    smoothFilter2.SetInputData(mc.GetOutput())
-    smoothFilter2.SetNumberOfIterations(10)
-    smoothFilter2.BoundarySmoothingOff()
-    smoothFilter2.FeatureEdgeSmoothingOff()
-    smoothFilter2.SetFeatureAngle(120)
-    smoothFilter2.SetPassBand(0.001)
-    smoothFilter2.NonManifoldSmoothingOn()
-    smoothFilter2.NormalizeCoordinatesOn()
-    smoothFilter2.Update()
-    
-    decimate = vtk.vtkDecimatePro()
-    decimate.SetInputData(smoothFilter2.GetOutput())
-    decimate.SetTargetReduction(0.1)
-    decimate.PreserveTopologyOn()
-    decimate.Update()
-    
-    return decimate.GetOutput()
@@ -0,0 +1,191 @@
+import numpy
+
+#------------------------------------------------------------
+#
+# TrackingHistory class
+#
+
+class TrackingHistory():
+
+  # TrackingHistory keeps the recent coil positions of a catheter with their time stamps in
+  # a preallocated ring buffer:
+  #
+  #   timeStamps[i] : acquisition time (seconds)
+  #   points[i]     : (nPoints, 3) array of the active coil positions (before registration)
+  #
+  # The number of coils is fixed while the samples are kept; if a sample with a different number
+  # of coils is added (e.g., the active coils are changed), the history is cleared.
+  #
+  # The history keeps at least the samples of the last 'duration' seconds (e.g., the interval between
+  # two registration point collections): the buffer is enlarged (up to 'maxCapacity' samples) if the
+  # oldest sample would be overwritten before it becomes older than 'duration'. The capacity is
+  # therefore adjusted to the tracking rate x 'duration'.
+
+  def __init__(self, capacity=64, duration=0.0, maxCapacity=8192):
+
+    self.capacity = capacity
+    self.duration = duration
+    self.maxCapacity = maxCapacity
+    self.allocate(0)
+
+
+  def setDuration(self, duration):
+
+    self.duration = duration
+
+
+  def grow(self):
+    # Double the capacity, keeping the samples.
+
+    (timeStamps, points) = self.getSamples()
+    n = self.nSamples
+    self.capacity = min(2 * self.capacity, self.maxCapacity)
+    self.timeStamps = numpy.zeros(self.capacity)
+    self.points = numpy.zeros((self.capacity, self.nPoints, 3))
+    self.timeStamps[:n] = timeStamps
+    self.points[:n] = points
+    self.head = n % self.capacity
+
+
+  def allocate(self, nPoints):
+
+    self.nPoints = nPoints
+    self.timeStamps = numpy.zeros(self.capacity)
+    self.points = numpy.zeros((self.capacity, nPoints, 3))
+    self.nSamples = 0
+    self.head = 0            # Index of the slot for the next sample
+
+
+  def clear(self):
+
+    self.nSamples = 0
+    self.head = 0
+
+
+  def add(self, timeStamp, points):
+    # Add a sample. 'points' is an (n, 3) array. A sample older than the newest one is ignored
+    # to keep the time stamps in an ascending order.
+
+    points = numpy.asarray(points, dtype=float).reshape(-1, 3)
+    if points.shape[0] != self.nPoints:
+      self.allocate(points.shape[0])
+
+    if self.nSamples > 0 and timeStamp <= self.getLatestTime():
+      return False
+
+    # When full, 'head' points to the oldest sample.
+    if self.nSamples == self.capacity and self.capacity < self.maxCapacity and timeStamp - self.timeStamps[self.head] < self.duration:
+      self.grow()
+
+    self.timeStamps[self.head] = timeStamp
+    self.points[self.head] = points
+    self.head = (self.head + 1) % self.capacity
+    self.nSamples = min(self.nSamples + 1, self.capacity)
+    return True
+
+
+  def getNumberOfSamples(self):
+
+    return self.nSamples
+
+
+  def getLatestTime(self):
+
+    if self.nSamples == 0:
+      return None
+    return self.timeStamps[(self.head - 1) % self.capacity]
+
+
+  def getSamples(self):
+    # Returns a tuple (timeStamps, points) ordered from the oldest to the newest.
+
+    index = (self.head - self.nSamples + numpy.arange(self.nSamples)) % self.capacity
+    return (self.timeStamps[index], self.points[index])
+
+
+  def interpolate(self, times, maxGap):
+    #
+    # Estimate the coil positions at the given times by linear interpolation between the two
+    # samples before and after each time. Returns a tuple (points, valid), where 'points' is an
+    # (m, nPoints, 3) array and 'valid' is a boolean array. An estimate is valid only if the time
+    # is within the history and the two samples are at most 'maxGap' seconds apart.
+    #
+
+    times = numpy.asarray(times, dtype=float).reshape(-1)
+    m = times.shape[0]
+    points = numpy.zeros((m, self.nPoints, 3))
+    valid = numpy.zeros(m, dtype=bool)
+    if self.nSamples == 0 or m == 0:
+      return (points, valid)
+
+    (ts, pts) = self.getSamples()
+
+    # Index of the sample after each time. A time equal to a sample uses that sample.
+    i1 = numpy.searchsorted(ts, times, side='left')
+    inRange = numpy.logical_and(i1 < self.nSamples, times >= ts[0])
+    i1 = numpy.clip(i1, 1, max(self.nSamples - 1, 1))
+    i0 = i1 - 1
+    if self.nSamples == 1:
+      i0[:] = 0
+      i1[:] = 0
+
+    gap = ts[i1] - ts[i0]
+    valid = numpy.logical_and(inRange, gap <= maxGap)
+
+    w = numpy.zeros(m)
+    fGap = gap > 0.0
+    w[fGap] = (times[fGap] - ts[i0[fGap]]) / gap[fGap]
+    w = numpy.clip(w, 0.0, 1.0)[:,None,None]
+    points = (1.0 - w) * pts[i0] + w * pts[i1]
+
+    return (points, valid)
+
+
+def pairTrackingSamples(history0, history1, since, maxTimeDifference):
+  #
+  # Pair the samples of two tracking histories. The stream with fewer samples after 'since' is
+  # used as the reference, and the other (faster) stream is interpolated at the time stamps of
+  # the reference samples. The reference samples after the newest sample of the other stream
+  # are left for the next call, because they cannot be interpolated yet.
+  #
+  # Returns a tuple (times, points0, points1, lastTime):
+  #   times    : (m,) time stamps of the pairs
+  #   points0  : (m, n0, 3) coil positions of history0
+  #   points1  : (m, n1, 3) coil positions of history1
+  #   lastTime : time stamp of the last reference sample examined; pass it as 'since' to the next call
+  #
+
+  empty = (numpy.zeros(0), numpy.zeros((0, history0.nPoints, 3)), numpy.zeros((0, history1.nPoints, 3)), since)
+  if history0.getNumberOfSamples() == 0 or history1.getNumberOfSamples() == 0:
+    return empty
+
+  (ts0, pts0) = history0.getSamples()
+  (ts1, pts1) = history1.getSamples()
+
+  # The samples after 'since' may have been overwritten if the histories are too short for the
+  # interval between the calls.
+  if since > 0.0 and (ts0[0] > since or ts1[0] > since):
+    print('TrackingHistory: samples since the last pairing have been dropped (capacity = %d, %d).' % (history0.capacity, history1.capacity))
+  n0 = numpy.count_nonzero(ts0 > since)
+  n1 = numpy.count_nonzero(ts1 > since)
+
+  if n0 <= n1:
+    (refTimes, refPoints, other, otherLatest) = (ts0, pts0, history1, ts1[-1])
+  else:
+    (refTimes, refPoints, other, otherLatest) = (ts1, pts1, history0, ts0[-1])
+
+  candidate = numpy.logical_and(refTimes > since, refTimes <= otherLatest)
+  if not numpy.any(candidate):
+    return empty
+
+  times = refTimes[candidate]
+  (otherPoints, valid) = other.interpolate(times, maxTimeDifference)
+  lastTime = times[-1]
+  times = times[valid]
+  refPoints = refPoints[candidate][valid]
+  otherPoints = otherPoints[valid]
+
+  if n0 <= n1:
+    return (times, refPoints, otherPoints, lastTime)
+  else:
+    return (times, otherPoints, refPoints, lastTime)